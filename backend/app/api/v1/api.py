@@ -1,9 +1,10 @@
 from fastapi import APIRouter
+from fastapi.responses import ORJSONResponse
 
 from app.api.v1.endpoints import agents, chat, sessions
 
-# 创建API路由器
-api_router = APIRouter()
+# 创建API路由器（默认使用orjson序列化响应）
+api_router = APIRouter(default_response_class=ORJSONResponse)
 
 # 注册各个模块的路由
 api_router.include_router(
@@ -1,20 +1,76 @@
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import ORJSONResponse
 from typing import List, Optional
-import uuid
-import json
+from functools import lru_cache
 from datetime import datetime
 
-from app.core.database import get_db, db_manager
+from app.core.serialization import dumps, loads, loads_frozen, FrozenDict, EMPTY_JSON
+from app.core.database import get_db, db_manager, AGENT_COLUMNS, SESSION_TREE_QUERY, rows_to_tree
+from app.core.cache import response_cache
+from app.core.responses import json_response
 from app.models.agent import (
     AgentCreate, AgentResponse, AgentUpdate, BranchCreateRequest,
     AgentSwitchRequest, AgentHierarchyNode, AgentStackFrameCreate
 )
-from app.services.agent_manager import AgentManager
+from app.services.agent_manager import agent_manager
 from app.core.multi_agent_manager import multi_agent_manager
+from app.core.stack_frame import resolve_inherited_messages
 from app.services.context_processor import context_processor
 
 router = APIRouter()
-agent_manager = AgentManager()
+
+# 热点查询语句：模块加载时构建一次，固定的SQL文本可命中连接的已编译语句缓存
+AGENT_BY_ID_QUERY = f"SELECT {AGENT_COLUMNS} FROM agents WHERE id = ?"
+AGENT_CHILDREN_QUERY = f"SELECT {AGENT_COLUMNS} FROM agents WHERE parent_id = ? ORDER BY created_at"
+
+
+@lru_cache(maxsize=4096)
+def _decode_context_data(raw: str) -> FrozenDict:
+    """
+    解析context_data字段
+    
+    以原始JSON字符串为缓存键：内容变化即换键，写入时无需失效。
+    结果为只读结构，可在多个响应和响应缓存之间安全共享。
+    """
+    return loads_frozen(raw)
+
+
+def _row_to_agent(row) -> AgentResponse:
+    """将agents表记录转换为AgentResponse"""
+    data = dict(row)
+    data["context_data"] = _decode_context_data(data["context_data"] or EMPTY_JSON)
+    return AgentResponse.model_validate(data)
+
+
+def _rows_to_agents(rows) -> List[dict]:
+    """
+    将多条agents表记录转换为响应字典列表
+    
+    数据直接来自数据库、类型已知，列表端点跳过Pydantic校验，
+    并直接返回ORJSONResponse以绕过jsonable_encoder。
+    """
+    agents = []
+    for row in rows:
+        data = dict(row)
+        data["context_data"] = _decode_context_data(data["context_data"] or EMPTY_JSON)
+        agents.append(data)
+    return agents
+
+
+async def assert_agent_exists(agent_id: str):
+    """仅检查Agent是否存在，不存在时返回404"""
+    row = await db_manager.execute_one("SELECT 1 FROM agents WHERE id = ? LIMIT 1", (agent_id,))
+    if not row:
+        raise HTTPException(status_code=404, detail="Agent不存在")
+
+
+def invalidate_agent_cache(agent_id: Optional[str] = None):
+    """Agent数据变更后使相关响应缓存失效"""
+    if agent_id:
+        response_cache.invalidate(f"agent:{agent_id}")
+        response_cache.invalidate(f"context:{agent_id}")
+    response_cache.invalidate_prefix("agents:")
+    response_cache.invalidate_prefix("hierarchy:")
 
 
 @router.post("/main", response_model=AgentResponse)
@@ -25,7 +81,7 @@ async def create_main_agent(agent_data: AgentCreate):
     
     # 检查会话是否存在
     session_check = await db_manager.execute_one(
-        "SELECT id FROM sessions WHERE id = ?", 
+        "SELECT 1 FROM sessions WHERE id = ?", 
         (agent_data.session_id,)
     )
     if not session_check:
@@ -33,7 +89,7 @@ async def create_main_agent(agent_data: AgentCreate):
     
     # 检查会话中是否已有主Agent
     existing_main = await db_manager.execute_one(
-        "SELECT id FROM agents WHERE session_id = ? AND agent_type = 'main'",
+        "SELECT 1 FROM agents WHERE session_id = ? AND agent_type = 'main'",
         (agent_data.session_id,)
     )
     if existing_main:
@@ -46,24 +102,12 @@ async def create_main_agent(agent_data: AgentCreate):
             topic=agent_data.topic,
             config=agent_data.context_data
         )
+        invalidate_agent_cache()
         
         # 获取创建的Agent信息
-        agent_row = await db_manager.execute_one(
-            "SELECT * FROM agents WHERE id = ?",
-            (agent_id,)
-        )
+        agent_row = await db_manager.execute_one(AGENT_BY_ID_QUERY, (agent_id,))
         
-        return AgentResponse(
-            id=agent_row[0],
-            session_id=agent_row[1],
-            parent_id=agent_row[2],
-            agent_type=agent_row[3],
-            topic=agent_row[4],
-            context_data=json.loads(agent_row[5]) if agent_row[5] else {},
-            stack_depth=agent_row[6],
-            status=agent_row[7],
-            created_at=agent_row[8]
-        )
+        return _row_to_agent(agent_row)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"创建主Agent失败: {str(e)}")
@@ -75,7 +119,7 @@ async def create_branch_agent(branch_data: BranchCreateRequest):
     
     # 验证父Agent存在
     parent_agent = await db_manager.execute_one(
-        "SELECT * FROM agents WHERE id = ?",
+        "SELECT 1 FROM agents WHERE id = ?",
         (branch_data.parent_agent_id,)
     )
     
@@ -90,24 +134,12 @@ async def create_branch_agent(branch_data: BranchCreateRequest):
             message_id=branch_data.message_id,
             inheritance_mode=branch_data.inheritance_mode
         )
+        invalidate_agent_cache()
         
         # 获取创建的分支Agent信息
-        agent_row = await db_manager.execute_one(
-            "SELECT * FROM agents WHERE id = ?",
-            (branch_agent_id,)
-        )
+        agent_row = await db_manager.execute_one(AGENT_BY_ID_QUERY, (branch_agent_id,))
         
-        return AgentResponse(
-            id=agent_row[0],
-            session_id=agent_row[1],
-            parent_id=agent_row[2],
-            agent_type=agent_row[3],
-            topic=agent_row[4],
-            context_data=json.loads(agent_row[5]) if agent_row[5] else {},
-            stack_depth=agent_row[6],
-            status=agent_row[7],
-            created_at=agent_row[8]
-        )
+        return _row_to_agent(agent_row)
         
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
@@ -118,25 +150,20 @@ async def create_branch_agent(branch_data: BranchCreateRequest):
 @router.get("/{agent_id}", response_model=AgentResponse)
 async def get_agent(agent_id: str):
     """获取Agent详情"""
-    query = "SELECT * FROM agents WHERE id = ?"
+    cache_key = f"agent:{agent_id}"
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
     
     try:
-        row = await db_manager.execute_one(query, (agent_id,))
+        row = await db_manager.execute_one(AGENT_BY_ID_QUERY, (agent_id,))
         
         if not row:
             raise HTTPException(status_code=404, detail="Agent不存在")
         
-        return AgentResponse(
-            id=row[0],
-            session_id=row[1],
-            parent_id=row[2],
-            agent_type=row[3],
-            topic=row[4],
-            context_data=json.loads(row[5]) if row[5] else {},
-            stack_depth=row[6],
-            status=row[7],
-            created_at=row[8]
-        )
+        agent = _row_to_agent(row)
+        response_cache.set(cache_key, agent)
+        return agent
         
     except HTTPException:
         raise
@@ -147,9 +174,6 @@ async def get_agent(agent_id: str):
 @router.put("/{agent_id}", response_model=AgentResponse)
 async def update_agent(agent_id: str, agent_update: AgentUpdate):
     """更新Agent"""
-    # 首先检查Agent是否存在
-    existing_agent = await get_agent(agent_id)
-    
     # 构建更新字段
     update_fields = []
     params = []
@@ -160,23 +184,29 @@ async def update_agent(agent_id: str, agent_update: AgentUpdate):
     
     if agent_update.context_data is not None:
         update_fields.append("context_data = ?")
-        params.append(json.dumps(agent_update.context_data))
+        params.append(dumps(agent_update.context_data))
     
     if agent_update.status is not None:
         update_fields.append("status = ?")
         params.append(agent_update.status)
     
     if not update_fields:
-        return existing_agent
+        return await get_agent(agent_id)
     
     params.append(agent_id)
-    query = f"UPDATE agents SET {', '.join(update_fields)} WHERE id = ?"
+    # 使用RETURNING在一次往返中完成更新与读取，未命中即表示Agent不存在
+    query = f"UPDATE agents SET {', '.join(update_fields)} WHERE id = ? RETURNING {AGENT_COLUMNS}"
     
     try:
-        await db_manager.execute_update(query, tuple(params))
-        return await get_agent(agent_id)
+        row = await db_manager.execute_returning(query, tuple(params))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新Agent失败: {str(e)}")
+    
+    if not row:
+        raise HTTPException(status_code=404, detail="Agent不存在")
+    
+    invalidate_agent_cache(agent_id)
+    return _row_to_agent(row)
 
 
 @router.post("/switch", response_model=dict)
@@ -212,11 +242,8 @@ async def switch_agent(switch_data: AgentSwitchRequest):
 @router.post("/{agent_id}/activate")
 async def activate_agent(agent_id: str):
     """激活Agent（兼容旧接口）"""
-    # 检查Agent是否存在
-    agent = await get_agent(agent_id)
-    
     try:
-        # 使用新的切换机制
+        # 使用新的切换机制（目标Agent不存在时抛出ValueError）
         success = await multi_agent_manager.switch_agent(
             from_agent_id="",
             to_agent_id=agent_id,
@@ -229,6 +256,8 @@ async def activate_agent(agent_id: str):
             "status": "active"
         }
         
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Agent不存在")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"激活Agent失败: {str(e)}")
 
@@ -236,52 +265,37 @@ async def activate_agent(agent_id: str):
 @router.post("/{agent_id}/suspend")
 async def suspend_agent(agent_id: str):
     """挂起Agent"""
-    # 检查Agent是否存在
-    agent = await get_agent(agent_id)
-    
     try:
-        # 更新Agent状态为挂起
-        await db_manager.execute_update(
+        # 更新Agent状态为挂起，影响行数为0即表示Agent不存在
+        updated = await db_manager.execute_update(
             "UPDATE agents SET status = 'suspended' WHERE id = ?",
             (agent_id,)
         )
-        
-        return {
-            "message": "Agent挂起成功",
-            "agent_id": agent_id,
-            "status": "suspended"
-        }
-        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"挂起Agent失败: {str(e)}")
+    
+    if not updated:
+        raise HTTPException(status_code=404, detail="Agent不存在")
+    
+    invalidate_agent_cache(agent_id)
+    return {
+        "message": "Agent挂起成功",
+        "agent_id": agent_id,
+        "status": "suspended"
+    }
 
 
 @router.get("/{agent_id}/children")
 async def get_agent_children(agent_id: str):
     """获取Agent的子Agent列表"""
     # 检查Agent是否存在
-    await get_agent(agent_id)
-    
-    query = "SELECT * FROM agents WHERE parent_id = ? ORDER BY created_at"
+    await assert_agent_exists(agent_id)
     
     try:
-        rows = await db_manager.execute_query(query, (agent_id,))
-        children = []
+        rows = await db_manager.execute_query(AGENT_CHILDREN_QUERY, (agent_id,))
+        children = _rows_to_agents(rows)
         
-        for row in rows:
-            children.append(AgentResponse(
-                id=row[0],
-                session_id=row[1],
-                parent_id=row[2],
-                agent_type=row[3],
-                topic=row[4],
-                context_data=json.loads(row[5]) if row[5] else {},
-                stack_depth=row[6],
-                status=row[7],
-                created_at=row[8]
-            ))
-        
-        return {"children": children}
+        return await json_response({"children": children}, len(children))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取子Agent失败: {str(e)}")
@@ -290,12 +304,19 @@ async def get_agent_children(agent_id: str):
 @router.get("/{agent_id}/hierarchy")
 async def get_agent_hierarchy(agent_id: str):
     """获取以指定Agent为根的层级结构"""
+    cache_key = f"hierarchy:agent:{agent_id}"
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     # 检查Agent是否存在
-    await get_agent(agent_id)
+    await assert_agent_exists(agent_id)
     
     try:
         hierarchy = await agent_manager.build_agent_hierarchy(agent_id)
-        return {"hierarchy": hierarchy}
+        result = {"hierarchy": hierarchy}
+        response_cache.set(cache_key, result)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取Agent层级结构失败: {str(e)}")
 
@@ -311,18 +332,11 @@ async def delete_agent(agent_id: str, force: bool = False):
         raise HTTPException(status_code=400, detail="删除主Agent需要设置force=true参数")
     
     try:
-        # 获取所有需要删除的Agent ID（包括子Agent）
-        agent_ids_to_delete = await get_agent_subtree_ids(agent_id)
-        
-        # 删除所有相关消息
+        # 删除整棵子树，并从内存缓存和层级关系中移除
+        agent_ids_to_delete = await multi_agent_manager.delete_agent_branch(agent_id)
         for aid in agent_ids_to_delete:
-            await db_manager.execute_update(
-                "DELETE FROM messages WHERE agent_id = ?",
-                (aid,)
-            )
-        
-        # 递归删除所有子Agent
-        await agent_manager.delete_agent_recursive(agent_id)
+            agent_manager.active_frames.pop(aid, None)
+        response_cache.clear()
         
         return {
             "message": "Agent及相关数据删除成功",
@@ -334,42 +348,56 @@ async def delete_agent(agent_id: str, force: bool = False):
         raise HTTPException(status_code=500, detail=f"删除Agent失败: {str(e)}")
 
 
-async def get_agent_subtree_ids(agent_id: str) -> List[str]:
-    """获取Agent及其所有子Agent的ID列表"""
-    agent_ids = [agent_id]
-    
-    # 递归获取所有子Agent
-    children_query = "SELECT id FROM agents WHERE parent_id = ?"
-    children = await db_manager.execute_query(children_query, (agent_id,))
-    
-    for child in children:
-        child_id = child[0]
-        child_subtree = await get_agent_subtree_ids(child_id)
-        agent_ids.extend(child_subtree)
-    
-    return agent_ids
-
-
 @router.get("/{agent_id}/context")
 async def get_agent_context(agent_id: str):
     """获取Agent的上下文信息"""
+    cache_key = f"context:{agent_id}"
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     # 检查Agent是否存在
-    await get_agent(agent_id)
+    await assert_agent_exists(agent_id)
     
     try:
         # 获取栈帧信息
-        frame_query = "SELECT * FROM agent_stack_frames WHERE agent_id = ? ORDER BY created_at DESC LIMIT 1"
+        frame_query = """
+            SELECT context_data, inherited_context, stack_depth, status
+            FROM agent_stack_frames
+            WHERE agent_id = ?
+            ORDER BY created_at DESC
+            LIMIT 1
+        """
         frame_row = await db_manager.execute_one(frame_query, (agent_id,))
         
         if not frame_row:
             return {"context_data": {}, "inherited_context": {}}
         
-        return {
-            "context_data": json.loads(frame_row[2]) if frame_row[2] else {},
-            "inherited_context": json.loads(frame_row[3]) if frame_row[3] else {},
-            "stack_depth": frame_row[4],
-            "status": frame_row[5]
+        # 消息保存在消息表中，不随栈帧记录保存
+        context_data = loads(frame_row["context_data"]) if frame_row["context_data"] else {}
+        inherited_context = loads(frame_row["inherited_context"]) if frame_row["inherited_context"] else {}
+        
+        # full模式的继承只保存来源引用，与本Agent的消息在同一次查询中取回
+        source_agent_id = None
+        if inherited_context.get("inheritance_mode") == "full" and "inherited_messages" not in inherited_context:
+            source_agent_id = inherited_context.get("source_agent_id")
+        
+        message_owners = [agent_id, source_agent_id] if source_agent_id else [agent_id]
+        messages_by_agent = await multi_agent_manager.load_messages(message_owners)
+        context_data["messages"] = messages_by_agent.get(agent_id, [])
+        if source_agent_id:
+            inherited_context["inherited_messages"] = resolve_inherited_messages(
+                inherited_context, messages_by_agent.get(source_agent_id, [])
+            )
+        
+        context = {
+            "context_data": context_data,
+            "inherited_context": inherited_context,
+            "stack_depth": frame_row["stack_depth"],
+            "status": frame_row["status"]
         }
+        response_cache.set(cache_key, context)
+        return context
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取Agent上下文失败: {str(e)}")
@@ -380,27 +408,22 @@ async def get_active_agents():
     """获取当前活跃的Agent列表"""
     try:
         active_agent_ids = await multi_agent_manager.get_active_agents()
+        if not active_agent_ids:
+            return ORJSONResponse({"active_agents": []})
+
+        # 一次性批量查询，避免逐个Agent查询数据库
+        placeholders = ",".join("?" * len(active_agent_ids))
+        rows = await db_manager.execute_query(
+            f"SELECT {AGENT_COLUMNS} FROM agents WHERE id IN ({placeholders})",
+            tuple(active_agent_ids)
+        )
+        rows_by_id = {row[0]: row for row in rows}
+
+        agents = _rows_to_agents(
+            rows_by_id[agent_id] for agent_id in active_agent_ids if agent_id in rows_by_id
+        )
         
-        agents = []
-        for agent_id in active_agent_ids:
-            agent_row = await db_manager.execute_one(
-                "SELECT * FROM agents WHERE id = ?",
-                (agent_id,)
-            )
-            if agent_row:
-                agents.append(AgentResponse(
-                    id=agent_row[0],
-                    session_id=agent_row[1],
-                    parent_id=agent_row[2],
-                    agent_type=agent_row[3],
-                    topic=agent_row[4],
-                    context_data=json.loads(agent_row[5]) if agent_row[5] else {},
-                    stack_depth=agent_row[6],
-                    status=agent_row[7],
-                    created_at=agent_row[8]
-                ))
-        
-        return {"active_agents": agents}
+        return await json_response({"active_agents": agents}, len(agents))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取活跃Agent列表失败: {str(e)}")
@@ -431,9 +454,17 @@ async def get_memory_stats():
 @router.get("/session/{session_id}/hierarchy")
 async def get_session_hierarchy(session_id: str):
     """获取会话的完整Agent层级结构"""
+    cache_key = f"hierarchy:session:{session_id}"
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return await json_response(cached)
+    
     try:
-        hierarchy = await multi_agent_manager.get_session_hierarchy(session_id)
-        return {"hierarchy": hierarchy}
+        # 递归查询按层级返回节点，直接组装为字典树，无需构建Pydantic模型再逐字段编码
+        rows = await db_manager.execute_query(SESSION_TREE_QUERY, (session_id,))
+        result = {"hierarchy": rows_to_tree(rows)}
+        response_cache.set(cache_key, result)
+        return await json_response(result, len(rows))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取会话层级结构失败: {str(e)}")
@@ -442,6 +473,11 @@ async def get_session_hierarchy(session_id: str):
 @router.get("/")
 async def list_agents(session_id: Optional[str] = None, agent_type: Optional[str] = None, status: Optional[str] = None):
     """获取Agent列表"""
+    cache_key = f"agents:{session_id}:{agent_type}:{status}"
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return await json_response(cached, len(cached["agents"]))
+    
     conditions = []
     params = []
     
@@ -458,26 +494,15 @@ async def list_agents(session_id: Optional[str] = None, agent_type: Optional[str
         params.append(status)
     
     where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
-    query = f"SELECT * FROM agents{where_clause} ORDER BY created_at DESC"
+    query = f"SELECT {AGENT_COLUMNS} FROM agents{where_clause} ORDER BY created_at DESC"
     
     try:
         rows = await db_manager.execute_query(query, tuple(params))
-        agents = []
-        
-        for row in rows:
-            agents.append(AgentResponse(
-                id=row[0],
-                session_id=row[1],
-                parent_id=row[2],
-                agent_type=row[3],
-                topic=row[4],
-                context_data=json.loads(row[5]) if row[5] else {},
-                stack_depth=row[6],
-                status=row[7],
-                created_at=row[8]
-            ))
+        agents = _rows_to_agents(rows)
         
-        return {"agents": agents}
+        result = {"agents": agents}
+        response_cache.set(cache_key, result)
+        return await json_response(result, len(agents))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取Agent列表失败: {str(e)}")
\ No newline at end of file
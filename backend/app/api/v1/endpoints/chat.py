@@ -1,83 +1,201 @@
 from fastapi import APIRouter, HTTPException, Depends
 from fastapi.responses import StreamingResponse
 from typing import List, Optional
-import uuid
-import json
+import asyncio
+from pydantic import TypeAdapter
+from functools import lru_cache
 from datetime import datetime
 
-from app.core.database import get_db, db_manager
+from app.core.serialization import loads, loads_frozen, EMPTY_JSON
+from app.core.database import get_db, db_manager, MESSAGE_COLUMNS
+from app.core.cache import response_cache
+from app.core.responses import json_response
+from app.core.ids import new_id
 from app.models.chat import ChatRequest, ChatResponse, ConversationResponse, ChatStreamRequest, ChatStreamChunk
 from app.models.message import MessageCreate, MessageResponse
 from app.services.deepseek_service import deepseek_service
-from app.services.agent_manager import AgentManager
 from app.core.multi_agent_manager import multi_agent_manager
+from app.api.v1.endpoints.agents import assert_agent_exists
 from app.services.context_processor import context_processor
 
 router = APIRouter()
 ai_service = deepseek_service
-agent_manager = AgentManager()
 
+# 流式响应块的序列化器：dump_json直接输出bytes
+_STREAM_CHUNK_ADAPTER = TypeAdapter(ChatStreamChunk)
 
-@router.post("/send", response_model=ChatResponse)
-async def send_message(chat_request: ChatRequest):
-    """发送消息并获取AI回复"""
+# 热点查询语句：模块加载时构建一次，固定的SQL文本可命中连接的已编译语句缓存
+MESSAGE_BY_ID_QUERY = f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id = ?"
+# 最近消息及整段对话的统计信息，一次往返取回（标量子查询只计算一次）
+CONVERSATION_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS},
+        (SELECT COUNT(*) FROM messages WHERE agent_id = ?1) AS total_messages,
+        (SELECT MIN(timestamp) FROM messages WHERE agent_id = ?1) AS started_at,
+        (SELECT MAX(timestamp) FROM messages WHERE agent_id = ?1) AS last_activity
+    FROM messages 
+    WHERE agent_id = ?1 
+    ORDER BY timestamp DESC 
+    LIMIT ?2
+"""
+# 最近max_messages条消息，按时间正序返回
+RECENT_CONTEXT_QUERY = """
+    SELECT role, content FROM (
+        SELECT role, content, timestamp FROM messages 
+        WHERE agent_id = ? 
+        ORDER BY timestamp DESC 
+        LIMIT ?
+    ) ORDER BY timestamp ASC
+"""
+# 自动模式：在最近max_messages条消息中，超过8条时只取开头2条和最后6条
+AUTO_CONTEXT_QUERY = """
+    WITH recent AS (
+        SELECT role, content, timestamp FROM messages 
+        WHERE agent_id = ?1 
+        ORDER BY timestamp DESC 
+        LIMIT ?2
+    ),
+    ranked AS (
+        SELECT role, content, timestamp,
+            ROW_NUMBER() OVER (ORDER BY timestamp DESC) AS rn,
+            COUNT(*) OVER () AS total
+        FROM recent
+    )
+    SELECT role, content FROM ranked 
+    WHERE total <= 8 OR rn <= 6 OR rn > total - 2 
+    ORDER BY timestamp ASC
+"""
+
+
+def _row_to_message(row) -> MessageResponse:
+    """将messages表记录转换为MessageResponse"""
+    data = dict(row)
+    data["metadata"] = loads(data["metadata"]) if data["metadata"] else {}
+    return MessageResponse.model_validate(data)
+
+
+def _rows_to_messages(rows) -> List[dict]:
+    """
+    将多条messages表记录转换为响应字典列表
     
-    # 检查Agent是否存在
-    agent_query = "SELECT * FROM agents WHERE id = ?"
-    agent_row = await db_manager.execute_one(agent_query, (chat_request.agent_id,))
+    数据直接来自数据库、类型已知，列表端点跳过Pydantic校验，
+    并直接返回ORJSONResponse以绕过jsonable_encoder。
+    """
+    return [
+        {
+            "id": row["id"],
+            "agent_id": row["agent_id"],
+            "role": row["role"],
+            "content": row["content"],
+            "metadata": loads(row["metadata"]) if row["metadata"] else {},
+            "timestamp": row["timestamp"]
+        }
+        for row in rows
+    ]
+
+
+async def _get_active_agent_row(agent_id: str):
+    """获取可对话的Agent记录（不存在返回404，未激活返回400）"""
+    agent_query = "SELECT topic, context_data, status FROM agents WHERE id = ?"
+    agent_row = await db_manager.execute_one(agent_query, (agent_id,))
     
     if not agent_row:
         raise HTTPException(status_code=404, detail="Agent不存在")
     
-    if agent_row[7] != "active":  # status字段
+    if agent_row["status"] != "active":
         raise HTTPException(status_code=400, detail="Agent未激活")
     
+    return agent_row
+
+
+def _build_context_messages(agent_context: dict) -> List[dict]:
+    """根据Agent上下文构建发送给AI的对话消息"""
+    context_messages = []
+    
+    # 添加继承的上下文
+    inherited_context = agent_context.get('inherited_context', {})
+    if inherited_context.get('inherited_messages'):
+        for msg in inherited_context['inherited_messages']:
+            context_messages.append({
+                "role": msg.get('role', 'user'),
+                "content": msg.get('content', '')
+            })
+    elif inherited_context.get('context_summary'):
+        # 如果是摘要继承，添加系统消息
+        context_messages.append({
+            "role": "system",
+            "content": f"上下文摘要：{inherited_context['context_summary']}"
+        })
+    
+    # 添加当前Agent的消息历史
+    current_messages = agent_context.get('current_context', {}).get('messages', [])
+    for msg in current_messages[-10:]:  # 最近10条消息
+        context_messages.append({
+            "role": msg.get('role', 'user'),
+            "content": msg.get('content', '')
+        })
+    
+    return context_messages
+
+
+@lru_cache(maxsize=1024)
+def _agent_prompt(topic: str, context_data: Optional[str]) -> tuple:
+    """
+    解析Agent配置并构建系统提示词
+    
+    以原始context_data字符串为缓存键，配置变更后键随之变化，无需手动失效。
+    返回的配置为只读结构，可在多个请求间安全共享。
+    """
+    agent_config = loads_frozen(context_data or EMPTY_JSON)
+    system_prompt = agent_config.get(
+        "system_prompt", 
+        f"你是一个专门探讨'{topic}'的智能学习助手。请专注于深入探讨这个话题，帮助用户获得更深入的理解。"
+    )
+    return agent_config, system_prompt
+
+
+def _agent_system_prompt(agent_row) -> tuple:
+    """获取Agent配置和系统提示词"""
+    return _agent_prompt(agent_row["topic"], agent_row["context_data"])
+
+
+async def _add_user_message(agent_id: str, content: str, context_mode: Optional[str]):
+    """
+    添加用户消息，同时获取Agent的完整上下文（包括继承的上下文）
+    
+    两者共享同一栈帧对象，上下文中的消息列表会包含刚添加的用户消息
+    """
+    return await asyncio.gather(
+        multi_agent_manager.add_message_to_agent(
+            agent_id=agent_id,
+            role="user",
+            content=content,
+            metadata={"context_mode": context_mode}
+        ),
+        multi_agent_manager.get_agent_context(agent_id)
+    )
+
+
+@router.post("/send", response_model=ChatResponse)
+async def send_message(chat_request: ChatRequest):
+    """发送消息并获取AI回复"""
+    
+    # 检查Agent是否存在
+    agent_row = await _get_active_agent_row(chat_request.agent_id)
+    
     start_time = datetime.now()
     
     try:
-        # 1. 使用栈帧式Agent管理器添加用户消息
-        user_message = await multi_agent_manager.add_message_to_agent(
-            agent_id=chat_request.agent_id,
-            role="user",
-            content=chat_request.content,
-            metadata={"context_mode": chat_request.context_mode}
+        # 1. 使用栈帧式Agent管理器添加用户消息，
+        # 2. 同时获取Agent的完整上下文
+        user_message, agent_context = await _add_user_message(
+            chat_request.agent_id, chat_request.content, chat_request.context_mode
         )
         
-        # 2. 获取Agent的完整上下文（包括继承的上下文）
-        agent_context = await multi_agent_manager.get_agent_context(chat_request.agent_id)
-        
         # 3. 构建对话上下文
-        context_messages = []
-        
-        # 添加继承的上下文
-        inherited_context = agent_context.get('inherited_context', {})
-        if inherited_context.get('inherited_messages'):
-            for msg in inherited_context['inherited_messages']:
-                context_messages.append({
-                    "role": msg.get('role', 'user'),
-                    "content": msg.get('content', '')
-                })
-        elif inherited_context.get('context_summary'):
-            # 如果是摘要继承，添加系统消息
-            context_messages.append({
-                "role": "system",
-                "content": f"上下文摘要：{inherited_context['context_summary']}"
-            })
-        
-        # 添加当前Agent的消息历史
-        current_messages = agent_context.get('current_context', {}).get('messages', [])
-        for msg in current_messages[-10:]:  # 最近10条消息
-            context_messages.append({
-                "role": msg.get('role', 'user'),
-                "content": msg.get('content', '')
-            })
+        context_messages = _build_context_messages(agent_context)
         
         # 4. 获取Agent配置和系统提示词
-        agent_config = json.loads(agent_row[5]) if agent_row[5] else {}
-        system_prompt = agent_config.get(
-            "system_prompt", 
-            f"你是一个专门探讨'{agent_row[4]}'的智能学习助手。请专注于深入探讨这个话题，帮助用户获得更深入的理解。"
-        )
+        agent_config, system_prompt = _agent_system_prompt(agent_row)
         
         # 5. 调用AI API
         ai_response = await ai_service.generate_response(
@@ -133,58 +251,101 @@ async def send_message(chat_request: ChatRequest):
         raise HTTPException(status_code=500, detail=f"发送消息失败: {str(e)}")
 
 
+@router.post("/stream")
+async def stream_message(stream_request: ChatStreamRequest):
+    """
+    发送消息并以SSE流式返回AI回复
+    
+    每个事件为一个ChatStreamChunk：中间块携带文本增量，
+    结束块的finished为True，id为持久化后的助手消息ID。
+    """
+    if not stream_request.stream:
+        # 未启用流式时退回普通接口
+        return await send_message(ChatRequest(
+            agent_id=stream_request.agent_id,
+            content=stream_request.content
+        ))
+    
+    agent_id = stream_request.agent_id
+    agent_row = await _get_active_agent_row(agent_id)
+    
+    try:
+        user_message, agent_context = await _add_user_message(
+            agent_id, stream_request.content, "auto"
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"发送消息失败: {str(e)}")
+    
+    context_messages = _build_context_messages(agent_context)
+    agent_config, system_prompt = _agent_system_prompt(agent_row)
+    stream_id = new_id()
+    
+    def sse_event(chunk: ChatStreamChunk) -> bytes:
+        # 直接序列化为UTF-8字节，StreamingResponse原样发送，不再经过str再编码一次
+        return b"data: " + _STREAM_CHUNK_ADAPTER.dump_json(chunk) + b"\n\n"
+    
+    async def event_stream():
+        parts = []
+        try:
+            async for delta in ai_service.stream_response(
+                messages=context_messages,
+                system_prompt=system_prompt,
+                agent_context=agent_config
+            ):
+                parts.append(delta)
+                yield sse_event(ChatStreamChunk(id=stream_id, agent_id=agent_id, content=delta))
+            
+            # 流结束后再持久化完整的AI回复
+            assistant_message = await multi_agent_manager.add_message_to_agent(
+                agent_id=agent_id,
+                role="assistant",
+                content="".join(parts),
+                metadata={
+                    "model": ai_service.model,
+                    "branchable": True,
+                    "context_used": len(context_messages),
+                    "streamed": True
+                }
+            )
+            yield sse_event(ChatStreamChunk(
+                id=assistant_message["id"], agent_id=agent_id, content="", finished=True
+            ))
+        except Exception as e:
+            yield sse_event(ChatStreamChunk(
+                id=stream_id, agent_id=agent_id, content=f"发送消息失败: {str(e)}", finished=True
+            ))
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @router.get("/conversation/{agent_id}", response_model=ConversationResponse)
 async def get_conversation(agent_id: str, limit: Optional[int] = 50):
     """获取Agent的对话历史"""
+    cache_key = f"conversation:{agent_id}:{limit}"
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return await json_response(cached, len(cached["messages"]))
     
     # 检查Agent是否存在
-    agent_query = "SELECT * FROM agents WHERE id = ?"
-    agent_row = await db_manager.execute_one(agent_query, (agent_id,))
-    
-    if not agent_row:
-        raise HTTPException(status_code=404, detail="Agent不存在")
+    await assert_agent_exists(agent_id)
     
     try:
-        # 获取消息列表
-        messages_query = """
-            SELECT * FROM messages 
-            WHERE agent_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        """
-        
-        rows = await db_manager.execute_query(messages_query, (agent_id, limit))
-        messages = []
+        # 获取消息列表，每行同时携带对话统计信息
+        rows = await db_manager.execute_query(CONVERSATION_QUERY, (agent_id, limit))
+        messages = _rows_to_messages(reversed(rows))  # 反转以获得正确的时间顺序
         
-        for row in reversed(rows):  # 反转以获得正确的时间顺序
-            messages.append(MessageResponse(
-                id=row[0],
-                agent_id=row[1],
-                role=row[2],
-                content=row[3],
-                metadata=json.loads(row[4]) if row[4] else {},
-                timestamp=row[5]
-            ))
+        # 没有消息时统计信息为空
+        stats_row = rows[0] if rows else None
         
-        # 获取对话统计信息
-        stats_query = """
-            SELECT 
-                COUNT(*) as total_messages,
-                MIN(timestamp) as started_at,
-                MAX(timestamp) as last_activity
-            FROM messages 
-            WHERE agent_id = ?
-        """
-        
-        stats_row = await db_manager.execute_one(stats_query, (agent_id,))
-        
-        return ConversationResponse(
-            agent_id=agent_id,
-            messages=messages,
-            total_messages=stats_row[0] if stats_row else 0,
-            started_at=stats_row[1] if stats_row else None,
-            last_activity=stats_row[2] if stats_row else None
-        )
+        conversation = {
+            "agent_id": agent_id,
+            "messages": messages,
+            "total_messages": stats_row["total_messages"] if stats_row else 0,
+            "started_at": stats_row["started_at"] if stats_row else None,
+            "last_activity": stats_row["last_activity"] if stats_row else None
+        }
+        response_cache.set(cache_key, conversation)
+        return await json_response(conversation, len(messages))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取对话历史失败: {str(e)}")
@@ -193,22 +354,13 @@ async def get_conversation(agent_id: str, limit: Optional[int] = 50):
 @router.get("/message/{message_id}", response_model=MessageResponse)
 async def get_message(message_id: str):
     """获取特定消息"""
-    query = "SELECT * FROM messages WHERE id = ?"
-    
     try:
-        row = await db_manager.execute_one(query, (message_id,))
+        row = await db_manager.execute_one(MESSAGE_BY_ID_QUERY, (message_id,))
         
         if not row:
             raise HTTPException(status_code=404, detail="消息不存在")
         
-        return MessageResponse(
-            id=row[0],
-            agent_id=row[1],
-            role=row[2],
-            content=row[3],
-            metadata=json.loads(row[4]) if row[4] else {},
-            timestamp=row[5]
-        )
+        return _row_to_message(row)
         
     except HTTPException:
         raise
@@ -220,13 +372,17 @@ async def get_message(message_id: str):
 async def delete_message(message_id: str):
     """删除消息"""
     # 检查消息是否存在
-    await get_message(message_id)
+    message = await get_message(message_id)
     
     try:
-        await db_manager.execute_update(
-            "DELETE FROM messages WHERE id = ?",
-            (message_id,)
-        )
+        # 删除前把以full模式引用该Agent消息的分支固定为消息副本
+        async with db_manager.transaction() as conn:
+            pinned_ids = await multi_agent_manager.pin_inherited_messages(message.agent_id, conn)
+            await conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+        response_cache.invalidate_prefix(f"conversation:{message.agent_id}:")
+        response_cache.invalidate(f"context:{message.agent_id}")
+        for pinned_id in pinned_ids:
+            response_cache.invalidate(f"context:{pinned_id}")
         
         return {"message": "消息删除成功"}
         
@@ -256,7 +412,7 @@ async def list_messages(
     where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
     
     query = f"""
-        SELECT * FROM messages{where_clause} 
+        SELECT {MESSAGE_COLUMNS} FROM messages{where_clause} 
         ORDER BY timestamp DESC 
         LIMIT ? OFFSET ?
     """
@@ -265,19 +421,9 @@ async def list_messages(
     
     try:
         rows = await db_manager.execute_query(query, tuple(params))
-        messages = []
+        messages = _rows_to_messages(rows)
         
-        for row in rows:
-            messages.append(MessageResponse(
-                id=row[0],
-                agent_id=row[1],
-                role=row[2],
-                content=row[3],
-                metadata=json.loads(row[4]) if row[4] else {},
-                timestamp=row[5]
-            ))
-        
-        return {"messages": messages}
+        return await json_response({"messages": messages}, len(messages))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取消息列表失败: {str(e)}")
@@ -287,18 +433,18 @@ async def list_messages(
 async def clear_conversation(agent_id: str):
     """清空Agent的对话历史"""
     # 检查Agent是否存在
-    agent_query = "SELECT * FROM agents WHERE id = ?"
-    agent_row = await db_manager.execute_one(agent_query, (agent_id,))
-    
-    if not agent_row:
-        raise HTTPException(status_code=404, detail="Agent不存在")
+    await assert_agent_exists(agent_id)
     
     try:
-        # 删除所有消息
-        deleted_count = await db_manager.execute_update(
-            "DELETE FROM messages WHERE agent_id = ?",
-            (agent_id,)
-        )
+        # 删除所有消息，删除前把以full模式引用这些消息的分支固定为消息副本
+        async with db_manager.transaction() as conn:
+            pinned_ids = await multi_agent_manager.pin_inherited_messages(agent_id, conn)
+            cursor = await conn.execute("DELETE FROM messages WHERE agent_id = ?", (agent_id,))
+            deleted_count = cursor.rowcount
+        response_cache.invalidate_prefix(f"conversation:{agent_id}:")
+        response_cache.invalidate(f"context:{agent_id}")
+        for pinned_id in pinned_ids:
+            response_cache.invalidate(f"context:{pinned_id}")
         
         return {
             "message": "对话历史清空成功",
@@ -315,38 +461,19 @@ async def get_conversation_context(agent_id: str, context_mode: str = "auto", ma
     if context_mode == "none":
         return []
     
-    # 获取最近的消息
-    query = """
-        SELECT role, content FROM messages 
-        WHERE agent_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    """
-    
-    rows = await db_manager.execute_query(query, (agent_id, max_messages))
-    
-    # 构建消息列表（反转以获得正确的时间顺序）
-    messages = []
-    for row in reversed(rows):
-        messages.append({
-            "role": row[0],
-            "content": row[1]
-        })
-    
-    # 根据上下文模式处理
+    # 在数据库端完成截取，只把需要的消息传回Python
     if context_mode == "selective":
-        # 选择性上下文：保留最重要的消息
-        return messages[-6:]  # 保留最近的6条消息
+        # 选择性上下文：保留最近的6条消息
+        rows = await db_manager.execute_query(RECENT_CONTEXT_QUERY, (agent_id, min(6, max_messages)))
     elif context_mode == "full":
         # 完整上下文：返回所有消息
-        return messages
+        rows = await db_manager.execute_query(RECENT_CONTEXT_QUERY, (agent_id, max_messages))
     else:  # auto
-        # 自动模式：根据消息数量智能选择
-        if len(messages) <= 8:
-            return messages
-        else:
-            # 保留开头2条和最后6条
-            return messages[:2] + messages[-6:]
+        # 自动模式：不超过8条时全部保留，否则保留开头2条和最后6条
+        rows = await db_manager.execute_query(AUTO_CONTEXT_QUERY, (agent_id, max_messages))
+    
+    # 查询结果已按时间正序排列
+    return [dict(row) for row in rows]
 
 
 @router.get("/context/{agent_id}")
@@ -382,7 +509,7 @@ async def get_conversation_stats(agent_id: str):
         
         row = await db_manager.execute_one(stats_query, (agent_id,))
         
-        if not row or row[0] == 0:
+        if not row or row["total_messages"] == 0:
             return {
                 "agent_id": agent_id,
                 "total_messages": 0,
@@ -393,15 +520,9 @@ async def get_conversation_stats(agent_id: str):
                 "last_message": None
             }
         
-        return {
-            "agent_id": agent_id,
-            "total_messages": row[0],
-            "user_messages": row[1],
-            "assistant_messages": row[2],
-            "avg_message_length": round(row[3], 2) if row[3] else 0,
-            "first_message": row[4],
-            "last_message": row[5]
-        }
+        stats = dict(row)
+        stats["avg_message_length"] = round(stats["avg_message_length"], 2) if stats["avg_message_length"] else 0
+        return {"agent_id": agent_id, **stats}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取对话统计失败: {str(e)}")
\ No newline at end of file
@@ -1,13 +1,25 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import ORJSONResponse
 from typing import List, Optional
 from pydantic import BaseModel
-import uuid
-from datetime import datetime
 
-from app.core.database import get_db, db_manager
+from app.core.database import get_db, db_manager, SESSION_COLUMNS, AGENT_COLUMNS, SESSION_TREE_QUERY, SQL_NOW, rows_to_tree
+from app.core.cache import response_cache
+from app.core.responses import json_response, weak_etag, not_modified
+from app.core.ids import new_id
 
+# 端点直接返回ORJSONResponse，跳过jsonable_encoder的逐字段递归；
+# response_model仅用于生成API文档
 router = APIRouter()
 
+# 固定的SQL文本：模块加载时构建一次，可命中连接的已编译语句缓存
+# 时间戳由数据库生成，并通过RETURNING在同一次往返中取回
+INSERT_SESSION_QUERY = f"""
+    INSERT INTO sessions (id, title, description, status, created_at, updated_at)
+    VALUES (?, ?, ?, 'active', {SQL_NOW}, {SQL_NOW})
+    RETURNING {SESSION_COLUMNS}
+"""
+
 
 # Pydantic模型
 class SessionCreate(BaseModel):
@@ -30,31 +42,25 @@ class SessionUpdate(BaseModel):
     status: Optional[str] = None
 
 
+async def _assert_session_exists(session_id: str):
+    """仅检查会话是否存在，不存在时返回404"""
+    row = await db_manager.execute_one("SELECT 1 FROM sessions WHERE id = ? LIMIT 1", (session_id,))
+    if not row:
+        raise HTTPException(status_code=404, detail="会话不存在")
+
+
 @router.post("/", response_model=SessionResponse)
 async def create_session(session_data: SessionCreate):
     """创建新的学习会话"""
-    session_id = str(uuid.uuid4())
-    current_time = datetime.now().isoformat()
-    
-    query = """
-        INSERT INTO sessions (id, title, description, status, created_at, updated_at)
-        VALUES (?, ?, ?, 'active', ?, ?)
-    """
+    session_id = new_id()
     
     try:
-        await db_manager.execute_insert(
-            query, 
-            (session_id, session_data.title, session_data.description, current_time, current_time)
+        row = await db_manager.execute_returning(
+            INSERT_SESSION_QUERY, 
+            (session_id, session_data.title, session_data.description)
         )
         
-        return SessionResponse(
-            id=session_id,
-            title=session_data.title,
-            description=session_data.description,
-            status="active",
-            created_at=current_time,
-            updated_at=current_time
-        )
+        return ORJSONResponse(dict(row))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"创建会话失败: {str(e)}")
 
@@ -62,58 +68,47 @@ async def create_session(session_data: SessionCreate):
 @router.get("/", response_model=List[SessionResponse])
 async def get_sessions():
     """获取所有学习会话"""
-    query = "SELECT * FROM sessions ORDER BY created_at DESC"
+    query = f"SELECT {SESSION_COLUMNS} FROM sessions ORDER BY created_at DESC"
     
     try:
         rows = await db_manager.execute_query(query)
-        sessions = []
-        
-        for row in rows:
-            sessions.append(SessionResponse(
-                id=row[0],
-                title=row[1],
-                description=row[2],
-                status=row[3],
-                created_at=row[4],
-                updated_at=row[5]
-            ))
-        
-        return sessions
+        return await json_response([dict(row) for row in rows], len(rows))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取会话列表失败: {str(e)}")
 
 
-@router.get("/{session_id}", response_model=SessionResponse)
-async def get_session(session_id: str):
-    """获取特定学习会话"""
-    query = "SELECT * FROM sessions WHERE id = ?"
+async def _fetch_session(session_id: str):
+    """获取会话行，不存在时返回404"""
+    query = f"SELECT {SESSION_COLUMNS} FROM sessions WHERE id = ?"
     
     try:
         row = await db_manager.execute_one(query, (session_id,))
-        
-        if not row:
-            raise HTTPException(status_code=404, detail="会话不存在")
-        
-        return SessionResponse(
-            id=row[0],
-            title=row[1],
-            description=row[2],
-            status=row[3],
-            created_at=row[4],
-            updated_at=row[5]
-        )
-    except HTTPException:
-        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取会话失败: {str(e)}")
+    
+    if not row:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    
+    return row
+
+
+@router.get("/{session_id}", response_model=SessionResponse)
+async def get_session(session_id: str, request: Request):
+    """获取特定学习会话（支持If-None-Match条件请求）"""
+    row = await _fetch_session(session_id)
+    
+    # 所有修改都会经由RETURNING刷新updated_at，行内容不变即ETag不变
+    etag = weak_etag(*row)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    return ORJSONResponse(dict(row), headers={"ETag": etag})
 
 
 @router.put("/{session_id}", response_model=SessionResponse)
 async def update_session(session_id: str, session_update: SessionUpdate):
     """更新学习会话"""
-    # 首先检查会话是否存在
-    existing_session = await get_session(session_id)
-    
     # 构建更新字段
     update_fields = []
     params = []
@@ -131,124 +126,78 @@ async def update_session(session_id: str, session_update: SessionUpdate):
         params.append(session_update.status)
     
     if not update_fields:
-        return existing_session
+        return ORJSONResponse(dict(await _fetch_session(session_id)))
     
-    # 添加更新时间
-    update_fields.append("updated_at = ?")
-    params.append(datetime.now().isoformat())
+    # 添加更新时间（由数据库生成）
+    update_fields.append(f"updated_at = {SQL_NOW}")
     params.append(session_id)
     
-    query = f"UPDATE sessions SET {', '.join(update_fields)} WHERE id = ?"
+    # 通过RETURNING同时完成存在性检查并取回更新后的会话
+    query = f"UPDATE sessions SET {', '.join(update_fields)} WHERE id = ? RETURNING {SESSION_COLUMNS}"
     
     try:
-        await db_manager.execute_update(query, tuple(params))
-        
-        # 返回更新后的会话
-        return await get_session(session_id)
+        row = await db_manager.execute_returning(query, tuple(params))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新会话失败: {str(e)}")
+    
+    if not row:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    
+    return ORJSONResponse(dict(row))
 
 
 @router.delete("/{session_id}")
 async def delete_session(session_id: str):
     """删除学习会话"""
-    # 首先检查会话是否存在
-    await get_session(session_id)
-    
     try:
-        # 删除相关的消息
-        await db_manager.execute_update(
-            "DELETE FROM messages WHERE agent_id IN (SELECT id FROM agents WHERE session_id = ?)",
-            (session_id,)
-        )
-        
-        # 删除相关的栈帧
-        await db_manager.execute_update(
-            "DELETE FROM agent_stack_frames WHERE agent_id IN (SELECT id FROM agents WHERE session_id = ?)",
-            (session_id,)
-        )
-        
-        # 删除相关的Agent
-        await db_manager.execute_update(
-            "DELETE FROM agents WHERE session_id = ?",
-            (session_id,)
-        )
-        
-        # 删除会话
-        await db_manager.execute_update(
+        # 相关的Agent、消息和栈帧由外键ON DELETE CASCADE在同一语句中删除；
+        # 影响行数为0即表示会话不存在
+        deleted = await db_manager.execute_update(
             "DELETE FROM sessions WHERE id = ?",
             (session_id,)
         )
-        
-        return {"message": "会话删除成功"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除会话失败: {str(e)}")
+    
+    if not deleted:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    
+    response_cache.clear()
+    return ORJSONResponse({"message": "会话删除成功"})
 
 
 @router.get("/{session_id}/agents")
 async def get_session_agents(session_id: str):
     """获取会话中的所有Agent"""
     # 首先检查会话是否存在
-    await get_session(session_id)
+    await _assert_session_exists(session_id)
     
-    query = "SELECT * FROM agents WHERE session_id = ? ORDER BY created_at"
+    query = f"SELECT {AGENT_COLUMNS} FROM agents WHERE session_id = ? ORDER BY created_at"
     
     try:
         rows = await db_manager.execute_query(query, (session_id,))
-        agents = []
-        
-        for row in rows:
-            agents.append({
-                "id": row[0],
-                "session_id": row[1],
-                "parent_id": row[2],
-                "agent_type": row[3],
-                "topic": row[4],
-                "context_data": row[5],
-                "stack_depth": row[6],
-                "status": row[7],
-                "created_at": row[8]
-            })
-        
-        return {"agents": agents}
+        return await json_response({"agents": [dict(row) for row in rows]}, len(rows))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取会话Agent失败: {str(e)}")
 
 
 @router.get("/{session_id}/hierarchy")
-async def get_session_hierarchy(session_id: str):
-    """获取会话的Agent层级结构"""
+async def get_session_hierarchy(session_id: str, request: Request):
+    """获取会话的Agent层级结构（支持If-None-Match条件请求）"""
     # 首先检查会话是否存在
-    await get_session(session_id)
-    
-    query = "SELECT * FROM agents WHERE session_id = ? ORDER BY stack_depth, created_at"
+    await _assert_session_exists(session_id)
     
     try:
-        rows = await db_manager.execute_query(query, (session_id,))
-        
-        # 构建层级结构
-        agents_dict = {}
-        root_agents = []
-        
-        for row in rows:
-            agent = {
-                "id": row[0],
-                "parent_id": row[2],
-                "agent_type": row[3],
-                "topic": row[4],
-                "level": row[6],
-                "children": []
-            }
-            agents_dict[agent["id"]] = agent
-            
-            if not agent["parent_id"]:
-                root_agents.append(agent)
+        # 递归查询保证父节点先于子节点返回，单次遍历即可建立层级结构
+        rows = await db_manager.execute_query(SESSION_TREE_QUERY, (session_id,))
         
-        # 建立父子关系
-        for agent in agents_dict.values():
-            if agent["parent_id"] and agent["parent_id"] in agents_dict:
-                agents_dict[agent["parent_id"]]["children"].append(agent)
+        # Agent表没有更新时间列，ETag直接由层级行内容计算；
+        # 未变化时跳过层级构建和序列化
+        etag = weak_etag(*map(tuple, rows))
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
         
-        return {"hierarchy": root_agents}
+        return await json_response({"hierarchy": rows_to_tree(rows)}, len(rows), etag=etag)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取会话层级结构失败: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,113 @@
+import math
+import operator
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from app.core.config import settings
+
+
+class ResponseCache:
+    """
+    进程内TTL响应缓存
+
+    用于读多写少的GET端点，命中时跳过数据库查询和JSON解码。
+    写操作需按键或键前缀主动失效。
+    """
+
+    def __init__(self, ttl_seconds: float = 60, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+
+    def get(self, key: str) -> Optional[Any]:
+        """获取缓存值，不存在或已过期时返回None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+
+        return value
+
+    def set(self, key: str, value: Any):
+        """写入缓存值"""
+        if len(self._entries) >= self.max_entries and key not in self._entries:
+            # 淘汰最早写入的条目
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+
+    def invalidate(self, key: str):
+        """使指定键失效"""
+        self._entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix: str):
+        """使所有以指定前缀开头的键失效"""
+        for key in [k for k in self._entries if k.startswith(prefix)]:
+            del self._entries[key]
+
+    def clear(self):
+        """清空缓存"""
+        self._entries.clear()
+
+
+class SemanticCache:
+    """
+    进程内语义缓存
+
+    以请求文本的向量（embedding）为键，查找时对已有条目逐一计算余弦相似度，
+    最高分不低于阈值即视为命中。条目按LRU淘汰。
+    scope用于隔离不能互相替代的请求（如不同模型），只在相同scope内比较。
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 256):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, Tuple[Hashable, List[float], Any]]" = OrderedDict()
+        self._next_id = 0
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> List[float]:
+        """归一化为单位向量，之后点积即余弦相似度"""
+        norm = math.sqrt(sum(x * x for x in vector))
+        if norm == 0:
+            return list(vector)
+        return [x / norm for x in vector]
+
+    def get(self, vector: List[float], scope: Hashable = None) -> Optional[Any]:
+        """查找与给定向量最相似的缓存值，未达到阈值时返回None"""
+        if not self._entries:
+            return None
+
+        query = self._normalize(vector)
+        best_id, best_score = None, self.threshold
+        for entry_id, (entry_scope, entry_vector, _) in self._entries.items():
+            if entry_scope != scope:
+                continue
+            score = sum(map(operator.mul, query, entry_vector))
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+
+        if best_id is None:
+            return None
+
+        self._entries.move_to_end(best_id)
+        return self._entries[best_id][2]
+
+    def set(self, vector: List[float], value: Any, scope: Hashable = None):
+        """写入缓存值"""
+        self._entries[self._next_id] = (scope, self._normalize(vector), value)
+        self._next_id += 1
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存"""
+        self._entries.clear()
+
+
+# 全局响应缓存实例
+response_cache = ResponseCache(ttl_seconds=settings.RESPONSE_CACHE_TTL)
@@ -0,0 +1,15 @@
+import time
+from datetime import datetime
+
+# 秒级时间戳字符串缓存：同一秒内的响应复用同一个字符串
+_ts_cache = {"t": 0, "s": ""}
+
+
+def now_iso() -> str:
+    """返回当前时间的ISO格式字符串（精确到秒）"""
+    it = int(time.time())
+    cache = _ts_cache
+    if cache["t"] != it:
+        cache["t"] = it
+        cache["s"] = datetime.fromtimestamp(it).isoformat()
+    return cache["s"]
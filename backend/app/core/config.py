@@ -1,5 +1,7 @@
 import os
 from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType
 from typing import List, Optional
 from pydantic import validator
 from pydantic_settings import BaseSettings
@@ -13,6 +15,7 @@ class Settings(BaseSettings):
     VERSION: str = "1.0.0"
     DEBUG: bool = True
     LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "text"  # text 或 json（每行一条结构化JSON日志）
     
     # 服务器配置
     SERVER_HOST: str = "0.0.0.0"
@@ -22,6 +25,10 @@ class Settings(BaseSettings):
     
     # 数据库配置
     DATABASE_URL: str = "sqlite:///./multi_agent_learning.db"
+    DATABASE_READ_POOL_SIZE: int = 8  # WAL模式下的只读连接数
+    DATABASE_POOL_TIMEOUT: float = 30.0  # 等待空闲读连接的超时时间（秒）
+    DATABASE_CACHE_SIZE_KB: int = 65536  # 每个连接的页缓存大小（KiB）
+    DATABASE_MMAP_SIZE: int = 268435456  # 内存映射读取的上限（字节），0表示关闭
     
     # Deepseek配置
     DEEPSEEK_API_KEY: Optional[str] = None
@@ -29,12 +36,14 @@ class Settings(BaseSettings):
     DEEPSEEK_MODEL: str = "deepseek-chat"
     DEEPSEEK_MAX_TOKENS: int = 2000
     DEEPSEEK_TEMPERATURE: float = 0.7
+    DEEPSEEK_MAX_CONCURRENCY: int = 8  # 同时在途的API请求上限
     
     # 保持OpenAI配置以便向后兼容
     OPENAI_API_KEY: Optional[str] = None
     OPENAI_MODEL: str = "gpt-3.5-turbo"
     OPENAI_MAX_TOKENS: int = 2000
     OPENAI_TEMPERATURE: float = 0.7
+    OPENAI_MAX_CONCURRENCY: int = 8  # generate_many同时在途的请求上限
     
     # CORS配置
     ALLOWED_ORIGINS: List[str] = [
@@ -49,6 +58,10 @@ class Settings(BaseSettings):
     MAX_CONTEXT_MESSAGES: int = 10
     CONTEXT_SUMMARY_LENGTH: int = 500
     
+    # 缓存配置
+    RESPONSE_CACHE_TTL: int = 60  # GET端点响应缓存时间（秒）
+    LARGE_RESPONSE_THRESHOLD: int = 500  # 条目数超过该值的响应在线程池中序列化
+    
     # 安全配置
     SECRET_KEY: str = "your-secret-key-change-in-production"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
@@ -84,35 +97,47 @@ class Settings(BaseSettings):
         case_sensitive = True
 
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """获取全局设置实例，环境变量读取和校验器每个进程只执行一次"""
+    return Settings()
+
+
 # 创建全局设置实例
-settings = Settings()
+settings = get_settings()
+
+# CORS来源在启动时冻结为元组，中间件配置直接使用
+ALLOWED_ORIGINS = tuple(settings.ALLOWED_ORIGINS)
 
+# 以下派生配置为只读视图，防止运行时被意外修改
 # 数据库配置
-DATABASE_CONFIG = {
+DATABASE_CONFIG = MappingProxyType({
     "url": settings.DATABASE_URL,
     "echo": settings.DEBUG,  # 在调试模式下显示SQL语句
-}
+})
 
 # Deepseek配置
-DEEPSEEK_CONFIG = {
+DEEPSEEK_CONFIG = MappingProxyType({
     "api_key": settings.DEEPSEEK_API_KEY,
     "base_url": settings.DEEPSEEK_BASE_URL,
     "model": settings.DEEPSEEK_MODEL,
     "max_tokens": settings.DEEPSEEK_MAX_TOKENS,
     "temperature": settings.DEEPSEEK_TEMPERATURE,
-}
+    "max_concurrency": settings.DEEPSEEK_MAX_CONCURRENCY,
+})
 
 # OpenAI配置（向后兼容）
-OPENAI_CONFIG = {
+OPENAI_CONFIG = MappingProxyType({
     "api_key": settings.OPENAI_API_KEY,
     "model": settings.OPENAI_MODEL,
     "max_tokens": settings.OPENAI_MAX_TOKENS,
     "temperature": settings.OPENAI_TEMPERATURE,
-}
+    "max_concurrency": settings.OPENAI_MAX_CONCURRENCY,
+})
 
 # Agent系统配置
-AGENT_CONFIG = {
+AGENT_CONFIG = MappingProxyType({
     "max_branch_depth": settings.MAX_BRANCH_DEPTH,
     "max_context_messages": settings.MAX_CONTEXT_MESSAGES,
     "context_summary_length": settings.CONTEXT_SUMMARY_LENGTH,
-}
\ No newline at end of file
+})
\ No newline at end of file
@@ -1,77 +1,217 @@
 import aiosqlite
 import asyncio
-from typing import Optional
+import logging
+import random
+import sqlite3
+from contextlib import asynccontextmanager
+from typing import List, Optional
 from app.core.config import settings
 
+logger = logging.getLogger(__name__)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """仅锁竞争导致的失败值得重试，语法错误、约束冲突等直接抛出"""
+    return isinstance(error, sqlite3.OperationalError) and "locked" in str(error)
+
+
+def _retry_delay(attempt: int) -> float:
+    """带随机抖动的指数退避，避免并发重试同时醒来再次冲突"""
+    return min(0.5, 0.05 * 2 ** attempt) * (0.5 + random.random())
+
+
+# 每个连接打开时应用的设置
+CONNECTION_PRAGMAS = f"""
+    -- 页大小须在切换WAL和建表之前设置，对已有数据的数据库无效
+    PRAGMA page_size = 4096;
+    -- 启用外键约束和优化设置
+    PRAGMA foreign_keys = ON;
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    -- 负值表示按KiB计的页缓存
+    PRAGMA cache_size = -{settings.DATABASE_CACHE_SIZE_KB};
+    -- 内存映射读取，绕过页缓存拷贝
+    PRAGMA mmap_size = {settings.DATABASE_MMAP_SIZE};
+    PRAGMA temp_store = memory;
+"""
+
 
 class DatabaseManager:
-    """数据库管理器 - 改进版本，增强稳定性"""
+    """数据库管理器 - 改进版本，增强稳定性
+
+    WAL模式下使用一个写连接和一组只读连接：
+    查询走读连接池并发执行，插入/更新/删除统一走写连接。
+    """
     
-    def __init__(self):
+    def __init__(
+        self,
+        read_pool_size: int = settings.DATABASE_READ_POOL_SIZE,
+        acquire_timeout: float = settings.DATABASE_POOL_TIMEOUT
+    ):
         self.db_path = settings.DATABASE_URL.replace("sqlite:///", "")
+        self.read_pool_size = read_pool_size
+        self.acquire_timeout = acquire_timeout
         self._connection: Optional[aiosqlite.Connection] = None
         self._connection_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()  # 写连接上的语句与事务串行执行
+        self._read_connections: List[aiosqlite.Connection] = []
+        self._read_pool: Optional[asyncio.Queue] = None
+    
+    async def _open_connection(self) -> aiosqlite.Connection:
+        """打开一个新连接并应用优化设置"""
+        conn = await aiosqlite.connect(
+            self.db_path,
+            timeout=30.0,  # 设置连接超时
+            isolation_level=None,  # 自动提交模式：单条写语句执行即提交，无需再调用commit()
+            cached_statements=256  # 按SQL文本缓存已编译语句，热点查询免重复解析
+        )
+        # 行对象支持按列名访问，可直接转换为dict
+        conn.row_factory = aiosqlite.Row
+        # 全部连接设置在一次executescript中完成，只需一次线程往返
+        await conn.executescript(CONNECTION_PRAGMAS)
+        return conn
     
     async def get_connection(self) -> aiosqlite.Connection:
-        """获取数据库连接 - 线程安全版本"""
+        """获取写连接 - 线程安全版本"""
+        # 快速路径：连接已就绪时无需争用初始化锁
+        conn = self._connection
+        if conn is not None and conn._connection is not None:
+            return conn
+        
         async with self._connection_lock:
             if self._connection is None or self._connection._connection is None:
                 try:
-                    self._connection = await aiosqlite.connect(
-                        self.db_path,
-                        timeout=30.0,  # 设置连接超时
-                        isolation_level=None  # 自动提交模式
-                    )
-                    # 启用外键约束和优化设置
-                    await self._connection.execute("PRAGMA foreign_keys = ON")
-                    await self._connection.execute("PRAGMA journal_mode = WAL")
-                    await self._connection.execute("PRAGMA synchronous = NORMAL")
-                    await self._connection.execute("PRAGMA cache_size = 1000")
-                    await self._connection.execute("PRAGMA temp_store = memory")
-                    await self._connection.commit()
+                    self._connection = await self._open_connection()
                 except Exception as e:
                     print(f"❌ 数据库连接失败: {e}")
                     raise
             return self._connection
     
+    async def _get_read_pool(self) -> asyncio.Queue:
+        """获取只读连接池，首次使用时创建"""
+        # 快速路径：连接池已创建时无需争用初始化锁
+        if self._read_pool is not None:
+            return self._read_pool
+        
+        async with self._connection_lock:
+            if self._read_pool is None:
+                pool = asyncio.Queue()
+                try:
+                    for _ in range(self.read_pool_size):
+                        conn = await self._open_connection()
+                        self._read_connections.append(conn)
+                        pool.put_nowait(conn)
+                except Exception as e:
+                    print(f"❌ 数据库连接失败: {e}")
+                    for conn in self._read_connections:
+                        await conn.close()
+                    self._read_connections = []
+                    raise
+                self._read_pool = pool
+            return self._read_pool
+    
+    @asynccontextmanager
+    async def read_connection(self):
+        """从只读连接池借出一个连接，用完归还"""
+        pool = await self._get_read_pool()
+        try:
+            conn = await asyncio.wait_for(pool.get(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"等待数据库读连接超时（{self.acquire_timeout}秒）")
+        try:
+            if conn._connection is None:
+                # 连接已失效，重新打开并替换
+                self._read_connections.remove(conn)
+                conn = await self._open_connection()
+                self._read_connections.append(conn)
+            yield conn
+        finally:
+            pool.put_nowait(conn)
+    
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        在写连接上开启事务（BEGIN IMMEDIATE），块内所有写操作一次提交
+        
+        块内请直接使用返回的连接执行语句，不要调用本管理器的写方法（会等待写锁）。
+        """
+        conn = await self.get_connection()
+        async with self._write_lock:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+            else:
+                await conn.execute("COMMIT")
+    
+    async def execute_transaction(self, statements) -> List[int]:
+        """在一个事务内依次执行多条(sql, params)写语句，返回各语句影响的行数"""
+        rowcounts = []
+        async with self.transaction() as conn:
+            for query, params in statements:
+                cursor = await conn.execute(query, params)
+                rowcounts.append(cursor.rowcount)
+        return rowcounts
+    
     async def close_connection(self):
-        """关闭数据库连接 - 安全版本"""
+        """关闭所有数据库连接 - 安全版本"""
         async with self._connection_lock:
+            connections = self._read_connections
             if self._connection:
+                connections = connections + [self._connection]
+            for conn in connections:
                 try:
-                    await self._connection.close()
+                    await conn.close()
                 except Exception as e:
                     print(f"⚠️ 关闭数据库连接时出错: {e}")
-                finally:
-                    self._connection = None
+            self._connection = None
+            self._read_connections = []
+            self._read_pool = None
     
     async def execute_query(self, query: str, params: tuple = ()):
         """执行查询 - 增强错误处理"""
         max_retries = 3
         for attempt in range(max_retries):
             try:
-                conn = await self.get_connection()
-                async with conn.execute(query, params) as cursor:
-                    return await cursor.fetchall()
+                async with self.read_connection() as conn:
+                    async with conn.execute(query, params) as cursor:
+                        return await cursor.fetchall()
             except Exception as e:
-                print(f"⚠️ 查询执行失败 (尝试 {attempt + 1}/{max_retries}): {e}")
-                if attempt == max_retries - 1:
+                logger.warning("查询执行失败 (尝试 %d/%d): %s", attempt + 1, max_retries, e)
+                if attempt == max_retries - 1 or not _is_retryable(e):
                     raise
-                await asyncio.sleep(0.1 * (attempt + 1))  # 指数退避
+                await asyncio.sleep(_retry_delay(attempt))
     
     async def execute_one(self, query: str, params: tuple = ()):
         """执行查询并返回单条记录 - 增强错误处理"""
         max_retries = 3
+        for attempt in range(max_retries):
+            try:
+                async with self.read_connection() as conn:
+                    async with conn.execute(query, params) as cursor:
+                        return await cursor.fetchone()
+            except Exception as e:
+                logger.warning("单条查询执行失败 (尝试 %d/%d): %s", attempt + 1, max_retries, e)
+                if attempt == max_retries - 1 or not _is_retryable(e):
+                    raise
+                await asyncio.sleep(_retry_delay(attempt))
+    
+    async def execute_returning(self, query: str, params: tuple = ()):
+        """执行带RETURNING子句的写操作并返回单条记录 - 增强错误处理"""
+        max_retries = 3
         for attempt in range(max_retries):
             try:
                 conn = await self.get_connection()
-                async with conn.execute(query, params) as cursor:
-                    return await cursor.fetchone()
+                async with self._write_lock:
+                    async with conn.execute(query, params) as cursor:
+                        return await cursor.fetchone()
             except Exception as e:
-                print(f"⚠️ 单条查询执行失败 (尝试 {attempt + 1}/{max_retries}): {e}")
-                if attempt == max_retries - 1:
+                logger.warning("写操作执行失败 (尝试 %d/%d): %s", attempt + 1, max_retries, e)
+                if attempt == max_retries - 1 or not _is_retryable(e):
                     raise
-                await asyncio.sleep(0.1 * (attempt + 1))
+                await asyncio.sleep(_retry_delay(attempt))
     
     async def execute_insert(self, query: str, params: tuple = ()) -> str:
         """执行插入操作并返回lastrowid - 增强错误处理"""
@@ -79,14 +219,14 @@ class DatabaseManager:
         for attempt in range(max_retries):
             try:
                 conn = await self.get_connection()
-                cursor = await conn.execute(query, params)
-                await conn.commit()
+                async with self._write_lock:
+                    cursor = await conn.execute(query, params)
                 return str(cursor.lastrowid)
             except Exception as e:
-                print(f"⚠️ 插入操作失败 (尝试 {attempt + 1}/{max_retries}): {e}")
-                if attempt == max_retries - 1:
+                logger.warning("插入操作失败 (尝试 %d/%d): %s", attempt + 1, max_retries, e)
+                if attempt == max_retries - 1 or not _is_retryable(e):
                     raise
-                await asyncio.sleep(0.1 * (attempt + 1))
+                await asyncio.sleep(_retry_delay(attempt))
     
     async def execute_update(self, query: str, params: tuple = ()) -> int:
         """执行更新操作并返回影响的行数 - 增强错误处理"""
@@ -94,19 +234,162 @@ class DatabaseManager:
         for attempt in range(max_retries):
             try:
                 conn = await self.get_connection()
-                cursor = await conn.execute(query, params)
-                await conn.commit()
+                async with self._write_lock:
+                    cursor = await conn.execute(query, params)
                 return cursor.rowcount
             except Exception as e:
-                print(f"⚠️ 更新操作失败 (尝试 {attempt + 1}/{max_retries}): {e}")
-                if attempt == max_retries - 1:
+                logger.warning("更新操作失败 (尝试 %d/%d): %s", attempt + 1, max_retries, e)
+                if attempt == max_retries - 1 or not _is_retryable(e):
                     raise
-                await asyncio.sleep(0.1 * (attempt + 1))
-
+                await asyncio.sleep(_retry_delay(attempt))
+    
+    async def execute_many(self, query: str, seq_of_params) -> int:
+        """以同一条预编译语句批量执行写操作，一次提交，返回影响的行数 - 增强错误处理"""
+        seq_of_params = list(seq_of_params)
+        max_retries = 3
+        for attempt in range(max_retries):
+            try:
+                # 自动提交模式下逐条提交，显式事务保证只提交一次
+                async with self.transaction() as conn:
+                    cursor = await conn.executemany(query, seq_of_params)
+                return cursor.rowcount
+            except Exception as e:
+                logger.warning("批量操作失败 (尝试 %d/%d): %s", attempt + 1, max_retries, e)
+                if attempt == max_retries - 1 or not _is_retryable(e):
+                    raise
+                await asyncio.sleep(_retry_delay(attempt))
 
 # 全局数据库管理器实例
 db_manager = DatabaseManager()
 
+# 各表的显式字段列表（顺序与建表一致），查询时替代SELECT *
+SESSION_COLUMNS = "id, title, description, status, created_at, updated_at"
+AGENT_COLUMNS = "id, session_id, parent_id, agent_type, topic, context_data, stack_depth, status, created_at"
+MESSAGE_COLUMNS = "id, agent_id, role, content, metadata, timestamp"
+# 数据库端生成的当前时间，与datetime.now().isoformat()格式一致（本地时间，毫秒精度），
+# 同一条语句内多次引用取值相同
+SQL_NOW = "strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')"
+
+# 层级结构只需要的Agent字段（不含较大的context_data）
+AGENT_NODE_COLUMNS = "id, parent_id, agent_type, topic, stack_depth AS level, status"
+
+# 递归CTE：以指定Agent为根的整棵子树
+SUBTREE_CTE = """
+    WITH RECURSIVE subtree(id) AS (
+        SELECT id FROM agents WHERE id = ?
+        UNION ALL
+        SELECT a.id FROM agents a JOIN subtree ON a.parent_id = subtree.id
+    )
+"""
+
+# 会话内的Agent树：从根Agent递归展开，按层级和创建时间排序，父节点总在子节点之前
+SESSION_TREE_QUERY = f"""
+    WITH RECURSIVE tree(id, parent_id, agent_type, topic, stack_depth, status, created_at, depth) AS (
+        SELECT id, parent_id, agent_type, topic, stack_depth, status, created_at, 0
+        FROM agents WHERE session_id = ?1 AND parent_id IS NULL
+        UNION ALL
+        SELECT a.id, a.parent_id, a.agent_type, a.topic, a.stack_depth, a.status, a.created_at, t.depth + 1
+        FROM agents a JOIN tree t ON a.parent_id = t.id
+        WHERE a.session_id = ?1
+    )
+    SELECT {AGENT_NODE_COLUMNS} FROM tree ORDER BY depth, created_at
+"""
+
+
+# 数据表结构，子表外键均为ON DELETE CASCADE，删除会话或Agent时由SQLite完成级联删除
+TABLE_SCHEMAS = {
+    # 学习会话表
+    "sessions": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            description TEXT,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    # Agent实例表
+    "agents": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            parent_id TEXT,
+            agent_type TEXT NOT NULL CHECK (agent_type IN ('main', 'branch')),
+            topic TEXT,
+            context_data TEXT,
+            stack_depth INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'active' CHECK (status IN ('active', 'suspended', 'completed')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+            FOREIGN KEY (parent_id) REFERENCES agents(id) ON DELETE CASCADE
+        )
+    """,
+    # 消息表
+    "messages": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id TEXT PRIMARY KEY,
+            agent_id TEXT NOT NULL,
+            role TEXT NOT NULL CHECK (role IN ('user', 'assistant', 'system')),
+            content TEXT NOT NULL,
+            metadata TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (agent_id) REFERENCES agents(id) ON DELETE CASCADE
+        )
+    """,
+    # 栈帧表（用于管理Agent上下文栈帧）
+    "agent_stack_frames": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id TEXT PRIMARY KEY,
+            agent_id TEXT NOT NULL,
+            context_data TEXT,
+            inherited_context TEXT,
+            stack_depth INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'active' CHECK (status IN ('active', 'suspended', 'completed')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (agent_id) REFERENCES agents(id) ON DELETE CASCADE
+        )
+    """,
+}
+
+
+async def _migrate_cascade_foreign_keys(conn: aiosqlite.Connection):
+    """
+    将旧表的外键升级为ON DELETE CASCADE
+    
+    SQLite不能修改已有外键，按官方流程新建表、复制数据、删除旧表再改名。
+    """
+    tables = []
+    for table in TABLE_SCHEMAS:
+        async with conn.execute(f"PRAGMA foreign_key_list({table})") as cursor:
+            foreign_keys = await cursor.fetchall()
+        if any(fk["on_delete"] != "CASCADE" for fk in foreign_keys):
+            tables.append(table)
+    
+    if not tables:
+        return
+    
+    print(f"🔄 升级外键为级联删除: {', '.join(tables)}")
+    # 重建期间必须关闭外键检查，且该设置在事务内无效
+    await conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table in tables:
+                async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+                    columns = ", ".join(row["name"] for row in await cursor.fetchall())
+                await conn.execute(TABLE_SCHEMAS[table].format(name=f"{table}_new"))
+                await conn.execute(f"INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}")
+                await conn.execute(f"DROP TABLE {table}")
+                await conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+            await conn.execute("COMMIT")
+        except BaseException:
+            await conn.execute("ROLLBACK")
+            raise
+    finally:
+        await conn.execute("PRAGMA foreign_keys = ON")
+
 
 async def init_db():
     """初始化数据库表结构 - 增强版本"""
@@ -114,71 +397,33 @@ async def init_db():
         conn = await db_manager.get_connection()
         print("🔄 开始初始化数据库...")
     
-        # 创建学习会话表
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS sessions (
-                id TEXT PRIMARY KEY,
-                title TEXT NOT NULL,
-                description TEXT,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # 创建Agent实例表
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS agents (
-                id TEXT PRIMARY KEY,
-                session_id TEXT NOT NULL,
-                parent_id TEXT,
-                agent_type TEXT NOT NULL CHECK (agent_type IN ('main', 'branch')),
-                topic TEXT,
-                context_data TEXT,
-                stack_depth INTEGER DEFAULT 0,
-                status TEXT DEFAULT 'active' CHECK (status IN ('active', 'suspended', 'completed')),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (session_id) REFERENCES sessions(id),
-                FOREIGN KEY (parent_id) REFERENCES agents(id)
-            )
-        """)
-        
-        # 创建消息表
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id TEXT PRIMARY KEY,
-                agent_id TEXT NOT NULL,
-                role TEXT NOT NULL CHECK (role IN ('user', 'assistant', 'system')),
-                content TEXT NOT NULL,
-                metadata TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (agent_id) REFERENCES agents(id)
-            )
-        """)
+        # 创建数据表（按依赖顺序）
+        for table, schema in TABLE_SCHEMAS.items():
+            await conn.execute(schema.format(name=table))
         
-        # 创建栈帧表（用于管理Agent上下文栈帧）
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS agent_stack_frames (
-                id TEXT PRIMARY KEY,
-                agent_id TEXT NOT NULL,
-                context_data TEXT,
-                inherited_context TEXT,
-                stack_depth INTEGER DEFAULT 0,
-                status TEXT DEFAULT 'active' CHECK (status IN ('active', 'suspended', 'completed')),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (agent_id) REFERENCES agents(id)
-            )
-        """)
+        # 旧数据库的外键缺少ON DELETE CASCADE时重建表
+        await _migrate_cascade_foreign_keys(conn)
         
         # 创建索引
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_agents_session_id ON agents(session_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_agents_parent_id ON agents(parent_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_agent_id ON messages(agent_id)")
+        # 复合索引与列表查询的过滤列和排序列一致，可直接按索引顺序返回结果
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions(created_at DESC)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_agents_session_parent_created ON agents(session_id, parent_id, created_at)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_agents_session_type_status ON agents(session_id, agent_type, status, created_at DESC)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_agents_parent_created ON agents(parent_id, created_at)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_agent_timestamp ON messages(agent_id, timestamp DESC)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_agent_role_timestamp ON messages(agent_id, role, timestamp DESC)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp DESC)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_stack_frames_agent_id ON agent_stack_frames(agent_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_stack_frames_agent_created ON agent_stack_frames(agent_id, created_at DESC)")
+        
+        # 移除已被复合索引前缀覆盖的旧索引，减少写入开销
+        await conn.execute("DROP INDEX IF EXISTS idx_agents_session_id")
+        await conn.execute("DROP INDEX IF EXISTS idx_agents_parent_id")
+        await conn.execute("DROP INDEX IF EXISTS idx_messages_agent_id")
+        await conn.execute("DROP INDEX IF EXISTS idx_stack_frames_agent_id")
+        
+        # 更新统计信息，让查询规划器按实际数据选择索引
+        await conn.execute("ANALYZE")
         
-        await conn.commit()
         print("✅ 数据库初始化完成")
     except Exception as e:
         print(f"❌ 数据库初始化失败: {e}")
@@ -206,4 +451,27 @@ async def rows_to_dict_list(cursor, rows):
         return []
     
     columns = [description[0] for description in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
\ No newline at end of file
+    return [dict(zip(columns, row)) for row in rows]
+
+def rows_to_tree(rows) -> List[dict]:
+    """
+    将按层级排序的Agent节点行组装为嵌套字典树
+    
+    行必须保证父节点先于子节点出现（如SESSION_TREE_QUERY的结果），
+    单次遍历、每个节点一次哈希查找即可挂载到父节点下。
+    """
+    nodes = {}
+    roots = []
+    
+    for row in rows:
+        node = dict(row)
+        node["children"] = []
+        nodes[node["id"]] = node
+        
+        parent = nodes.get(node["parent_id"]) if node["parent_id"] else None
+        if parent is not None:
+            parent["children"].append(node)
+        else:
+            roots.append(node)
+    
+    return roots
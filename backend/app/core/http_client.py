@@ -0,0 +1,33 @@
+import importlib.util
+from typing import Optional
+
+import httpx
+
+# HTTP/2需要可选依赖h2（httpx[http2]），未安装时使用HTTP/1.1
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# 连接池上限：保持足够多的长连接，突发请求也无需重新握手
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=100)
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    获取进程内共享的HTTP客户端
+
+    所有AI服务的SDK客户端都注入同一个连接池，DNS解析和TLS握手只在建立连接时发生一次，
+    之后的请求复用长连接。
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(http2=HTTP2_AVAILABLE, timeout=60, limits=HTTP_LIMITS)
+    return _client
+
+
+async def close_http_client():
+    """关闭共享HTTP客户端（应用关闭时调用）"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
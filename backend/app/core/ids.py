@@ -0,0 +1,43 @@
+import asyncio
+import os
+import uuid
+from collections import deque
+
+# 预生成的ID数量
+ID_BUFFER_SIZE = 256
+# 后台补充的检查间隔（秒）
+ID_REFILL_INTERVAL = 0.05
+
+_id_buffer: deque = deque()
+
+
+def new_id() -> str:
+    """
+    获取一个新ID（32位十六进制的UUID4，不含连字符）
+
+    优先从预生成的缓冲区取出，缓冲区耗尽时退回即时生成。
+    """
+    try:
+        return _id_buffer.popleft()
+    except IndexError:
+        return uuid.uuid4().hex
+
+
+def _fill_id_buffer():
+    """补满缓冲区：一次读取全部所需随机字节，摊薄os.urandom的系统调用开销"""
+    missing = ID_BUFFER_SIZE - len(_id_buffer)
+    if missing <= 0:
+        return
+
+    raw = os.urandom(16 * missing)
+    _id_buffer.extend(
+        uuid.UUID(bytes=raw[i:i + 16], version=4).hex
+        for i in range(0, len(raw), 16)
+    )
+
+
+async def refill_id_buffer():
+    """后台任务：定期补充ID缓冲区"""
+    while True:
+        _fill_id_buffer()
+        await asyncio.sleep(ID_REFILL_INTERVAL)
@@ -0,0 +1,28 @@
+import logging
+
+from app.core.serialization import dumps
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    结构化日志格式：每条记录输出为一行JSON
+
+    通过extra={"fields": {...}}传入的字段合并到输出中，便于日志采集系统直接解析。
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "lvl": record.levelname,
+            "name": record.name,
+            "msg": record.getMessage(),
+        }
+
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+
+        return dumps(entry, default=str)
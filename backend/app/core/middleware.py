@@ -0,0 +1,125 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# 请求体大小上限：10MB
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+BODY_METHODS = frozenset(("POST", "PUT", "PATCH"))
+
+# 响应头名称预先构造，避免每个响应重新分配
+PROCESS_TIME_HEADER = b"x-process-time"
+
+_TOO_LARGE_BODY = b'{"detail":"Request entity too large"}'
+# 413在读取请求体之前直接发出，并要求关闭连接，未读取的请求体随连接一起丢弃；
+# 外层中间件（如CORS）会原地修改响应头，每次发送时复制为新列表
+_TOO_LARGE_HEADERS = (
+    (b"content-type", b"application/json"),
+    (b"connection", b"close"),
+    (b"content-length", str(len(_TOO_LARGE_BODY)).encode()),
+)
+
+
+_INVALID_HOST_BODY = b"Invalid host header"
+_INVALID_HOST_HEADERS = (
+    (b"content-type", b"text/plain; charset=utf-8"),
+    (b"content-length", str(len(_INVALID_HOST_BODY)).encode()),
+)
+
+
+def _content_length(headers) -> int:
+    """从原始请求头中取出content-length，缺失或无法解析时返回0"""
+    for name, value in headers:
+        if name == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return 0
+    return 0
+
+
+class RequestGuardMiddleware:
+    """
+    请求守卫中间件（纯ASGI实现）
+
+    一次遍历内完成请求体大小限制和处理时间记录：
+    超过上限的POST/PUT/PATCH请求直接返回413，其余请求包装send，
+    在响应头发出时写入X-Process-Time（单位：微秒，如"153us"）。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] in BODY_METHODS and _content_length(scope["headers"]) > MAX_UPLOAD_SIZE:
+            await send({"type": "http.response.start", "status": 413, "headers": list(_TOO_LARGE_HEADERS)})
+            await send({"type": "http.response.body", "body": _TOO_LARGE_BODY})
+            return
+
+        # 单调时钟的整数纳秒读数，处理时间以整数微秒写入响应头
+        start = time.perf_counter_ns()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                elapsed_us = (time.perf_counter_ns() - start) // 1000
+                headers = list(message.get("headers", []))
+                headers.append((PROCESS_TIME_HEADER, b"%dus" % elapsed_us))
+                message["headers"] = headers
+
+                # 记录请求日志：参数延迟格式化，日志级别关闭时整体跳过；
+                # fields供结构化日志格式直接输出
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "%s %s - Status: %s - Time: %.4fs",
+                        scope["method"], scope["path"], message["status"], elapsed_us / 1e6,
+                        extra={"fields": {
+                            "m": scope["method"],
+                            "p": scope["path"],
+                            "s": message["status"],
+                            "t_us": elapsed_us,
+                        }},
+                    )
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+class FastTrustedHostMiddleware:
+    """
+    可信主机中间件（纯ASGI实现）
+
+    允许的主机名在构造时拆分为精确匹配集合和通配后缀（"*.example.com"），
+    每个请求只做一次集合查找和一次endswith判断。
+    """
+
+    def __init__(self, app, allowed_hosts):
+        self.app = app
+        self.exact = frozenset(host.encode() for host in allowed_hosts if not host.startswith("*"))
+        self.suffixes = tuple(host[1:].encode() for host in allowed_hosts if host.startswith("*."))
+        self.allow_any = "*" in allowed_hosts
+
+    async def __call__(self, scope, receive, send):
+        if self.allow_any or scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        host = b""
+        for name, value in scope["headers"]:
+            if name == b"host":
+                host = value.rsplit(b":", 1)[0]
+                break
+
+        if host in self.exact or (self.suffixes and host.endswith(self.suffixes)):
+            await self.app(scope, receive, send)
+            return
+
+        if scope["type"] == "websocket":
+            await send({"type": "websocket.close", "code": 1008})
+            return
+
+        await send({"type": "http.response.start", "status": 400, "headers": list(_INVALID_HOST_HEADERS)})
+        await send({"type": "http.response.body", "body": _INVALID_HOST_BODY})
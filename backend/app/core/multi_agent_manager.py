@@ -1,16 +1,164 @@
 from typing import Dict, List, Optional, Any, Tuple
 from datetime import datetime
-import json
-import uuid
 import asyncio
+import heapq
+from collections import OrderedDict, defaultdict, deque
+from contextlib import AsyncExitStack
 from dataclasses import dataclass
+from itertools import islice
+from weakref import WeakValueDictionary
 
-from app.core.stack_frame import AgentStackFrame
-from app.core.database import db_manager
-from app.models.agent import AgentHierarchyNode
+from app.core.serialization import dumps, loads, EMPTY_JSON
+from app.core.stack_frame import AgentStackFrame, resolve_inherited_messages
+from app.core.database import db_manager, SESSION_TREE_QUERY, SUBTREE_CTE, MESSAGE_COLUMNS
+from app.core.cache import response_cache
+from app.core.ids import new_id
+from app.models.agent import AgentHierarchyNode, hierarchy_node_from_row
 
 
-@dataclass
+# 固定的SQL文本集中在模块级定义，每次执行的文本完全相同，可命中连接的已编译语句缓存
+
+# 目标Agent及其全部祖先的最新栈帧，按从根到目标的顺序返回
+ANCESTOR_FRAMES_QUERY = """
+    WITH RECURSIVE chain(agent_id, parent_id, depth) AS (
+        SELECT id, parent_id, 0 FROM agents WHERE id = ?
+        UNION ALL
+        SELECT a.id, a.parent_id, c.depth + 1 FROM agents a JOIN chain c ON a.id = c.parent_id
+    )
+    SELECT sf.id, sf.agent_id, sf.context_data, sf.inherited_context, sf.stack_depth,
+           sf.status, sf.created_at, sf.updated_at, c.parent_id
+    FROM chain c
+    JOIN agent_stack_frames sf ON sf.id = (
+        SELECT id FROM agent_stack_frames 
+        WHERE agent_id = c.agent_id 
+        ORDER BY created_at DESC 
+        LIMIT 1
+    )
+    ORDER BY c.depth DESC
+"""
+
+MAIN_AGENT_INSERT_QUERY = """
+    INSERT INTO agents (id, session_id, parent_id, agent_type, topic, context_data, stack_depth, status, created_at)
+    VALUES (?, ?, NULL, 'main', ?, ?, 0, 'active', ?)
+"""
+
+BRANCH_AGENT_INSERT_QUERY = """
+    INSERT INTO agents (id, session_id, parent_id, agent_type, topic, context_data, stack_depth, status, created_at)
+    VALUES (?, ?, ?, 'branch', ?, ?, ?, 'active', ?)
+"""
+
+PARENT_SESSION_QUERY = "SELECT session_id FROM agents WHERE id = ?"
+
+FRAME_INSERT_QUERY = """
+    INSERT INTO agent_stack_frames (id, agent_id, context_data, inherited_context, stack_depth, status, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+FRAME_UPDATE_QUERY = """
+    UPDATE agent_stack_frames 
+    SET context_data = ?, inherited_context = ?, status = ?, updated_at = ?
+    WHERE agent_id = ?
+"""
+
+# 以full模式引用父Agent消息、尚未固定消息副本的子Agent栈帧
+FULL_INHERITORS_QUERY = """
+    SELECT sf.id, sf.agent_id, sf.inherited_context
+    FROM agents a
+    JOIN agent_stack_frames sf ON sf.agent_id = a.id
+    WHERE a.parent_id = ?
+      AND json_extract(sf.inherited_context, '$.inheritance_mode') = 'full'
+      AND json_extract(sf.inherited_context, '$.source_agent_id') = a.parent_id
+      AND json_extract(sf.inherited_context, '$.inherited_messages') IS NULL
+"""
+
+FRAME_INHERITED_UPDATE_QUERY = "UPDATE agent_stack_frames SET inherited_context = ? WHERE id = ?"
+
+# 启动预热：每个Agent取最近创建的栈帧，按更新时间返回最近活跃的若干个Agent
+WARMUP_AGENTS_QUERY = """
+    SELECT agent_id
+    FROM (
+        SELECT agent_id, status, updated_at,
+               ROW_NUMBER() OVER (PARTITION BY agent_id ORDER BY created_at DESC) AS rn
+        FROM agent_stack_frames
+    )
+    WHERE rn = 1 AND status = 'active'
+    ORDER BY updated_at DESC
+    LIMIT ?
+"""
+
+MESSAGE_INSERT_QUERY = """
+    INSERT INTO messages (id, agent_id, role, content, metadata, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+class FrameCache(OrderedDict):
+    """
+    按最近使用顺序淘汰的栈帧缓存，超过容量时移除最久未访问的栈帧
+    
+    同时按状态维护栈帧ID索引，栈帧状态变化时通过回调更新，
+    查询活跃/挂起的Agent无需遍历整个缓存。
+    """
+    
+    def __init__(self, maxsize: int = 256):
+        super().__init__()
+        self.maxsize = maxsize
+        self.by_status: Dict[str, set] = defaultdict(set)
+    
+    def _index(self, key: str, frame: AgentStackFrame):
+        self.by_status[frame.status].add(key)
+        frame._status_listener = self._on_status_change
+    
+    def _unindex(self, key: str, frame: AgentStackFrame):
+        self.by_status[frame.status].discard(key)
+        frame._status_listener = None
+    
+    def _on_status_change(self, frame: AgentStackFrame, old_status: str):
+        self.by_status[old_status].discard(frame.agent_id)
+        self.by_status[frame.status].add(frame.agent_id)
+    
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+    
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+    
+    def __setitem__(self, key, value):
+        previous = OrderedDict.get(self, key)
+        if previous is not None:
+            self._unindex(key, previous)
+        super().__setitem__(key, value)
+        self._index(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+    
+    def __delitem__(self, key):
+        self._unindex(key, super().__getitem__(key))
+        super().__delitem__(key)
+    
+    def pop(self, key, *default):
+        if key in self:
+            self._unindex(key, super().__getitem__(key))
+        return super().pop(key, *default)
+    
+    def popitem(self, last: bool = True):
+        key, frame = super().popitem(last=last)
+        self._unindex(key, frame)
+        return key, frame
+    
+    def clear(self):
+        for key, frame in self.items():
+            frame._status_listener = None
+        self.by_status.clear()
+        super().clear()
+
+
+@dataclass(slots=True)
 class AgentSwitchContext:
     """Agent切换上下文"""
     from_agent_id: str
@@ -31,11 +179,21 @@ class MultiAgentManager:
     """
     
     def __init__(self):
-        self.active_frames: Dict[str, AgentStackFrame] = {}
+        self.max_cached_frames = 256
+        self.active_frames: Dict[str, AgentStackFrame] = FrameCache(self.max_cached_frames)
         self.agent_hierarchy: Dict[str, List[str]] = {}  # parent_id -> [child_ids]
-        self.switch_history: List[AgentSwitchContext] = []
+        self.switch_history: deque = deque(maxlen=100)  # 只保留最近100条切换记录
+        self._loading_frames: Dict[str, asyncio.Future] = {}  # agent_id -> 正在进行的加载
+        # 每个Agent一把锁，不同Agent上的操作互不阻塞；无人持有时随弱引用自动回收
+        self._agent_locks: WeakValueDictionary = WeakValueDictionary()
+        # 活跃分支Agent的最小堆 (created_at时间戳, agent_id)，已挂起或删除的条目在弹出时惰性丢弃
+        self._branch_heap: List[Tuple[float, str]] = []
         self.max_stack_depth = 5
         self.max_active_agents = 10
+        # 消息写入队列：后台任务将并发到达的消息合并为一个事务提交
+        self.message_batch_size = 128
+        self._message_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
     
     async def create_main_agent(self, session_id: str, topic: str, config: Optional[Dict] = None) -> str:
         """
@@ -49,20 +207,10 @@ class MultiAgentManager:
         Returns:
             创建的Agent ID
         """
-        agent_id = str(uuid.uuid4())
+        agent_id = new_id()
         current_time = datetime.now().isoformat()
         
-        # 创建Agent记录
-        agent_query = """
-            INSERT INTO agents (id, session_id, parent_id, agent_type, topic, context_data, stack_depth, status, created_at)
-            VALUES (?, ?, NULL, 'main', ?, ?, 0, 'active', ?)
-        """
-        
         context_data = config or {}
-        await db_manager.execute_insert(
-            agent_query,
-            (agent_id, session_id, topic, json.dumps(context_data), current_time)
-        )
         
         # 创建栈帧
         main_frame = AgentStackFrame(
@@ -72,8 +220,13 @@ class MultiAgentManager:
             stack_depth=0
         )
         
-        # 创建栈帧记录
-        await self._create_stack_frame_record(main_frame)
+        # Agent记录与栈帧记录在同一事务中写入
+        async with db_manager.transaction() as conn:
+            await conn.execute(
+                MAIN_AGENT_INSERT_QUERY,
+                (agent_id, session_id, topic, dumps(context_data) if context_data else EMPTY_JSON, current_time)
+            )
+            await self._create_stack_frame_record(main_frame, conn)
         
         # 缓存到内存
         self.active_frames[agent_id] = main_frame
@@ -114,26 +267,15 @@ class MultiAgentManager:
             await self._suspend_oldest_branch_agent()
         
         # 获取父Agent信息
-        parent_agent_query = "SELECT session_id FROM agents WHERE id = ?"
-        parent_row = await db_manager.execute_one(parent_agent_query, (parent_agent_id,))
+        parent_row = await db_manager.execute_one(PARENT_SESSION_QUERY, (parent_agent_id,))
         if not parent_row:
             raise ValueError(f"父Agent {parent_agent_id} 数据不存在")
         
         session_id = parent_row[0]
-        branch_agent_id = str(uuid.uuid4())
+        branch_agent_id = new_id()
         current_time = datetime.now().isoformat()
         
-        # 创建分支Agent记录
-        branch_query = """
-            INSERT INTO agents (id, session_id, parent_id, agent_type, topic, context_data, stack_depth, status, created_at)
-            VALUES (?, ?, ?, 'branch', ?, ?, ?, 'active', ?)
-        """
-        
         context_data = {'branch_from_message': message_id, 'inheritance_mode': inheritance_mode}
-        await db_manager.execute_insert(
-            branch_query,
-            (branch_agent_id, session_id, parent_agent_id, topic, json.dumps(context_data), parent_frame.stack_depth + 1, current_time)
-        )
         
         # 创建分支栈帧
         branch_frame = AgentStackFrame(
@@ -146,11 +288,17 @@ class MultiAgentManager:
         # 执行上下文继承
         inherited_context = branch_frame.inherit_context(inheritance_mode, topic)
         
-        # 创建栈帧记录
-        await self._create_stack_frame_record(branch_frame)
+        # Agent记录与栈帧记录在同一事务中写入
+        async with db_manager.transaction() as conn:
+            await conn.execute(
+                BRANCH_AGENT_INSERT_QUERY,
+                (branch_agent_id, session_id, parent_agent_id, topic, dumps(context_data), parent_frame.stack_depth + 1, current_time)
+            )
+            await self._create_stack_frame_record(branch_frame, conn)
         
         # 缓存到内存
         self.active_frames[branch_agent_id] = branch_frame
+        self._track_branch_frame(branch_frame)
         
         # 更新层级关系
         if parent_agent_id not in self.agent_hierarchy:
@@ -171,20 +319,54 @@ class MultiAgentManager:
         Returns:
             切换是否成功
         """
+        # 按固定顺序获取涉及的Agent锁，避免相向切换时死锁；
+        # 同一Agent上的切换按顺序完成，切换历史与栈帧状态保持一致
+        async with AsyncExitStack() as stack:
+            for agent_id in sorted({from_agent_id, to_agent_id} - {None, ""}):
+                await stack.enter_async_context(self._agent_lock(agent_id))
+            return await self._switch_agent_locked(from_agent_id, to_agent_id, reason)
+    
+    def _agent_lock(self, agent_id: str) -> asyncio.Lock:
+        """获取指定Agent的锁"""
+        lock = self._agent_locks.get(agent_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._agent_locks[agent_id] = lock
+        return lock
+    
+    async def _switch_agent_locked(self, from_agent_id: str, to_agent_id: str, reason: str) -> bool:
+        """在已持有相关Agent锁的情况下执行切换"""
         # 验证目标Agent存在
         target_frame = await self._get_or_load_frame(to_agent_id)
         if not target_frame:
             raise ValueError(f"目标Agent {to_agent_id} 不存在")
         
+        changed_frames = []
+        
         # 如果源Agent存在，挂起它
         if from_agent_id and from_agent_id in self.active_frames:
             source_frame = self.active_frames[from_agent_id]
             source_frame.suspend()
-            await self._update_stack_frame_record(source_frame)
+            changed_frames.append(source_frame)
         
         # 激活目标Agent
         target_frame.resume()
-        await self._update_stack_frame_record(target_frame)
+        changed_frames.append(target_frame)
+        
+        # 源和目标栈帧的状态在同一事务中写入
+        if any(frame.is_dirty for frame in changed_frames):
+            try:
+                async with db_manager.transaction() as conn:
+                    for frame in changed_frames:
+                        await self._update_stack_frame_record(frame, conn)
+            except BaseException:
+                for frame in changed_frames:
+                    frame.mark_dirty()
+                raise
+            # 事务提交后再使上下文缓存失效，避免并发读取在提交前重新缓存旧数据
+            for frame in changed_frames:
+                response_cache.invalidate(f"context:{frame.agent_id}")
+        self._track_branch_frame(target_frame)
         
         # 记录切换历史
         switch_context = AgentSwitchContext(
@@ -195,10 +377,6 @@ class MultiAgentManager:
         )
         self.switch_history.append(switch_context)
         
-        # 限制历史记录长度
-        if len(self.switch_history) > 100:
-            self.switch_history = self.switch_history[-50:]
-        
         return True
     
     async def get_agent_context(self, agent_id: str) -> Dict[str, Any]:
@@ -237,22 +415,107 @@ class MultiAgentManager:
         # 添加消息到栈帧
         message = frame.add_message(role, content, metadata)
         
-        # 更新栈帧记录
-        await self._update_stack_frame_record(frame)
-        
-        # 同时保存到消息表
-        message_query = """
-            INSERT INTO messages (id, agent_id, role, content, metadata, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """
-        
-        await db_manager.execute_insert(
-            message_query,
-            (message['id'], agent_id, role, content, json.dumps(metadata or {}), message['timestamp'])
-        )
+        # 交给后台写入任务与其他并发消息合并提交；
+        # 等待所在批次提交完成后再返回，保证调用方随后的读取可见
+        row = (message['id'], agent_id, role, content, dumps(metadata) if metadata else EMPTY_JSON, message['timestamp'])
+        done = asyncio.get_running_loop().create_future()
+        self._get_message_queue().put_nowait((frame, row, done))
+        await done
         
         return message
     
+    def _get_message_queue(self) -> asyncio.Queue:
+        """获取消息写入队列，后台写入任务未运行时（或事件循环已更换）重新启动"""
+        loop = asyncio.get_running_loop()
+        if self._writer_task is None or self._writer_task.done() or self._writer_task.get_loop() is not loop:
+            self._message_queue = asyncio.Queue()
+            self._writer_task = loop.create_task(self._message_writer(self._message_queue))
+        return self._message_queue
+    
+    async def _message_writer(self, queue: asyncio.Queue):
+        """
+        后台写入任务：取出队列中已到达的消息，合并为一个事务写入
+        
+        同一批次中每个栈帧只更新一次，所有消息行通过executemany一次插入。
+        """
+        try:
+            while True:
+                batch = [await queue.get()]
+                try:
+                    # 让出一次事件循环，使同一时刻到达的写入者也能进入本批次
+                    await asyncio.sleep(0)
+                    while len(batch) < self.message_batch_size and not queue.empty():
+                        batch.append(queue.get_nowait())
+                    
+                    try:
+                        await self._write_message_batch(batch)
+                        results = [None] * len(batch)
+                    except Exception as e:
+                        if len(batch) == 1:
+                            results = [e]
+                        else:
+                            # 批次失败时逐条重写，避免一条坏消息拖累同批次的其他消息
+                            results = []
+                            for item in batch:
+                                try:
+                                    await self._write_message_batch([item])
+                                    results.append(None)
+                                except Exception as item_error:
+                                    results.append(item_error)
+                    
+                    for (_, _, done), error in zip(batch, results):
+                        if not done.done():
+                            if error is None:
+                                done.set_result(None)
+                            else:
+                                done.set_exception(error)
+                finally:
+                    # 任务被取消或遇到非Exception异常时，本批次的等待者同样要得到结果
+                    for _, _, done in batch:
+                        if not done.done():
+                            done.set_exception(RuntimeError("消息写入任务已停止"))
+                        queue.task_done()
+        finally:
+            # 写入任务退出后不再有人处理队列，剩余的等待者以异常结束
+            while not queue.empty():
+                _, _, done = queue.get_nowait()
+                if not done.done():
+                    done.set_exception(RuntimeError("消息写入任务已停止"))
+                queue.task_done()
+    
+    async def _write_message_batch(self, batch: List[Tuple[AgentStackFrame, tuple, asyncio.Future]]):
+        """在一个事务中写入一批消息及其所属栈帧"""
+        frames = {frame.agent_id: frame for frame, _, _ in batch}
+        
+        try:
+            async with db_manager.transaction() as conn:
+                for frame in frames.values():
+                    await self._update_stack_frame_record(frame, conn)
+                await conn.executemany(MESSAGE_INSERT_QUERY, [row for _, row, _ in batch])
+        except BaseException:
+            # 事务已回滚，栈帧需在下次写入时重新持久化
+            for frame in frames.values():
+                frame.mark_dirty()
+            raise
+        
+        # 事务提交后再使缓存失效，避免并发读取在提交前重新缓存旧数据
+        for agent_id in frames:
+            response_cache.invalidate_prefix(f"conversation:{agent_id}:")
+            response_cache.invalidate(f"context:{agent_id}")
+    
+    async def flush(self):
+        """等待队列中的消息全部写入数据库"""
+        if self._message_queue is not None and self._writer_task is not None and not self._writer_task.done():
+            await self._message_queue.join()
+    
+    async def close(self):
+        """写入剩余消息并停止后台写入任务"""
+        await self.flush()
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+            self._message_queue = None
+    
     async def get_session_hierarchy(self, session_id: str) -> List[AgentHierarchyNode]:
         """
         获取会话的Agent层级结构
@@ -263,86 +526,55 @@ class MultiAgentManager:
         Returns:
             Agent层级节点列表
         """
-        # 获取会话中的所有Agent
-        agents_query = "SELECT * FROM agents WHERE session_id = ? ORDER BY stack_depth, created_at"
-        agent_rows = await db_manager.execute_query(agents_query, (session_id,))
+        # 递归查询会话中的Agent树，父节点总在子节点之前返回
+        agent_rows = await db_manager.execute_query(SESSION_TREE_QUERY, (session_id,))
         
         if not agent_rows:
             return []
         
-        # 构建Agent字典
+        # 单次遍历构建层级结构
         agents_dict = {}
         root_agents = []
         
         for row in agent_rows:
-            node = AgentHierarchyNode(
-                id=row[0],
-                parent_id=row[2],
-                agent_type=row[3],
-                topic=row[4],
-                level=row[6],
-                status=row[7],
-                children=[]
-            )
+            node = hierarchy_node_from_row(row)
             
             agents_dict[node.id] = node
             
-            # 如果没有父Agent，则为根Agent
-            if not node.parent_id:
+            # 如果没有父Agent，则为根Agent；否则父节点已先出现，直接挂载
+            if node.parent_id:
+                agents_dict[node.parent_id].children.append(node)
+            else:
                 root_agents.append(node)
         
-        # 建立父子关系
-        for agent in agents_dict.values():
-            if agent.parent_id and agent.parent_id in agents_dict:
-                agents_dict[agent.parent_id].children.append(agent)
-        
         return root_agents
     
-    async def delete_agent_branch(self, agent_id: str, recursive: bool = True) -> int:
+    async def delete_agent_branch(self, agent_id: str) -> List[str]:
         """
-        删除Agent分支
+        删除Agent分支（包括所有子Agent、栈帧和消息）
         
         Args:
             agent_id: Agent ID
-            recursive: 是否递归删除子Agent
             
         Returns:
-            删除的Agent数量
+            被删除的Agent ID列表（含子Agent），调用方可据此清理其他缓存
         """
-        deleted_count = 0
+        async with db_manager.transaction() as conn:
+            # 先取回子树ID用于清理内存缓存；子Agent、栈帧和消息由外键ON DELETE CASCADE级联删除
+            async with conn.execute(f"{SUBTREE_CTE} SELECT id FROM subtree", (agent_id,)) as cursor:
+                agent_ids = [row["id"] for row in await cursor.fetchall()]
+            await conn.execute("DELETE FROM agents WHERE id = ?", (agent_id,))
         
-        if recursive:
-            # 递归删除子Agent
-            children_query = "SELECT id FROM agents WHERE parent_id = ?"
-            children_rows = await db_manager.execute_query(children_query, (agent_id,))
-            
-            for child_row in children_rows:
-                child_count = await self.delete_agent_branch(child_row[0], True)
-                deleted_count += child_count
-        
-        # 删除Agent的消息
-        await db_manager.execute_update("DELETE FROM messages WHERE agent_id = ?", (agent_id,))
-        
-        # 删除Agent的栈帧
-        await db_manager.execute_update("DELETE FROM agent_stack_frames WHERE agent_id = ?", (agent_id,))
-        
-        # 删除Agent
-        await db_manager.execute_update("DELETE FROM agents WHERE id = ?", (agent_id,))
+        # 从内存缓存和层级关系中移除
+        deleted_ids = set(agent_ids)
+        for deleted_id in agent_ids:
+            self.active_frames.pop(deleted_id, None)
+            self.agent_hierarchy.pop(deleted_id, None)
         
-        # 从内存缓存中移除
-        if agent_id in self.active_frames:
-            del self.active_frames[agent_id]
-        
-        # 更新层级关系
-        for parent_id, children in self.agent_hierarchy.items():
-            if agent_id in children:
-                children.remove(agent_id)
+        for children in self.agent_hierarchy.values():
+            children[:] = [child for child in children if child not in deleted_ids]
         
-        if agent_id in self.agent_hierarchy:
-            del self.agent_hierarchy[agent_id]
-        
-        deleted_count += 1
-        return deleted_count
+        return agent_ids
     
     async def get_switch_history(self, limit: int = 20) -> List[Dict[str, Any]]:
         """
@@ -354,7 +586,8 @@ class MultiAgentManager:
         Returns:
             切换历史记录列表
         """
-        history = self.switch_history[-limit:] if limit > 0 else self.switch_history
+        start = max(0, len(self.switch_history) - limit) if limit > 0 else 0
+        history = islice(self.switch_history, start, None)
         
         return [
             {
@@ -373,10 +606,26 @@ class MultiAgentManager:
         Returns:
             活跃Agent ID列表
         """
-        return [
-            agent_id for agent_id, frame in self.active_frames.items()
-            if frame.status == 'active'
-        ]
+        return list(self.active_frames.by_status['active'])
+    
+    async def warmup(self, limit: int = 64) -> int:
+        """
+        预热栈帧缓存：载入最近更新的活跃Agent栈帧
+        
+        重启后首次访问这些Agent时无需再从数据库重建栈帧。
+        
+        Args:
+            limit: 最多载入的Agent数量（祖先栈帧随之载入）
+            
+        Returns:
+            载入的Agent数量
+        """
+        rows = await db_manager.execute_query(WARMUP_AGENTS_QUERY, (min(limit, self.max_cached_frames),))
+        
+        # 按更新时间升序载入，最近更新的栈帧位于LRU末端
+        for row in reversed(rows):
+            await self._get_or_load_frame(row['agent_id'])
+        return len(rows)
     
     async def _get_or_load_frame(self, agent_id: str) -> Optional[AgentStackFrame]:
         """
@@ -392,111 +641,222 @@ class MultiAgentManager:
         if agent_id in self.active_frames:
             return self.active_frames[agent_id]
         
-        # 从数据库加载
-        frame_query = """
-            SELECT sf.*, a.parent_id
-            FROM agent_stack_frames sf
-            JOIN agents a ON sf.agent_id = a.id
-            WHERE sf.agent_id = ?
-            ORDER BY sf.created_at DESC
-            LIMIT 1
+        # 合并同一Agent的并发加载，保证只构建一个栈帧对象
+        loading = self._loading_frames.get(agent_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load_frame(agent_id))
+            self._loading_frames[agent_id] = loading
+            loading.add_done_callback(lambda _: self._loading_frames.pop(agent_id, None))
+        
+        return await asyncio.shield(loading)
+    
+    async def _load_frame(self, agent_id: str) -> Optional[AgentStackFrame]:
         """
+        从数据库加载Agent栈帧
+        
+        一次递归查询取回整条祖先链的栈帧，再一次查询从消息表回填
+        未缓存栈帧的消息，然后从根向下重建，已在内存中的祖先直接复用。
         
-        frame_row = await db_manager.execute_one(frame_query, (agent_id,))
-        if not frame_row:
+        Args:
+            agent_id: Agent ID
+            
+        Returns:
+            Agent栈帧对象
+        """
+        frame_rows = await db_manager.execute_query(ANCESTOR_FRAMES_QUERY, (agent_id,))
+        if not frame_rows or frame_rows[-1]['agent_id'] != agent_id:
             return None
         
-        # 重建栈帧对象
-        parent_frame = None
-        parent_agent_id = frame_row[8]  # a.parent_id
-        
-        if parent_agent_id:
-            parent_frame = await self._get_or_load_frame(parent_agent_id)
-        
-        frame_data = {
-            'frame_id': frame_row[0],
-            'agent_id': frame_row[1],
-            'context_data': json.loads(frame_row[2]) if frame_row[2] else {},
-            'inherited_context': json.loads(frame_row[3]) if frame_row[3] else {},
-            'stack_depth': frame_row[4],
-            'status': frame_row[5],
-            'created_at': frame_row[6],
-            'updated_at': frame_row[7]
-        }
+        # 消息不随栈帧记录保存，从消息表取回需要重建的栈帧的消息
+        missing_ids = [row['agent_id'] for row in frame_rows if row['agent_id'] not in self.active_frames]
+        messages_by_agent = await self.load_messages(missing_ids)
+        
+        # 查询返回后不再有await，以下重建过程不会与其他加载交错
+        frame = None
+        for frame_row in frame_rows:
+            row_agent_id = frame_row['agent_id']
+            cached = self.active_frames.get(row_agent_id)
+            if cached is not None:
+                frame = cached
+                continue
+            
+            # 祖先缺少栈帧记录时没有父栈帧，与逐级加载时的行为一致
+            parent_agent_id = frame_row['parent_id']
+            parent_frame = self.active_frames.get(parent_agent_id) if parent_agent_id else None
+            
+            context_data = loads(frame_row['context_data']) if frame_row['context_data'] else {}
+            context_data['messages'] = messages_by_agent.get(row_agent_id, [])
+            
+            frame_data = {
+                'frame_id': frame_row['id'],
+                'agent_id': row_agent_id,
+                'context_data': context_data,
+                'inherited_context': loads(frame_row['inherited_context']) if frame_row['inherited_context'] else {},
+                'stack_depth': frame_row['stack_depth'],
+                'status': frame_row['status'],
+                'created_at': frame_row['created_at'],
+                'updated_at': frame_row['updated_at']
+            }
+            
+            frame = AgentStackFrame.from_dict(frame_data, parent_frame)
+            frame.mark_persisted()
+            
+            # 缓存到内存
+            self.active_frames[row_agent_id] = frame
+            self._track_branch_frame(frame)
         
-        frame = AgentStackFrame.from_dict(frame_data, parent_frame)
+        return frame
+    
+    async def load_messages(self, agent_ids: List[str], conn=None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        从消息表批量取回多个Agent的消息，按时间顺序分组
         
-        # 缓存到内存
-        self.active_frames[agent_id] = frame
+        Args:
+            agent_ids: Agent ID列表
+            conn: 所在事务的连接，为空时使用读连接
+            
+        Returns:
+            agent_id -> 消息列表
+        """
+        if not agent_ids:
+            return {}
+        
+        placeholders = ",".join("?" * len(agent_ids))
+        query = f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE agent_id IN ({placeholders}) ORDER BY timestamp, rowid"
+        if conn is not None:
+            async with conn.execute(query, tuple(agent_ids)) as cursor:
+                rows = await cursor.fetchall()
+        else:
+            rows = await db_manager.execute_query(query, tuple(agent_ids))
+        
+        messages_by_agent: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            messages_by_agent.setdefault(row['agent_id'], []).append({
+                'id': row['id'],
+                'role': row['role'],
+                'content': row['content'],
+                'timestamp': row['timestamp'],
+                'metadata': loads(row['metadata']) if row['metadata'] else {}
+            })
+        return messages_by_agent
+    
+    async def pin_inherited_messages(self, source_agent_id: str, conn) -> List[str]:
+        """
+        把引用指定Agent消息的full模式继承固定为消息副本
         
-        return frame
+        full模式只记录截止消息，来源消息被删除或清空后无法还原；
+        须在删除来源消息的同一事务中、删除语句之前调用。
+        
+        Args:
+            source_agent_id: 即将删除消息的Agent ID
+            conn: 所在事务的连接
+            
+        Returns:
+            继承上下文被改写的子Agent ID列表（事务提交后需失效其上下文缓存）
+        """
+        async with conn.execute(FULL_INHERITORS_QUERY, (source_agent_id,)) as cursor:
+            frame_rows = await cursor.fetchall()
+        if not frame_rows:
+            return []
+        
+        source_messages = (await self.load_messages([source_agent_id], conn)).get(source_agent_id, [])
+        
+        updates = []
+        for frame_row in frame_rows:
+            inherited = loads(frame_row['inherited_context'])
+            messages = resolve_inherited_messages(inherited, source_messages)
+            inherited['inherited_messages'] = messages
+            updates.append((dumps(inherited), frame_row['id']))
+            
+            cached = self.active_frames.get(frame_row['agent_id'])
+            if cached is not None and cached.frame_id == frame_row['id']:
+                cached.pin_inherited_messages(messages)
+        await conn.executemany(FRAME_INHERITED_UPDATE_QUERY, updates)
+        
+        return [frame_row['agent_id'] for frame_row in frame_rows]
     
-    async def _create_stack_frame_record(self, frame: AgentStackFrame):
+    async def _create_stack_frame_record(self, frame: AgentStackFrame, conn=None):
         """
         创建栈帧数据库记录
         
         Args:
             frame: 栈帧对象
-        """
-        query = """
-            INSERT INTO agent_stack_frames (id, agent_id, context_data, inherited_context, stack_depth, status, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """
-        
-        await db_manager.execute_insert(
-            query,
-            (
-                frame.frame_id,
-                frame.agent_id,
-                json.dumps(frame.context_data),
-                json.dumps(frame.inherited_context),
-                frame.stack_depth,
-                frame.status,
-                frame.created_at.isoformat(),
-                frame.updated_at.isoformat()
-            )
+            conn: 所在事务的连接，为空时单独提交
+        """
+        params = (
+            frame.frame_id,
+            frame.agent_id,
+            frame.serialized_context(),
+            frame.serialized_inherited(),
+            frame.stack_depth,
+            frame.status,
+            frame.created_at.isoformat(),
+            frame.updated_at.isoformat()
         )
+        
+        if conn is not None:
+            await conn.execute(FRAME_INSERT_QUERY, params)
+        else:
+            await db_manager.execute_insert(FRAME_INSERT_QUERY, params)
+        frame.mark_persisted()
     
-    async def _update_stack_frame_record(self, frame: AgentStackFrame):
+    async def _update_stack_frame_record(self, frame: AgentStackFrame, conn=None):
         """
-        更新栈帧数据库记录
+        更新栈帧数据库记录，自上次写入后未修改时直接跳过
         
         Args:
             frame: 栈帧对象
+            conn: 所在事务的连接，为空时单独提交
         """
-        query = """
-            UPDATE agent_stack_frames 
-            SET context_data = ?, inherited_context = ?, status = ?, updated_at = ?
-            WHERE agent_id = ?
-        """
+        if not frame.is_dirty:
+            return
         
-        await db_manager.execute_update(
-            query,
-            (
-                json.dumps(frame.context_data),
-                json.dumps(frame.inherited_context),
-                frame.status,
-                frame.updated_at.isoformat(),
-                frame.agent_id
-            )
+        params = (
+            frame.serialized_context(),
+            frame.serialized_inherited(),
+            frame.status,
+            frame.updated_at.isoformat(),
+            frame.agent_id
         )
+        
+        if conn is not None:
+            await conn.execute(FRAME_UPDATE_QUERY, params)
+        else:
+            await db_manager.execute_update(FRAME_UPDATE_QUERY, params)
+        frame.mark_persisted()
+    
+    def _track_branch_frame(self, frame: AgentStackFrame):
+        """将活跃的分支栈帧加入最老分支堆"""
+        if frame.stack_depth > 0 and frame.status == 'active':
+            heapq.heappush(self._branch_heap, (frame.created_at.timestamp(), frame.agent_id))
+        
+        # 过期条目过多时按当前活跃分支重建，避免堆无限增长
+        if len(self._branch_heap) > 2 * len(self.active_frames) + 16:
+            self._branch_heap = [
+                (f.created_at.timestamp(), agent_id) for agent_id, f in self.active_frames.items()
+                if f.stack_depth > 0 and f.status == 'active'
+            ]
+            heapq.heapify(self._branch_heap)
     
     async def _suspend_oldest_branch_agent(self):
         """
         挂起最老的分支Agent
         """
-        branch_agents = [
-            (agent_id, frame) for agent_id, frame in self.active_frames.items()
-            if frame.stack_depth > 0 and frame.status == 'active'
-        ]
-        
-        if branch_agents:
-            # 按创建时间排序，挂起最老的
-            branch_agents.sort(key=lambda x: x[1].created_at)
-            oldest_agent_id, oldest_frame = branch_agents[0]
+        # 弹出堆顶直到找到仍在内存中且处于活跃状态的分支栈帧
+        while self._branch_heap:
+            created_at, agent_id = heapq.heappop(self._branch_heap)
+            oldest_frame = self.active_frames.get(agent_id)
+            if (
+                oldest_frame is None
+                or oldest_frame.status != 'active'
+                or oldest_frame.created_at.timestamp() != created_at
+            ):
+                continue
             
             oldest_frame.suspend()
             await self._update_stack_frame_record(oldest_frame)
+            response_cache.invalidate(f"context:{agent_id}")
+            return
     
     def get_memory_stats(self) -> Dict[str, Any]:
         """
@@ -505,8 +865,8 @@ class MultiAgentManager:
         Returns:
             内存统计信息
         """
-        active_count = len([f for f in self.active_frames.values() if f.status == 'active'])
-        suspended_count = len([f for f in self.active_frames.values() if f.status == 'suspended'])
+        active_count = len(self.active_frames.by_status['active'])
+        suspended_count = len(self.active_frames.by_status['suspended'])
         
         return {
             'total_frames': len(self.active_frames),
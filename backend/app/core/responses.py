@@ -0,0 +1,45 @@
+import hashlib
+from typing import Any, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from app.core.config import settings
+
+
+async def json_response(content: Any, item_count: int = 0, etag: Optional[str] = None) -> ORJSONResponse:
+    """
+    构建ORJSONResponse
+
+    条目数超过阈值时在线程池中完成序列化，避免大响应阻塞事件循环；
+    小响应直接在当前线程序列化，省去线程切换开销。
+    """
+    headers = {"ETag": etag} if etag else None
+    if item_count > settings.LARGE_RESPONSE_THRESHOLD:
+        # ORJSONResponse在构造时即完成序列化
+        return await run_in_threadpool(ORJSONResponse, content, headers=headers)
+    return ORJSONResponse(content, headers=headers)
+
+
+def weak_etag(*parts: Any) -> str:
+    """根据资源内容生成弱ETag"""
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=8).hexdigest()
+    return f'W/"{digest}"'
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """
+    比较If-None-Match与当前ETag
+
+    匹配时返回304响应，调用方可直接返回而跳过构建和序列化；不匹配时返回None。
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    
+    # 弱比较：忽略W/前缀，支持逗号分隔的多个ETag和通配符
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if "*" in candidates or etag.removeprefix("W/") in candidates:
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
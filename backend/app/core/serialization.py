@@ -0,0 +1,50 @@
+import orjson
+
+# 空字典的JSON文本，无元数据或继承上下文时直接使用，无需每次编码
+EMPTY_JSON = "{}"
+
+loads = orjson.loads
+
+
+def dumps(obj, default=None) -> str:
+    """
+    编码为JSON文本
+
+    default: 遇到无法直接编码的对象时的转换函数（如str）
+    """
+    return orjson.dumps(obj, default=default).decode()
+
+
+class FrozenDict(dict):
+    """
+    只读字典：可在多个请求间共享的解码结果
+
+    仍是dict的子类，orjson和Pydantic可直接处理；任何修改操作都抛出TypeError，
+    需要修改时先用copy()取得普通字典副本。
+    """
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenDict不可修改，请先调用copy()")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        # copy/pickle通过构造函数重建，不经过__setitem__
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(obj):
+    """递归地把字典转为FrozenDict、列表转为元组"""
+    if isinstance(obj, dict):
+        return FrozenDict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+
+def loads_frozen(raw: str):
+    """解码为不可修改的结构，结果可安全地缓存和共享"""
+    return freeze(loads(raw))
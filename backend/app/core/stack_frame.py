@@ -1,11 +1,15 @@
-from typing import Dict, List, Optional, Any
+from typing import Callable, Dict, List, Optional, Any, Tuple
 from datetime import datetime
-import json
-import uuid
+import heapq
+import sys
 from dataclasses import dataclass, field
+from itertools import takewhile
 
+from app.core.serialization import dumps, EMPTY_JSON
+from app.core.ids import new_id
 
-@dataclass
+
+@dataclass(slots=True)
 class AgentStackFrame:
     """
     Agent栈帧类 - 栈帧式分支Agent架构的核心组件
@@ -25,7 +29,16 @@ class AgentStackFrame:
     status: str = "active"  # active, suspended, completed
     created_at: datetime = field(default_factory=datetime.now)
     updated_at: datetime = field(default_factory=datetime.now)
-    frame_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    frame_id: str = field(default_factory=new_id)
+    
+    # 序列化缓存与脏标记：未修改的栈帧无需再次写库
+    _context_json: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    _inherited_json: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    _dirty: bool = field(default=True, init=False, repr=False, compare=False)
+    # 相关性计算用的消息特征缓存：(小写内容, 词集合, 长度权重)，与消息列表一一对应
+    _message_features: List[Tuple[str, frozenset, float]] = field(default_factory=list, init=False, repr=False, compare=False)
+    # 状态变化回调 (frame, old_status)，由持有该栈帧的缓存设置，用于维护状态索引
+    _status_listener: Optional[Callable[['AgentStackFrame', str], None]] = field(default=None, init=False, repr=False, compare=False)
     
     def __post_init__(self):
         """初始化后处理"""
@@ -52,30 +65,35 @@ class AgentStackFrame:
         
         parent_context = self.parent_frame.context_data
         parent_messages = parent_context.get('messages', [])
+        # 继承时间与栈帧更新时间共用同一次取时
+        now = datetime.now()
         
         if mode == 'none':
             return {}
         
         elif mode == 'full':
-            # 完整继承父上下文
+            # 完整继承父上下文：只记录来源和截止消息，不复制消息列表；
+            # 父Agent的消息只追加，读取时按截止位置取前缀即可还原
             self.inherited_context = {
-                'inherited_messages': parent_messages,
                 'inheritance_mode': 'full',
                 'source_agent_id': self.parent_frame.agent_id,
+                'as_of_message_id': parent_messages[-1]['id'] if parent_messages else None,
                 'message_count': len(parent_messages),
-                'inherited_at': datetime.now().isoformat()
+                'inherited_at': now.isoformat()
             }
         
         elif mode == 'selective':
             # 选择性继承（基于相关性选择3-5条对话）
-            relevant_messages = self._select_relevant_messages(parent_messages, topic)
+            relevant_messages = self._select_relevant_messages(
+                parent_messages, topic, self.parent_frame.message_features()
+            )
             self.inherited_context = {
                 'inherited_messages': relevant_messages,
                 'inheritance_mode': 'selective',
                 'source_agent_id': self.parent_frame.agent_id,
                 'message_count': len(relevant_messages),
                 'selection_criteria': topic,
-                'inherited_at': datetime.now().isoformat()
+                'inherited_at': now.isoformat()
             }
         
         elif mode == 'summary':
@@ -87,19 +105,72 @@ class AgentStackFrame:
                 'source_agent_id': self.parent_frame.agent_id,
                 'original_message_count': len(parent_messages),
                 'summary_topic': topic,
-                'inherited_at': datetime.now().isoformat()
+                'inherited_at': now.isoformat()
             }
         
-        self.updated_at = datetime.now()
+        self._inherited_json = None
+        self._dirty = True
+        self.updated_at = now
         return self.inherited_context
     
-    def _select_relevant_messages(self, messages: List[Dict], topic: str) -> List[Dict]:
+    def message_features(self) -> List[Tuple[str, frozenset, float]]:
+        """
+        获取本栈帧各消息的相关性特征
+        
+        消息列表只追加，特征按新增消息增量计算并缓存，
+        多次从同一父Agent创建分支时无需重复分词。
+        """
+        messages = self.context_data.get('messages', [])
+        features = self._message_features
+        if len(features) > len(messages):
+            features.clear()
+        features.extend(self._extract_features(msg.get('content', '')) for msg in messages[len(features):])
+        return features
+    
+    @staticmethod
+    def _extract_features(content: str) -> Tuple[str, frozenset, float]:
+        """提取单条消息的小写内容、词集合和长度权重"""
+        content_lower = content.lower()
+        # 词驻留后，各消息间重复出现的词共享同一个字符串对象，且集合求交时可按身份快速比较
+        tokens = frozenset(map(sys.intern, content_lower.split()))
+        return content_lower, tokens, min(1.0, len(content) / 100)
+    
+    @staticmethod
+    def _score_features(features: Tuple[str, frozenset, float], topic_words: frozenset) -> float:
+        """根据预先提取的消息特征计算相关性得分 (0-1)"""
+        content_lower, message_words, length_weight = features
+        if not content_lower or not topic_words:
+            return 0.0
+        
+        # 1. 关键词匹配得分：词汇重叠度
+        overlap = len(topic_words & message_words)
+        keyword_score = overlap / len(topic_words)
+        
+        # 2. 语义包含得分：整词命中必然是子串命中，只对未整词命中的主题词做子串查找
+        substring_hits = sum(
+            word in content_lower for word in topic_words if word not in message_words
+        )
+        semantic_score = (overlap + substring_hits) / len(topic_words)
+        
+        # 3. 长度权重（较长的消息可能包含更多信息）已在特征中计算
+        # 综合评分
+        final_score = (0.4 * keyword_score + 0.4 * semantic_score + 0.2 * length_weight)
+        
+        return min(1.0, final_score)
+    
+    def _select_relevant_messages(
+        self, 
+        messages: List[Dict], 
+        topic: str, 
+        features: Optional[List[Tuple[str, frozenset, float]]] = None
+    ) -> List[Dict]:
         """
         基于相关性选择消息
         
         Args:
             messages: 父Agent的消息列表
             topic: 分支主题
+            features: 与messages对应的消息特征（来自父栈帧缓存），为空时现场计算
             
         Returns:
             选择的相关消息列表
@@ -108,19 +179,17 @@ class AgentStackFrame:
             # 如果没有主题，返回最近的3条消息
             return messages[-3:] if len(messages) > 3 else messages
         
-        # 计算每条消息的相关性得分
-        scored_messages = []
-        for msg in messages:
-            content = msg.get('content', '')
-            relevance_score = self._calculate_relevance(content, topic)
-            scored_messages.append((msg, relevance_score))
+        if features is None or len(features) != len(messages):
+            features = [self._extract_features(msg.get('content', '')) for msg in messages]
         
-        # 按相关性排序
-        scored_messages.sort(key=lambda x: x[1], reverse=True)
+        # 计算每条消息的相关性得分，主题只分词一次
+        topic_words = frozenset(topic.lower().split())
+        scores = [self._score_features(feature, topic_words) for feature in features]
         
-        # 选择最相关的3-5条消息
-        selected_count = min(5, max(3, len(scored_messages) // 2))
-        selected_messages = [msg for msg, score in scored_messages[:selected_count] if score > 0.1]
+        # 选择最相关的3-5条消息：只取前k名，无需对全部消息排序（结果与稳定排序后截取一致）
+        selected_count = min(5, max(3, len(messages) // 2))
+        top_indices = heapq.nlargest(selected_count, range(len(scores)), key=scores.__getitem__)
+        selected_messages = [messages[i] for i in top_indices if scores[i] > 0.1]
         
         # 如果相关消息太少，补充最近的消息
         if len(selected_messages) < 2:
@@ -152,34 +221,10 @@ class AgentStackFrame:
         if not message_content or not topic:
             return 0.0
         
-        message_lower = message_content.lower()
-        topic_lower = topic.lower()
-        
-        # 1. 关键词匹配得分
-        topic_words = set(topic_lower.split())
-        message_words = set(message_lower.split())
-        
-        if not topic_words:
-            return 0.0
-        
-        # 计算词汇重叠度
-        overlap = len(topic_words.intersection(message_words))
-        keyword_score = overlap / len(topic_words)
-        
-        # 2. 语义包含得分
-        semantic_score = 0.0
-        for word in topic_words:
-            if word in message_lower:
-                semantic_score += 1.0
-        semantic_score = semantic_score / len(topic_words)
-        
-        # 3. 长度权重（较长的消息可能包含更多信息）
-        length_weight = min(1.0, len(message_content) / 100)
-        
-        # 综合评分
-        final_score = (0.4 * keyword_score + 0.4 * semantic_score + 0.2 * length_weight)
-        
-        return min(1.0, final_score)
+        return self._score_features(
+            self._extract_features(message_content), 
+            frozenset(topic.lower().split())
+        )
     
     def _generate_context_summary(self, messages: List[Dict], topic: str) -> str:
         """
@@ -243,11 +288,13 @@ class AgentStackFrame:
         Returns:
             添加的消息对象
         """
+        # 消息时间戳与栈帧更新时间共用同一次取时
+        now = datetime.now()
         message = {
-            'id': str(uuid.uuid4()),
+            'id': new_id(),
             'role': role,
             'content': content,
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': now.isoformat(),
             'metadata': metadata or {}
         }
         
@@ -255,8 +302,10 @@ class AgentStackFrame:
         if 'messages' not in self.context_data:
             self.context_data['messages'] = []
         
+        # 消息本身由消息表持久化，栈帧只需写回更新时间
         self.context_data['messages'].append(message)
-        self.updated_at = datetime.now()
+        self._dirty = True
+        self.updated_at = now
         
         return message
     
@@ -273,7 +322,7 @@ class AgentStackFrame:
             'stack_depth': self.stack_depth,
             'status': self.status,
             'current_context': self.context_data,
-            'inherited_context': self.inherited_context,
+            'inherited_context': self.resolved_inherited_context(),
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
@@ -285,21 +334,78 @@ class AgentStackFrame:
         
         return full_context
     
+    def resolved_inherited_context(self) -> Dict[str, Any]:
+        """
+        获取可直接使用的继承上下文
+        
+        full模式只保存对父Agent消息的引用，这里从父栈帧取出截止位置之前的消息；
+        其他模式（以及旧版本保存的完整副本）原样返回。
+        """
+        inherited = self.inherited_context
+        if inherited.get('inheritance_mode') != 'full' or 'inherited_messages' in inherited:
+            return inherited
+        
+        source_messages = self.parent_frame.context_data.get('messages', []) if self.parent_frame else []
+        return {**inherited, 'inherited_messages': resolve_inherited_messages(inherited, source_messages)}
+    
+    def pin_inherited_messages(self, messages: List[Dict[str, Any]]):
+        """把full模式的引用固定为消息副本（来源消息被删除前调用，数据库记录由调用方更新）"""
+        self.inherited_context = {**self.inherited_context, 'inherited_messages': messages}
+        self._inherited_json = None
+    
     def suspend(self):
         """挂起栈帧"""
-        self.status = "suspended"
-        self.updated_at = datetime.now()
+        self._set_status("suspended")
     
     def resume(self):
         """恢复栈帧"""
-        self.status = "active"
-        self.updated_at = datetime.now()
+        self._set_status("active")
     
     def complete(self):
         """完成栈帧"""
-        self.status = "completed"
+        self._set_status("completed")
+    
+    def _set_status(self, status: str):
+        """更新状态，状态未变化时不标记为待写入"""
+        if self.status != status:
+            old_status = self.status
+            self.status = status
+            self._dirty = True
+            if self._status_listener is not None:
+                self._status_listener(self, old_status)
         self.updated_at = datetime.now()
     
+    @property
+    def is_dirty(self) -> bool:
+        """自上次写库后是否有修改"""
+        return self._dirty
+    
+    def mark_dirty(self):
+        """标记为待写入（例如写库事务回滚后）"""
+        self._dirty = True
+    
+    def mark_persisted(self):
+        """标记当前状态已写入数据库"""
+        self._dirty = False
+    
+    def serialized_context(self) -> str:
+        """
+        获取需要写入栈帧记录的context_data JSON文本
+        
+        消息只追加且已逐条写入消息表，加载栈帧时从消息表回填，
+        因此这里不包含messages，栈帧记录的大小与对话长度无关。
+        """
+        if self._context_json is None:
+            persisted = {k: v for k, v in self.context_data.items() if k != 'messages'}
+            self._context_json = dumps(persisted) if persisted else EMPTY_JSON
+        return self._context_json
+    
+    def serialized_inherited(self) -> str:
+        """获取inherited_context的JSON文本（继承后不再变化，编码一次即可）"""
+        if self._inherited_json is None:
+            self._inherited_json = dumps(self.inherited_context) if self.inherited_context else EMPTY_JSON
+        return self._inherited_json
+    
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典格式"""
         return {
@@ -317,27 +423,57 @@ class AgentStackFrame:
     @classmethod
     def from_dict(cls, data: Dict[str, Any], parent_frame: Optional['AgentStackFrame'] = None) -> 'AgentStackFrame':
         """从字典创建栈帧对象"""
-        frame = cls(
+        # 时间戳和ID在构造前解析，只有缺失时才生成默认值
+        now = None
+        timestamps = []
+        for key in ('created_at', 'updated_at'):
+            value = data.get(key)
+            if isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            elif value is None:
+                now = now or datetime.now()
+                value = now
+            timestamps.append(value)
+        
+        return cls(
             agent_id=data['agent_id'],
             parent_frame=parent_frame,
             context_data=data.get('context_data', {}),
             inherited_context=data.get('inherited_context', {}),
             stack_depth=data.get('stack_depth', 0),
             status=data.get('status', 'active'),
-            frame_id=data.get('frame_id', str(uuid.uuid4()))
+            created_at=timestamps[0],
+            updated_at=timestamps[1],
+            frame_id=data['frame_id'] if 'frame_id' in data else new_id()
         )
+
+
+def resolve_inherited_messages(inherited: Dict[str, Any], source_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    按full模式的继承引用，从来源Agent的消息列表中取出继承时已有的消息
+    
+    Args:
+        inherited: full模式的继承上下文（含as_of_message_id和message_count）
+        source_messages: 来源Agent按时间排序的消息列表
         
-        # 设置时间戳
-        if 'created_at' in data:
-            if isinstance(data['created_at'], str):
-                frame.created_at = datetime.fromisoformat(data['created_at'])
-            else:
-                frame.created_at = data['created_at']
-        
-        if 'updated_at' in data:
-            if isinstance(data['updated_at'], str):
-                frame.updated_at = datetime.fromisoformat(data['updated_at'])
-            else:
-                frame.updated_at = data['updated_at']
-        
-        return frame
\ No newline at end of file
+    Returns:
+        截止到as_of_message_id（含）的消息前缀
+    """
+    as_of = inherited.get('as_of_message_id')
+    if not as_of:
+        return []
+    
+    # 消息只追加，通常按继承时的消息数即可直接定位
+    count = inherited.get('message_count', 0)
+    if 0 < count <= len(source_messages) and source_messages[count - 1]['id'] == as_of:
+        return source_messages[:count]
+    
+    for index, message in enumerate(source_messages):
+        if message['id'] == as_of:
+            return source_messages[:index + 1]
+    
+    # 截止消息已被删除时，退回继承时刻之前仍然存在的消息
+    inherited_at = inherited.get('inherited_at')
+    if not inherited_at:
+        return []
+    return list(takewhile(lambda message: message['timestamp'] <= inherited_at, source_messages))[:count]
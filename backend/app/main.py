@@ -1,25 +1,42 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.exceptions import RequestValidationError
 import uvicorn
 import time
 import logging
 from contextlib import asynccontextmanager
-from typing import Callable
 
-from app.core.config import settings
+from app.core.config import settings, ALLOWED_ORIGINS
 from app.core.database import init_db
+from app.core.middleware import RequestGuardMiddleware, FastTrustedHostMiddleware
+from app.core.log_format import JsonLogFormatter
 from app.api.v1.api import api_router
 
 # 配置日志
-logging.basicConfig(
-    level=getattr(logging, settings.LOG_LEVEL.upper()),
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+if settings.LOG_FORMAT.lower() == "json":
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(JsonLogFormatter())
+    logging.basicConfig(level=getattr(logging, settings.LOG_LEVEL.upper()), handlers=[_log_handler])
+else:
+    logging.basicConfig(
+        level=getattr(logging, settings.LOG_LEVEL.upper()),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
 logger = logging.getLogger(__name__)
 
+# 数据库探测结果缓存：/ready与后台健康检查共用，间隔内直接返回上次结果
+READY_PROBE_INTERVAL = 5
+_last_probe_ts = 0.0
+_last_probe_ok = True
+
+
+def _record_probe(ok: bool):
+    """记录一次数据库探测结果"""
+    global _last_probe_ts, _last_probe_ok
+    _last_probe_ts = time.monotonic()
+    _last_probe_ok = ok
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -29,6 +46,11 @@ async def lifespan(app: FastAPI):
         # 启动时初始化数据库
         await init_db()
         logger.info("Database initialized successfully")
+        
+        # 预热Agent栈帧缓存，避免重启后每个Agent首次访问都要从数据库重建栈帧
+        from app.core.multi_agent_manager import multi_agent_manager
+        warmed = await multi_agent_manager.warmup()
+        logger.info("Agent frame cache warmed with %d agents", warmed)
         print("🚀 多Agent学习系统启动成功")
         
         # 启动健康检查任务
@@ -42,8 +64,10 @@ async def lifespan(app: FastAPI):
                     await asyncio.sleep(300)  # 每5分钟检查一次
                     # 简单的数据库连接测试
                     await db_manager.execute_one("SELECT 1")
+                    _record_probe(True)
                     logger.debug("Health check passed")
                 except Exception as e:
+                    _record_probe(False)
                     logger.error(f"Health check failed: {e}")
                     # 尝试重新连接数据库
                     try:
@@ -56,6 +80,14 @@ async def lifespan(app: FastAPI):
         # 启动健康检查任务
         health_task = asyncio.create_task(health_check_task())
         
+        # 启动UUID缓冲区补充任务
+        from app.core.ids import refill_id_buffer
+        id_refill_task = asyncio.create_task(refill_id_buffer())
+        
+        # 预先生成OpenAPI文档：FastAPI生成后即缓存在app.openapi_schema，
+        # 遍历全部模型的开销放在启动阶段，而不是第一个访问文档的请求
+        app.openapi()
+        
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
         raise
@@ -69,6 +101,16 @@ async def lifespan(app: FastAPI):
         # 取消健康检查任务
         if 'health_task' in locals():
             health_task.cancel()
+        if 'id_refill_task' in locals():
+            id_refill_task.cancel()
+        
+        # 写入尚在队列中的消息
+        from app.core.multi_agent_manager import multi_agent_manager
+        await multi_agent_manager.close()
+        
+        # 关闭AI服务共享的HTTP连接池
+        from app.core.http_client import close_http_client
+        await close_http_client()
         
         # 关闭数据库连接
         from app.core.database import db_manager
@@ -89,45 +131,16 @@ app = FastAPI(
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
     docs_url=f"{settings.API_V1_STR}/docs" if settings.DEBUG else None,
     redoc_url=f"{settings.API_V1_STR}/redoc" if settings.DEBUG else None,
+    default_response_class=ORJSONResponse,
 )
 
-# 请求处理时间中间件
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next: Callable):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
-    
-    # 记录请求日志
-    logger.info(
-        f"{request.method} {request.url.path} - "
-        f"Status: {response.status_code} - "
-        f"Time: {process_time:.4f}s"
-    )
-    return response
-
-# 请求大小限制中间件
-@app.middleware("http")
-async def limit_upload_size(request: Request, call_next: Callable):
-    if request.method in ["POST", "PUT", "PATCH"]:
-        content_length = request.headers.get("content-length")
-        if content_length:
-            content_length = int(content_length)
-            max_size = 10 * 1024 * 1024  # 10MB
-            if content_length > max_size:
-                return JSONResponse(
-                    status_code=413,
-                    content={"detail": "Request entity too large"}
-                )
-    
-    response = await call_next(request)
-    return response
+# 请求守卫中间件：请求大小限制和处理时间记录合并为一次ASGI遍历
+app.add_middleware(RequestGuardMiddleware)
 
 # CORS中间件配置
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=settings.ALLOWED_ORIGINS,
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
     allow_headers=[
@@ -138,14 +151,15 @@ app.add_middleware(
         "Authorization",
         "X-Requested-With",
         "X-Process-Time",
+        "If-None-Match",
     ],
-    expose_headers=["X-Process-Time"],
+    expose_headers=["X-Process-Time", "ETag"],
 )
 
 # 信任的主机中间件（生产环境安全）
 if not settings.DEBUG:
     app.add_middleware(
-        TrustedHostMiddleware,
+        FastTrustedHostMiddleware,
         allowed_hosts=["localhost", "127.0.0.1", "*.yourdomain.com"]
     )
 
@@ -176,6 +190,29 @@ async def health_check():
     }
 
 
+@app.get("/live")
+def liveness():
+    """存活探针：仅说明进程可响应，不访问数据库"""
+    return {"status": "alive"}
+
+
+@app.get("/ready")
+async def readiness():
+    """就绪探针：数据库探测结果在间隔内复用，避免负载均衡器高频轮询压到数据库"""
+    if time.monotonic() - _last_probe_ts >= READY_PROBE_INTERVAL:
+        from app.core.database import db_manager
+        try:
+            await db_manager.execute_one("SELECT 1")
+            _record_probe(True)
+        except Exception as e:
+            logger.error(f"Readiness probe failed: {e}")
+            _record_probe(False)
+    
+    if not _last_probe_ok:
+        return ORJSONResponse(status_code=503, content={"status": "unavailable"})
+    return {"status": "ready"}
+
+
 @app.get("/info")
 async def system_info():
     """系统信息端点"""
@@ -197,8 +234,11 @@ async def system_info():
 # 全局异常处理
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    logger.error(f"Validation error on {request.url.path}: {exc.errors()}")
-    return JSONResponse(
+    logger.error(
+        "Validation error on %s: %s", request.url.path, exc.errors(),
+        extra={"fields": {"p": request.url.path, "s": 422}}
+    )
+    return ORJSONResponse(
         status_code=422,
         content={
             "detail": "请求参数验证失败",
@@ -209,26 +249,38 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
-    logger.error(f"HTTP error on {request.url.path}: {exc.detail}")
-    return JSONResponse(
+    logger.error(
+        "HTTP error on %s: %s", request.url.path, exc.detail,
+        extra={"fields": {"p": request.url.path, "s": exc.status_code}}
+    )
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={"detail": exc.detail}
     )
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
-    logger.error(f"Unexpected error on {request.url.path}: {str(exc)}", exc_info=True)
-    return JSONResponse(
+    logger.error(
+        "Unexpected error on %s: %s", request.url.path, exc,
+        exc_info=True, extra={"fields": {"p": request.url.path, "s": 500}}
+    )
+    return ORJSONResponse(
         status_code=500,
         content={"detail": "内部服务器错误"}
     )
 
 
 if __name__ == "__main__":
+    # uvicorn[standard]已包含uvloop和httptools；uvloop不支持Windows，缺失时回退到asyncio。
+    # 请求日志由RequestGuardMiddleware记录，关闭uvicorn自带的访问日志
+    import importlib.util
     uvicorn.run(
         "app.main:app",
         host="0.0.0.0",
         port=8000,
         reload=settings.DEBUG,
-        log_level="info"
+        log_level="info",
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http="httptools",
+        access_log=False
     )
\ No newline at end of file
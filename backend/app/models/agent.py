@@ -1,13 +1,12 @@
-from pydantic import BaseModel, Field, validator
-from typing import Optional, Dict, Any, List
+from pydantic import BaseModel, Field, model_validator
+from typing import Optional, Dict, Any, List, Literal
 from datetime import datetime
-import json
 
 
 class AgentBase(BaseModel):
     """Agent基础模型"""
     session_id: str = Field(..., description="所属会话ID")
-    agent_type: str = Field(..., pattern="^(main|branch)$", description="Agent类型")
+    agent_type: Literal["main", "branch"] = Field(..., description="Agent类型")
     topic: str = Field(..., min_length=1, max_length=255, description="Agent主题")
 
 
@@ -16,20 +15,20 @@ class AgentCreate(AgentBase):
     parent_id: Optional[str] = Field(None, description="父Agent ID（分支Agent必需）")
     context_data: Optional[Dict[str, Any]] = Field(default_factory=dict, description="上下文数据")
     
-    @validator('parent_id')
-    def validate_parent_id(cls, v, values):
-        if values.get('agent_type') == 'branch' and not v:
+    @model_validator(mode='after')
+    def validate_parent_id(self):
+        if self.agent_type == 'branch' and not self.parent_id:
             raise ValueError('分支Agent必须指定父Agent ID')
-        if values.get('agent_type') == 'main' and v:
+        if self.agent_type == 'main' and self.parent_id:
             raise ValueError('主Agent不能有父Agent')
-        return v
+        return self
 
 
 class AgentUpdate(BaseModel):
     """更新Agent请求模型"""
     topic: Optional[str] = Field(None, min_length=1, max_length=255)
     context_data: Optional[Dict[str, Any]] = None
-    status: Optional[str] = Field(None, pattern="^(active|suspended|completed)$")
+    status: Optional[Literal["active", "suspended", "completed"]] = None
 
 
 class AgentResponse(AgentBase):
@@ -92,15 +91,27 @@ class AgentHierarchyNode(BaseModel):
 # 解决前向引用问题
 AgentHierarchyNode.model_rebuild()
 
+# 层级节点的全部字段：构造时复制一份作为已设置字段集合（节点赋值时会修改该集合），
+# 不必每个节点从输入键重新统计
+_HIERARCHY_NODE_FIELDS = frozenset(AgentHierarchyNode.model_fields)
+
+
+def hierarchy_node_from_row(row) -> AgentHierarchyNode:
+    """
+    由层级查询的数据库行构造节点
+    
+    字段直接来自数据库、类型已知，跳过逐节点的Pydantic校验。
+    """
+    return AgentHierarchyNode.model_construct(set(_HIERARCHY_NODE_FIELDS), **row, children=[])
+
 
 class BranchCreateRequest(BaseModel):
     """创建分支Agent请求模型"""
     parent_agent_id: str = Field(..., description="父Agent ID")
     topic: str = Field(..., min_length=1, max_length=255, description="分支主题")
     message_id: str = Field(..., description="触发分支的消息ID")
-    inheritance_mode: str = Field(
+    inheritance_mode: Literal["selective", "summary", "full", "none"] = Field(
         default="selective", 
-        pattern="^(selective|summary|full|none)$", 
         description="上下文继承模式"
     )
 
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Literal
 from .message import MessageResponse
 
 
@@ -7,9 +7,8 @@ class ChatRequest(BaseModel):
     """聊天请求模型"""
     agent_id: str = Field(..., description="Agent ID")
     content: str = Field(..., min_length=1, max_length=4000, description="用户消息内容")
-    context_mode: Optional[str] = Field(
+    context_mode: Optional[Literal["auto", "full", "selective", "none"]] = Field(
         default="auto", 
-        pattern="^(auto|full|selective|none)$", 
         description="上下文模式"
     )
     
@@ -50,9 +49,8 @@ class ChatStreamChunk(BaseModel):
 class ContextInheritanceRequest(BaseModel):
     """上下文继承请求模型"""
     parent_agent_id: str = Field(..., description="父Agent ID")
-    inheritance_mode: str = Field(
+    inheritance_mode: Literal["selective", "summary", "full", "none"] = Field(
         default="selective",
-        pattern="^(selective|summary|full|none)$",
         description="继承模式"
     )
     max_messages: Optional[int] = Field(default=5, ge=1, le=20, description="最大消息数")
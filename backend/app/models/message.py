@@ -1,11 +1,11 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Literal
 from datetime import datetime
 
 
 class MessageBase(BaseModel):
     """消息基础模型"""
-    role: str = Field(..., pattern="^(user|assistant|system)$", description="消息角色")
+    role: Literal["user", "assistant", "system"] = Field(..., description="消息角色")
     content: str = Field(..., min_length=1, description="消息内容")
 
 
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Literal
 from datetime import datetime
 
 
@@ -18,7 +18,7 @@ class SessionUpdate(BaseModel):
     """更新会话请求模型"""
     title: Optional[str] = Field(None, min_length=1, max_length=255)
     description: Optional[str] = Field(None, max_length=1000)
-    status: Optional[str] = Field(None, pattern="^(active|completed|archived)$")
+    status: Optional[Literal["active", "completed", "archived"]] = None
 
 
 class SessionResponse(SessionBase):
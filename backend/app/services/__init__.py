@@ -1,10 +1,11 @@
 # 服务模块
-from .agent_manager import AgentManager
+from .agent_manager import AgentManager, agent_manager
 from .openai_service import OpenAIService
 from .deepseek_service import DeepseekService, deepseek_service
 
 __all__ = [
     "AgentManager",
+    "agent_manager",
     "OpenAIService",
     "DeepseekService",
     "deepseek_service",
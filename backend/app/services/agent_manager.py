@@ -1,57 +1,102 @@
-import json
-import uuid
-from typing import Dict, List, Optional, Any
-from datetime import datetime
+from typing import Dict, List, Optional, Any, Tuple
+from collections import OrderedDict
+import time
+from functools import lru_cache
 
-from app.core.database import db_manager
-from app.models.agent import AgentHierarchyNode
+from app.core.serialization import dumps, loads
+from app.core.database import db_manager, AGENT_NODE_COLUMNS, SESSION_TREE_QUERY, SQL_NOW
+from app.models.agent import AgentHierarchyNode, hierarchy_node_from_row
+from app.core.ids import new_id
+
+
+# 以指定Agent为根的整棵子树，同层按创建时间排序
+HIERARCHY_QUERY = f"""
+    WITH RECURSIVE subtree(id, parent_id, agent_type, topic, stack_depth, status, created_at, depth) AS (
+        SELECT id, parent_id, agent_type, topic, stack_depth, status, created_at, 0
+        FROM agents WHERE id = ?
+        UNION ALL
+        SELECT a.id, a.parent_id, a.agent_type, a.topic, a.stack_depth, a.status, a.created_at, s.depth + 1
+        FROM agents a JOIN subtree s ON a.parent_id = s.id
+    )
+    SELECT {AGENT_NODE_COLUMNS} FROM subtree ORDER BY depth, created_at
+"""
+
+# 栈帧写入语句：时间戳由数据库在语句内生成（同一语句内created_at与updated_at取值相同），
+# 不在Python中逐次格式化当前时间
+# 栈深度在同一语句内从agents表取得，并通过RETURNING取回
+FRAME_INSERT_QUERY = f"""
+    INSERT INTO agent_stack_frames (id, agent_id, context_data, inherited_context, stack_depth, status, created_at, updated_at)
+    SELECT ?, id, ?, ?, stack_depth, 'active', {SQL_NOW}, {SQL_NOW}
+    FROM agents WHERE id = ?
+    RETURNING stack_depth
+"""
+FRAME_STATUS_UPDATE_QUERY = f"UPDATE agent_stack_frames SET status = ?, updated_at = {SQL_NOW} WHERE agent_id = ?"
+FRAME_CONTEXT_UPDATE_QUERY = f"UPDATE agent_stack_frames SET context_data = ?, updated_at = {SQL_NOW} WHERE agent_id = ?"
+
+
+def _load_json(raw: Optional[str]) -> Dict[str, Any]:
+    """解析JSON文本字段，空值返回空字典"""
+    return loads(raw) if raw else {}
+
+
+@lru_cache(maxsize=1024)
+def _topic_tokens(topic: str) -> frozenset:
+    """话题的小写分词集合"""
+    return frozenset(topic.lower().split())
 
 
 class AgentManager:
     """Agent管理器 - 实现栈帧式Agent架构的核心逻辑"""
     
     def __init__(self):
-        self.active_frames: Dict[str, Any] = {}
+        # 有界LRU缓存：agent_id -> (写入时间, 上下文)，超过容量或TTL的条目被淘汰
+        self.active_frames: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+        self._cache_max = 1024
+        self._cache_ttl = 600
+    
+    def _cache_get(self, agent_id: str) -> Optional[Dict[str, Any]]:
+        """读取缓存的上下文，过期时移除并返回None"""
+        entry = self.active_frames.get(agent_id)
+        if entry is None:
+            return None
+        
+        cached_at, context = entry
+        if time.monotonic() - cached_at > self._cache_ttl:
+            del self.active_frames[agent_id]
+            return None
+        
+        self.active_frames.move_to_end(agent_id)
+        return context
+    
+    def _cache_set(self, agent_id: str, context: Dict[str, Any]):
+        """写入缓存，超过容量时淘汰最久未使用的条目"""
+        self.active_frames[agent_id] = (time.monotonic(), context)
+        self.active_frames.move_to_end(agent_id)
+        while len(self.active_frames) > self._cache_max:
+            self.active_frames.popitem(last=False)
     
     async def create_stack_frame(self, agent_id: str, context_data: Dict, inherited_context: Dict) -> str:
         """创建Agent栈帧"""
-        frame_id = str(uuid.uuid4())
-        current_time = datetime.now().isoformat()
+        frame_id = new_id()
         
-        # 获取Agent信息以确定栈深度
-        agent_row = await db_manager.execute_one(
-            "SELECT stack_depth FROM agents WHERE id = ?",
-            (agent_id,)
+        # 单条INSERT ... SELECT完成栈深度查询和插入
+        row = await db_manager.execute_returning(
+            FRAME_INSERT_QUERY,
+            (frame_id, dumps(context_data), dumps(inherited_context), agent_id)
         )
         
-        stack_depth = agent_row[0] if agent_row else 0
-        
-        query = """
-            INSERT INTO agent_stack_frames (id, agent_id, context_data, inherited_context, stack_depth, status, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, 'active', ?, ?)
-        """
-        
-        await db_manager.execute_insert(
-            query,
-            (
-                frame_id,
-                agent_id,
-                json.dumps(context_data),
-                json.dumps(inherited_context),
-                stack_depth,
-                current_time,
-                current_time
-            )
-        )
+        # Agent不存在时INSERT ... SELECT不插入任何行
+        if row is None:
+            raise ValueError(f"Agent {agent_id} 不存在")
         
         # 缓存到内存中
-        self.active_frames[agent_id] = {
+        self._cache_set(agent_id, {
             "frame_id": frame_id,
             "context_data": context_data,
             "inherited_context": inherited_context,
-            "stack_depth": stack_depth,
+            "stack_depth": row["stack_depth"],
             "status": "active"
-        }
+        })
         
         return frame_id
     
@@ -66,12 +111,14 @@ class AgentManager:
         if inheritance_mode == "none":
             return {}
         
-        # 获取父Agent的消息历史
+        # 获取父Agent最近20条消息，由数据库按时间顺序返回（子查询沿索引倒序取数）
         messages_query = """
-            SELECT role, content, timestamp FROM messages 
-            WHERE agent_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT 20
+            SELECT role, content, timestamp FROM (
+                SELECT role, content, timestamp FROM messages 
+                WHERE agent_id = ? 
+                ORDER BY timestamp DESC 
+                LIMIT 20
+            ) ORDER BY timestamp ASC
         """
         
         rows = await db_manager.execute_query(messages_query, (parent_agent_id,))
@@ -79,13 +126,7 @@ class AgentManager:
         if not rows:
             return {}
         
-        messages = []
-        for row in reversed(rows):  # 按时间顺序排列
-            messages.append({
-                "role": row[0],
-                "content": row[1],
-                "timestamp": row[2]
-            })
+        messages = [dict(row) for row in rows]
         
         if inheritance_mode == "full":
             return {
@@ -145,101 +186,47 @@ class AgentManager:
     async def build_agent_hierarchy(self, root_agent_id: str) -> AgentHierarchyNode:
         """构建Agent层级结构"""
         
-        # 获取根Agent信息
-        root_query = "SELECT * FROM agents WHERE id = ?"
-        root_row = await db_manager.execute_one(root_query, (root_agent_id,))
+        # 一次递归查询取回整棵子树，按深度排序保证父节点先于子节点出现
+        rows = await db_manager.execute_query(HIERARCHY_QUERY, (root_agent_id,))
         
-        if not root_row:
+        if not rows:
             raise ValueError(f"Agent {root_agent_id} 不存在")
         
-        # 递归构建层级结构
-        return await self._build_hierarchy_recursive(root_row)
-    
-    async def _build_hierarchy_recursive(self, agent_row) -> AgentHierarchyNode:
-        """递归构建层级结构"""
-        agent_id = agent_row[0]
-        
-        # 创建当前节点
-        node = AgentHierarchyNode(
-            id=agent_id,
-            parent_id=agent_row[2],
-            agent_type=agent_row[3],
-            topic=agent_row[4],
-            level=agent_row[6],
-            status=agent_row[7],
-            children=[]
-        )
-        
-        # 获取子Agent
-        children_query = "SELECT * FROM agents WHERE parent_id = ? ORDER BY created_at"
-        children_rows = await db_manager.execute_query(children_query, (agent_id,))
-        
-        # 递归构建子节点
-        for child_row in children_rows:
-            child_node = await self._build_hierarchy_recursive(child_row)
-            node.children.append(child_node)
-        
-        return node
-    
-    async def delete_agent_recursive(self, agent_id: str):
-        """递归删除Agent及其所有子Agent"""
-        
-        # 获取所有子Agent
-        children_query = "SELECT id FROM agents WHERE parent_id = ?"
-        children_rows = await db_manager.execute_query(children_query, (agent_id,))
-        
-        # 递归删除子Agent
-        for child_row in children_rows:
-            await self.delete_agent_recursive(child_row[0])
-        
-        # 删除当前Agent的消息
-        await db_manager.execute_update(
-            "DELETE FROM messages WHERE agent_id = ?",
-            (agent_id,)
-        )
-        
-        # 删除当前Agent的栈帧
-        await db_manager.execute_update(
-            "DELETE FROM agent_stack_frames WHERE agent_id = ?",
-            (agent_id,)
-        )
-        
-        # 删除当前Agent
-        await db_manager.execute_update(
-            "DELETE FROM agents WHERE id = ?",
-            (agent_id,)
-        )
+        # 单次遍历组装层级结构
+        nodes: Dict[str, AgentHierarchyNode] = {}
+        for row in rows:
+            node = hierarchy_node_from_row(row)
+            nodes[node.id] = node
+            
+            parent = nodes.get(node.parent_id) if node.id != root_agent_id else None
+            if parent:
+                parent.children.append(node)
         
-        # 从内存缓存中移除
-        if agent_id in self.active_frames:
-            del self.active_frames[agent_id]
+        return nodes[root_agent_id]
     
     async def suspend_agent_frame(self, agent_id: str):
         """挂起Agent栈帧"""
-        await db_manager.execute_update(
-            "UPDATE agent_stack_frames SET status = 'suspended', updated_at = ? WHERE agent_id = ?",
-            (datetime.now().isoformat(), agent_id)
-        )
+        await db_manager.execute_update(FRAME_STATUS_UPDATE_QUERY, ("suspended", agent_id))
         
-        if agent_id in self.active_frames:
-            self.active_frames[agent_id]["status"] = "suspended"
+        context = self._cache_get(agent_id)
+        if context is not None:
+            context["status"] = "suspended"
     
     async def resume_agent_frame(self, agent_id: str):
         """恢复Agent栈帧"""
-        await db_manager.execute_update(
-            "UPDATE agent_stack_frames SET status = 'active', updated_at = ? WHERE agent_id = ?",
-            (datetime.now().isoformat(), agent_id)
-        )
+        await db_manager.execute_update(FRAME_STATUS_UPDATE_QUERY, ("active", agent_id))
         
-        if agent_id in self.active_frames:
-            self.active_frames[agent_id]["status"] = "active"
+        context = self._cache_get(agent_id)
+        if context is not None:
+            context["status"] = "active"
     
     async def get_agent_context(self, agent_id: str) -> Dict[str, Any]:
         """获取Agent的完整上下文"""
         
         # 先从内存缓存获取
-        if agent_id in self.active_frames:
-            return self.active_frames[agent_id]
+        cached = self._cache_get(agent_id)
+        if cached is not None:
+            return cached
         
         # 从数据库获取
         frame_query = """
@@ -256,92 +243,77 @@ class AgentManager:
             return {}
         
         context = {
-            "context_data": json.loads(frame_row[0]) if frame_row[0] else {},
-            "inherited_context": json.loads(frame_row[1]) if frame_row[1] else {},
-            "stack_depth": frame_row[2],
-            "status": frame_row[3]
+            "context_data": _load_json(frame_row["context_data"]),
+            "inherited_context": _load_json(frame_row["inherited_context"]),
+            "stack_depth": frame_row["stack_depth"],
+            "status": frame_row["status"]
         }
         
         # 缓存到内存
-        self.active_frames[agent_id] = context
+        self._cache_set(agent_id, context)
         
         return context
     
     async def update_agent_context(self, agent_id: str, context_data: Dict[str, Any]):
         """更新Agent上下文"""
-        current_time = datetime.now().isoformat()
-        
         # 更新数据库
-        await db_manager.execute_update(
-            "UPDATE agent_stack_frames SET context_data = ?, updated_at = ? WHERE agent_id = ?",
-            (json.dumps(context_data), current_time, agent_id)
-        )
+        await db_manager.execute_update(FRAME_CONTEXT_UPDATE_QUERY, (dumps(context_data), agent_id))
         
         # 更新内存缓存
-        if agent_id in self.active_frames:
-            self.active_frames[agent_id]["context_data"] = context_data
+        context = self._cache_get(agent_id)
+        if context is not None:
+            context["context_data"] = context_data
     
     def calculate_message_relevance(self, message: str, branch_topic: str) -> float:
         """计算消息与分支话题的相关性（简化版本）"""
-        # 简单的关键词匹配
-        message_lower = message.lower()
-        topic_lower = branch_topic.lower()
-        
-        # 计算关键词重叠度
-        topic_words = set(topic_lower.split())
-        message_words = set(message_lower.split())
-        
+        # 话题分词按话题缓存，同一分支的多条消息复用
+        topic_words = _topic_tokens(branch_topic)
         if not topic_words:
             return 0.0
         
-        overlap = len(topic_words.intersection(message_words))
-        keyword_score = overlap / len(topic_words)
+        message_lower = message.lower()
+        message_words = set(message_lower.split())
         
-        # 简单的语义相似度（基于包含关系）
-        semantic_score = 0.0
+        # 单次遍历同时统计两种匹配：
+        # 关键词重叠（完整单词）和语义相似度（包含关系，完整单词必然也被包含）
+        keyword_hits = 0
+        semantic_hits = 0
         for word in topic_words:
-            if word in message_lower:
-                semantic_score += 1.0
-        
-        semantic_score = semantic_score / len(topic_words) if topic_words else 0.0
+            if word in message_words:
+                keyword_hits += 1
+                semantic_hits += 1
+            elif word in message_lower:
+                semantic_hits += 1
         
         # 综合评分
-        return 0.6 * semantic_score + 0.4 * keyword_score
+        return (0.6 * semantic_hits + 0.4 * keyword_hits) / len(topic_words)
     
     async def get_session_hierarchy(self, session_id: str) -> List[AgentHierarchyNode]:
         """获取会话的完整Agent层级结构"""
         
-        # 获取会话中的所有Agent
-        agents_query = "SELECT * FROM agents WHERE session_id = ? ORDER BY stack_depth, created_at"
-        agent_rows = await db_manager.execute_query(agents_query, (session_id,))
+        # 递归查询会话中的Agent树，父节点总在子节点之前返回
+        agent_rows = await db_manager.execute_query(SESSION_TREE_QUERY, (session_id,))
         
         if not agent_rows:
             return []
         
-        # 构建Agent字典
+        # 单次遍历构建层级结构
         agents_dict = {}
         root_agents = []
         
         for row in agent_rows:
-            node = AgentHierarchyNode(
-                id=row[0],
-                parent_id=row[2],
-                agent_type=row[3],
-                topic=row[4],
-                level=row[6],
-                status=row[7],
-                children=[]
-            )
+            node = hierarchy_node_from_row(row)
             
             agents_dict[node.id] = node
             
-            # 如果没有父Agent，则为根Agent
-            if not node.parent_id:
+            # 如果没有父Agent，则为根Agent；否则父节点已先出现，直接挂载
+            if node.parent_id:
+                agents_dict[node.parent_id].children.append(node)
+            else:
                 root_agents.append(node)
         
-        # 建立父子关系
-        for agent in agents_dict.values():
-            if agent.parent_id and agent.parent_id in agents_dict:
-                agents_dict[agent.parent_id].children.append(agent)
-        
-        return root_agents
\ No newline at end of file
+        return root_agents
+
+
+# 全局实例
+agent_manager = AgentManager()
@@ -1,9 +1,78 @@
 from typing import Dict, List, Optional, Any, Tuple
 import re
-import json
 from datetime import datetime
-from collections import Counter
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
 import math
+import heapq
+
+
+# 预编译的正则表达式：模块加载时编译一次，避免每次调用查询re模块的模式缓存
+_RE_WORD = re.compile(r'\b\w+\b')
+_RE_KEYWORD = re.compile(r'\b\w{3,}\b')  # 长度至少为3的词
+_RE_CODE = re.compile(r'```[\s\S]*?```|`[^`]+`')  # 代码块或行内代码
+# 结构化元素：列表项、编号列表、代码块、粗体，合并为一个正则一次扫描
+_RE_STRUCTURE = re.compile(
+    r'^\s*[-*+]\s'  # 列表项
+    r'|^\s*\d+\.\s'  # 编号列表
+    r'|```[\s\S]*?```'  # 代码块
+    r'|\*\*[^*]+\*\*|__[^_]+__',  # 粗体
+    re.MULTILINE
+)
+_RE_CAP = re.compile(r'\b[A-Z][a-z]+\b')  # 大写开头的词
+_RE_CAMEL = re.compile(r'\b[a-zA-Z]+(?:[A-Z][a-z]*)+\b')  # CamelCase技术术语
+
+
+# 停用词列表（简化版）
+_STOP_WORDS = frozenset({
+    '的', '了', '在', '是', '我', '有', '和', '就', '不', '人', '都', '一', '一个', '上', '也', '很', '到', '说', '要', '去', '你', '会', '着', '没有', '看', '好', '自己', '这', '那', '什么', '可以', '这个', '那个', '怎么', '为什么', '如何',
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'can', 'this', 'that', 'these', 'those', 'i', 'you', 'he', 'she', 'it', 'we', 'they', 'me', 'him', 'her', 'us', 'them'
+})
+
+# 重要性权重词汇
+_IMPORTANCE_KEYWORDS = {
+    '问题': 2.0, '解决': 2.0, '方法': 1.8, '原理': 1.8, '实现': 1.5, '设计': 1.5,
+    '算法': 2.0, '架构': 1.8, '系统': 1.5, '功能': 1.3, '特性': 1.3, '优化': 1.5,
+    'problem': 2.0, 'solution': 2.0, 'method': 1.8, 'principle': 1.8, 'implement': 1.5, 'design': 1.5,
+    'algorithm': 2.0, 'architecture': 1.8, 'system': 1.5, 'function': 1.3, 'feature': 1.3, 'optimize': 1.5
+}
+
+_IMPORTANCE_WORD_KEYWORDS = {k: w for k, w in _IMPORTANCE_KEYWORDS.items() if k.isascii()}
+_IMPORTANCE_CJK_KEYWORDS = tuple((k, w) for k, w in _IMPORTANCE_KEYWORDS.items() if not k.isascii())
+
+# 相关性各分项的权重
+_WEIGHT_LEXICAL = 0.25
+_WEIGHT_SEMANTIC = 0.25
+_WEIGHT_IMPORTANCE = 0.20
+_WEIGHT_CONTEXT = 0.15
+_WEIGHT_STRUCTURE = 0.15
+
+
+def _combine_scores(lexical: float, semantic: float, importance: float, context: float, structure: float) -> float:
+    """按权重合成相关性得分，上限为1"""
+    return min(1.0, (
+        _WEIGHT_LEXICAL * lexical +
+        _WEIGHT_SEMANTIC * semantic +
+        _WEIGHT_IMPORTANCE * importance +
+        _WEIGHT_CONTEXT * context +
+        _WEIGHT_STRUCTURE * structure
+    ))
+
+
+@dataclass(slots=True)
+class TextFeatures:
+    """一段文本的相关性特征：每段文本只分词一次，在多次相似度计算中复用"""
+    keywords: frozenset
+    phrases: Tuple[str, ...]
+    concepts: frozenset
+    importance: float
+    structure: float
+
+
+# 文本特征的LRU缓存：同一对话的消息在多次上下文选择中反复出现，命中时跳过分词。
+# 缓存的特征为不可变集合/元组，可在多次调用间安全共享
+_FEATURE_CACHE_MAX = 2048
+_feature_cache: "OrderedDict[str, TextFeatures]" = OrderedDict()
 
 
 class ContextProcessor:
@@ -17,20 +86,12 @@ class ContextProcessor:
     - 关键信息提取
     """
     
-    def __init__(self):
-        # 停用词列表（简化版）
-        self.stop_words = {
-            '的', '了', '在', '是', '我', '有', '和', '就', '不', '人', '都', '一', '一个', '上', '也', '很', '到', '说', '要', '去', '你', '会', '着', '没有', '看', '好', '自己', '这', '那', '什么', '可以', '这个', '那个', '怎么', '为什么', '如何',
-            'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'can', 'this', 'that', 'these', 'those', 'i', 'you', 'he', 'she', 'it', 'we', 'they', 'me', 'him', 'her', 'us', 'them'
-        }
-        
-        # 重要性权重词汇
-        self.importance_keywords = {
-            '问题': 2.0, '解决': 2.0, '方法': 1.8, '原理': 1.8, '实现': 1.5, '设计': 1.5,
-            '算法': 2.0, '架构': 1.8, '系统': 1.5, '功能': 1.3, '特性': 1.3, '优化': 1.5,
-            'problem': 2.0, 'solution': 2.0, 'method': 1.8, 'principle': 1.8, 'implement': 1.5, 'design': 1.5,
-            'algorithm': 2.0, 'architecture': 1.8, 'system': 1.5, 'function': 1.3, 'feature': 1.3, 'optimize': 1.5
-        }
+    # 处理器不保存实例状态，不需要__dict__
+    __slots__ = ()
+    
+    # 停用词和重要性权重词汇为只读的模块级常量，所有实例共享
+    stop_words = _STOP_WORDS
+    importance_keywords = _IMPORTANCE_KEYWORDS
     
     def calculate_advanced_relevance(self, message_content: str, topic: str, context_messages: List[Dict] = None) -> float:
         """
@@ -47,41 +108,92 @@ class ContextProcessor:
         if not message_content or not topic:
             return 0.0
         
+        context_features = None
+        if context_messages:
+            context_features = [
+                self._featurize(content)
+                for content in (msg.get('content', '') for msg in context_messages[-3:])
+                if content
+            ]
+        
+        return self._relevance_from_features(
+            self._featurize(message_content), self._featurize(topic), context_features
+        )
+    
+    def _featurize(self, text: str) -> TextFeatures:
+        """
+        提取文本的全部相关性特征
+        
+        Args:
+            text: 文本内容
+            
+        Returns:
+            文本特征
+        """
+        cached = _feature_cache.get(text)
+        if cached is not None:
+            _feature_cache.move_to_end(text)
+            return cached
+        
+        # 只转小写、分词一次，关键词、短语和重要性都由同一份词列表得到
+        text_lower = text.lower()
+        words = _RE_WORD.findall(text_lower)
+        word_set = set(words)
+        
+        features = TextFeatures(
+            keywords=frozenset(word for word in word_set if len(word) > 2 and word not in _STOP_WORDS),
+            phrases=tuple(self._phrases_from_words(words)),
+            concepts=frozenset(self._extract_concepts(text)),
+            importance=self._importance_from_tokens(text, text_lower, word_set),
+            structure=self._calculate_structure_weight(text)
+        )
+        
+        _feature_cache[text] = features
+        if len(_feature_cache) > _FEATURE_CACHE_MAX:
+            _feature_cache.popitem(last=False)
+        
+        return features
+    
+    def _relevance_from_features(
+        self,
+        message: TextFeatures,
+        topic: TextFeatures,
+        context: Optional[List[TextFeatures]] = None
+    ) -> float:
+        """
+        基于预先提取的特征计算相关性
+        
+        Args:
+            message: 消息特征
+            topic: 主题特征
+            context: 最近几条上下文消息的特征（可选）
+            
+        Returns:
+            相关性得分 (0-1)
+        """
         # 1. 基础词汇相似度
-        lexical_score = self._calculate_lexical_similarity(message_content, topic)
+        lexical_score = self._keyword_similarity(message.keywords, topic.keywords)
         
         # 2. 语义相似度（基于词汇共现）
-        semantic_score = self._calculate_semantic_similarity(message_content, topic)
+        semantic_score = self._phrase_concept_similarity(
+            message.phrases, message.concepts, topic.phrases, topic.concepts
+        )
         
         # 3. 重要性权重
-        importance_score = self._calculate_importance_weight(message_content)
+        importance_score = message.importance
         
         # 4. 上下文连贯性（如果提供了上下文）
         context_score = 0.0
-        if context_messages:
-            context_score = self._calculate_context_coherence(message_content, context_messages)
+        if context:
+            context_score = sum(
+                self._keyword_similarity(message.keywords, ctx.keywords) for ctx in context
+            ) / len(context)
         
         # 5. 长度和结构权重
-        structure_score = self._calculate_structure_weight(message_content)
+        structure_score = message.structure
         
         # 综合评分
-        weights = {
-            'lexical': 0.25,
-            'semantic': 0.25,
-            'importance': 0.20,
-            'context': 0.15,
-            'structure': 0.15
-        }
-        
-        final_score = (
-            weights['lexical'] * lexical_score +
-            weights['semantic'] * semantic_score +
-            weights['importance'] * importance_score +
-            weights['context'] * context_score +
-            weights['structure'] * structure_score
-        )
-        
-        return min(1.0, final_score)
+        return _combine_scores(lexical_score, semantic_score, importance_score, context_score, structure_score)
     
     def _calculate_lexical_similarity(self, text1: str, text2: str) -> float:
         """
@@ -94,24 +206,24 @@ class ContextProcessor:
         Returns:
             词汇相似度得分
         """
-        words1 = self._extract_keywords(text1.lower())
-        words2 = self._extract_keywords(text2.lower())
-        
+        return self._keyword_similarity(
+            self._extract_keywords(text1.lower()), self._extract_keywords(text2.lower())
+        )
+    
+    def _keyword_similarity(self, words1: set, words2: set) -> float:
+        """基于关键词集合计算词汇相似度（Jaccard与余弦的平均）"""
         if not words1 or not words2:
             return 0.0
         
-        # 计算Jaccard相似度
-        intersection = len(words1.intersection(words2))
-        union = len(words1.union(words2))
+        # 计算Jaccard相似度（并集大小由容斥得到，不构造并集）
+        intersection = len(words1 & words2)
+        union = len(words1) + len(words2) - intersection
         
-        jaccard_score = intersection / union if union > 0 else 0.0
+        jaccard_score = intersection / union
         
-        # 计算余弦相似度（基于词频）
-        all_words = words1.union(words2)
-        vector1 = [1 if word in words1 else 0 for word in all_words]
-        vector2 = [1 if word in words2 else 0 for word in all_words]
-        
-        cosine_score = self._cosine_similarity(vector1, vector2)
+        # 计算余弦相似度：二值词袋向量的点积即交集大小，模长即集合大小的平方根，
+        # 无需按并集展开向量
+        cosine_score = intersection / math.sqrt(len(words1) * len(words2))
         
         return (jaccard_score + cosine_score) / 2
     
@@ -126,29 +238,24 @@ class ContextProcessor:
         Returns:
             语义相似度得分
         """
-        # 提取关键短语
-        phrases1 = self._extract_key_phrases(text1)
-        phrases2 = self._extract_key_phrases(text2)
-        
+        return self._phrase_concept_similarity(
+            self._extract_key_phrases(text1), self._extract_concepts(text1),
+            self._extract_key_phrases(text2), self._extract_concepts(text2)
+        )
+    
+    def _phrase_concept_similarity(
+        self, phrases1: List[str], concepts1: set, phrases2: List[str], concepts2: set
+    ) -> float:
+        """基于关键短语和概念计算语义相似度"""
         if not phrases1 or not phrases2:
             return 0.0
         
-        # 计算短语匹配度
-        matches = 0
-        total_comparisons = 0
-        
-        for phrase1 in phrases1:
-            for phrase2 in phrases2:
-                total_comparisons += 1
-                if self._phrases_similar(phrase1, phrase2):
-                    matches += 1
-        
-        phrase_similarity = matches / total_comparisons if total_comparisons > 0 else 0.0
+        # 计算短语匹配度：Bi-Gram相似度 2·|Bi(T1) ∩ Bi(T2)| / (|Bi(T1)| + |Bi(T2)|)，
+        # 多重集交集由Counter直接求得
+        common = Counter(phrases1) & Counter(phrases2)
+        phrase_similarity = 2 * sum(common.values()) / (len(phrases1) + len(phrases2))
         
         # 计算概念重叠度
-        concepts1 = self._extract_concepts(text1)
-        concepts2 = self._extract_concepts(text2)
-        
         concept_overlap = len(concepts1.intersection(concepts2)) / len(concepts1.union(concepts2)) if concepts1.union(concepts2) else 0.0
         
         return (phrase_similarity + concept_overlap) / 2
@@ -164,21 +271,25 @@ class ContextProcessor:
             重要性权重得分
         """
         text_lower = text.lower()
-        importance_score = 0.0
-        word_count = 0
-        
-        # 检查重要性关键词
-        for keyword, weight in self.importance_keywords.items():
-            if keyword in text_lower:
-                importance_score += weight
-                word_count += 1
+        return self._importance_from_tokens(text, text_lower, set(_RE_WORD.findall(text_lower)))
+    
+    def _importance_from_tokens(self, text: str, text_lower: str, word_set: set) -> float:
+        """基于已分词的文本计算重要性权重"""
+        # 检查重要性关键词（每个关键词至多计一次）：
+        # 英文关键词按完整单词匹配，一次分词后做集合查找（"system"不再匹配"systematic"）；
+        # 中文没有词边界，仍按子串匹配
+        matched_words = _IMPORTANCE_WORD_KEYWORDS.keys() & word_set
+        importance_score = sum(_IMPORTANCE_WORD_KEYWORDS[word] for word in matched_words)
+        importance_score += sum(
+            weight for keyword, weight in _IMPORTANCE_CJK_KEYWORDS if keyword in text_lower
+        )
         
         # 检查问号（问题通常更重要）
         question_count = text.count('?') + text.count('？')
         importance_score += question_count * 0.5
         
         # 检查代码块（技术内容更重要）
-        code_blocks = len(re.findall(r'```[\s\S]*?```|`[^`]+`', text))
+        code_blocks = len(_RE_CODE.findall(text))
         importance_score += code_blocks * 0.3
         
         # 标准化得分
@@ -238,11 +349,7 @@ class ContextProcessor:
             length_score = 0.6
         
         # 结构复杂度（包含列表、代码等结构化内容）
-        structure_elements = 0
-        structure_elements += len(re.findall(r'^\s*[-*+]\s', text, re.MULTILINE))  # 列表项
-        structure_elements += len(re.findall(r'^\s*\d+\.\s', text, re.MULTILINE))  # 编号列表
-        structure_elements += len(re.findall(r'```[\s\S]*?```', text))  # 代码块
-        structure_elements += len(re.findall(r'\*\*[^*]+\*\*|__[^_]+__', text))  # 粗体
+        structure_elements = sum(1 for _ in _RE_STRUCTURE.finditer(text))
         
         structure_score = min(1.0, structure_elements * 0.2)
         
@@ -320,14 +427,21 @@ class ContextProcessor:
         if len(messages) <= max_count:
             return messages
         
+        # 每条消息和主题只提取一次特征，后续相似度计算都复用
+        contents = [msg.get('content', '') for msg in messages]
+        features = [self._featurize(content) for content in contents]
+        topic_features = self._featurize(topic) if topic else None
+        
         # 计算每条消息的综合得分
         scored_messages = []
         
         for i, msg in enumerate(messages):
-            content = msg.get('content', '')
-            
-            # 相关性得分
-            relevance_score = self.calculate_advanced_relevance(content, topic, messages[:i])
+            # 相关性得分（上下文为此前最近3条非空消息）
+            if not contents[i] or topic_features is None:
+                relevance_score = 0.0
+            else:
+                context = [features[j] for j in range(max(0, i - 3), i) if contents[j]]
+                relevance_score = self._relevance_from_features(features[i], topic_features, context)
             
             # 位置权重（最近的消息更重要）
             position_weight = (i + 1) / len(messages)
@@ -340,36 +454,30 @@ class ContextProcessor:
             
             scored_messages.append((msg, total_score, i))
         
-        # 按得分排序
-        scored_messages.sort(key=lambda x: x[1], reverse=True)
+        # 只取得分最高的max_count条（O(N log K)），不对全部消息排序
+        selected_with_indices = heapq.nlargest(max_count, scored_messages, key=lambda x: x[1])
         
         # 选择最优消息，保持时间顺序
-        selected_with_indices = scored_messages[:max_count]
         selected_with_indices.sort(key=lambda x: x[2])  # 按原始索引排序
         
         return [msg for msg, score, idx in selected_with_indices]
     
     def _extract_keywords(self, text: str) -> set:
         """提取关键词"""
-        # 简单的分词和过滤
-        words = re.findall(r'\b\w+\b', text.lower())
-        keywords = set()
-        
-        for word in words:
-            if len(word) > 2 and word not in self.stop_words:
-                keywords.add(word)
-        
-        return keywords
+        # 简单的分词和过滤：长度不足3的词由正则直接跳过
+        return {word for word in _RE_KEYWORD.findall(text.lower()) if word not in _STOP_WORDS}
     
     def _extract_key_phrases(self, text: str) -> List[str]:
         """提取关键短语"""
-        # 简单的短语提取（2-3个词的组合）
-        words = re.findall(r'\b\w+\b', text.lower())
+        return self._phrases_from_words(_RE_WORD.findall(text.lower()))
+    
+    def _phrases_from_words(self, words: List[str]) -> List[str]:
+        """由分词结果组合关键短语（相邻两个非停用词）"""
         phrases = []
         
-        for i in range(len(words) - 1):
-            if words[i] not in self.stop_words and words[i+1] not in self.stop_words:
-                phrases.append(f"{words[i]} {words[i+1]}")
+        for first, second in zip(words, words[1:]):
+            if first not in _STOP_WORDS and second not in _STOP_WORDS:
+                phrases.append(f"{first} {second}")
         
         return phrases
     
@@ -379,11 +487,11 @@ class ContextProcessor:
         concepts = set()
         
         # 大写开头的词
-        capitalized_words = re.findall(r'\b[A-Z][a-z]+\b', text)
+        capitalized_words = _RE_CAP.findall(text)
         concepts.update(capitalized_words)
         
         # 技术术语模式
-        tech_terms = re.findall(r'\b[a-zA-Z]+(?:[A-Z][a-z]*)+\b', text)  # CamelCase
+        tech_terms = _RE_CAMEL.findall(text)  # CamelCase
         concepts.update(tech_terms)
         
         return concepts
@@ -406,22 +514,31 @@ class ContextProcessor:
         if not vec1 or not vec2 or len(vec1) != len(vec2):
             return 0.0
         
-        dot_product = sum(a * b for a, b in zip(vec1, vec2))
-        magnitude1 = math.sqrt(sum(a * a for a in vec1))
-        magnitude2 = math.sqrt(sum(b * b for b in vec2))
+        # 点积和两个模长在同一次遍历中累加
+        dot_product = norm1 = norm2 = 0.0
+        for a, b in zip(vec1, vec2):
+            dot_product += a * b
+            norm1 += a * a
+            norm2 += b * b
         
-        if magnitude1 == 0 or magnitude2 == 0:
+        if norm1 == 0 or norm2 == 0:
             return 0.0
         
-        return dot_product / (magnitude1 * magnitude2)
+        return dot_product / (math.sqrt(norm1) * math.sqrt(norm2))
     
     def _extract_key_messages(self, messages: List[Dict], topic: str) -> List[Dict]:
         """提取关键消息"""
         key_messages = []
+        if not topic:
+            return key_messages
         
+        # 主题特征只提取一次
+        topic_features = self._featurize(topic)
         for msg in messages:
             content = msg.get('content', '')
-            relevance = self.calculate_advanced_relevance(content, topic)
+            if not content:
+                continue
+            relevance = self._relevance_from_features(self._featurize(content), topic_features)
             
             if relevance > 0.3:  # 相关性阈值
                 key_messages.append(msg)
@@ -443,10 +560,7 @@ class ContextProcessor:
         """提取问答对"""
         qa_pairs = []
         
-        for i in range(len(messages) - 1):
-            current_msg = messages[i]
-            next_msg = messages[i + 1]
-            
+        for current_msg, next_msg in zip(messages, messages[1:]):
             if (current_msg.get('role') == 'user' and 
                 next_msg.get('role') == 'assistant'):
                 
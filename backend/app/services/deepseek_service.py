@@ -1,9 +1,51 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
 import asyncio
-from typing import List, Dict, Any, Optional
-from datetime import datetime
+import hashlib
+import time
+from typing import List, Dict, Any, Optional, AsyncIterator
+from functools import lru_cache
 
 from app.core.config import settings, DEEPSEEK_CONFIG
+from app.core.cache import ResponseCache
+from app.core.clock import now_iso
+from app.core.http_client import get_http_client
+
+
+# API接受的消息角色与字段
+_ALLOWED_ROLES = frozenset({"user", "assistant", "system"})
+_MESSAGE_KEYS = frozenset({"role", "content"})
+
+# 提示词模板：模块加载时构造一次，调用时只做format
+_SUMMARY_TMPL = """
+        请为以下对话生成一个简洁的摘要，突出关键讨论点和重要信息。
+        摘要长度不超过{max_length}字符。
+        
+        对话内容：
+        {conversation_text}
+        
+        摘要：
+        """
+
+_BRANCH_TMPL = """
+        你是一个专门探讨"{topic}"的学习助手。
+        
+        你的任务是：
+        1. 专注于深入探讨"{topic}"这个特定话题
+        2. 提供详细、准确的解释和分析
+        3. 结合上下文信息，给出针对性的回答
+        4. 保持专业性和准确性
+        
+        上下文信息：
+        {parent_context}
+        
+        请基于以上上下文，专注于"{topic}"话题进行深入讨论。
+        """.strip()
+
+
+@lru_cache(maxsize=1024)
+def _branch_prompt(branch_topic: str, parent_context: str) -> str:
+    """生成分支提示词（纯函数，相同参数直接返回缓存结果）"""
+    return _BRANCH_TMPL.format(topic=branch_topic, parent_context=parent_context)
 
 
 class DeepseekService:
@@ -24,11 +66,23 @@ class DeepseekService:
         self.max_tokens = DEEPSEEK_CONFIG["max_tokens"]
         self.temperature = DEEPSEEK_CONFIG["temperature"]
         
+        # 限制同时在途的API请求数，避免突发流量触发限流
+        self._sem = asyncio.Semaphore(DEEPSEEK_CONFIG.get("max_concurrency", 8))
+        # 摘要结果按对话内容哈希缓存，相同对话窗口重复请求时不再调用API
+        self._summary_cache = ResponseCache(ttl_seconds=600, max_entries=512)
+        # 健康检查结果缓存：探测请求会产生计费调用，短时间内重复检查直接返回上次结果
+        self._health_cache: Optional[Dict[str, Any]] = None
+        self._health_cache_ts = 0.0
+        self._health_cache_ttl = 30
+        
         if self.api_key:
-            # 使用OpenAI客户端，配置为Deepseek的API（按照官方样例）
-            self.client = OpenAI(
+            # 使用OpenAI异步客户端，配置为Deepseek的API（按照官方样例）；
+            # 所有请求共享同一个客户端及其连接池，无需占用线程
+            self.client = AsyncOpenAI(
                 api_key=self.api_key,
-                base_url=self.base_url  # Deepseek官方base_url已包含完整路径
+                base_url=self.base_url,  # Deepseek官方base_url已包含完整路径
+                timeout=60,
+                http_client=get_http_client()
             )
         else:
             self.client = None
@@ -54,22 +108,7 @@ class DeepseekService:
         max_tokens = max_tokens or self.max_tokens
         
         # 构建消息列表
-        api_messages = []
-        
-        # 添加系统提示词
-        if system_prompt:
-            api_messages.append({
-                "role": "system",
-                "content": system_prompt
-            })
-        
-        # 添加对话历史
-        for msg in messages:
-            if msg["role"] in ["user", "assistant", "system"]:
-                api_messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
+        api_messages = self._build_api_messages(messages, system_prompt)
         
         try:
             # 调用Deepseek API（使用OpenAI兼容格式）
@@ -85,7 +124,7 @@ class DeepseekService:
                 "model": model,
                 "usage": response.get("usage", {}),
                 "finish_reason": response["choices"][0].get("finish_reason"),
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
             
         except Exception as e:
@@ -93,26 +132,98 @@ class DeepseekService:
             error_type = type(e).__name__
             error_message = str(e)
             
-            # 根据错误类型提供更友好的提示
-            if "timeout" in error_message.lower():
-                user_message = "抱歉，AI服务响应超时，请稍后重试。"
-            elif "api_key" in error_message.lower() or "unauthorized" in error_message.lower():
-                user_message = "抱歉，API密钥配置有误，请检查配置。"
-            elif "rate_limit" in error_message.lower():
-                user_message = "抱歉，请求过于频繁，请稍后重试。"
-            else:
-                user_message = f"抱歉，AI服务暂时不可用。错误信息: {error_message}"
-            
             return {
-                "content": user_message,
+                "content": self._friendly_error_message(e),
                 "model": model,
                 "usage": {},
                 "finish_reason": "error",
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": now_iso(),
                 "error": error_message,
                 "error_type": error_type
             }
     
+    async def stream_response(
+        self, 
+        messages: List[Dict[str, str]], 
+        system_prompt: str = None,
+        agent_context: Dict[str, Any] = None,
+        model: str = None,
+        temperature: float = None,
+        max_tokens: int = None
+    ) -> AsyncIterator[str]:
+        """流式生成AI回复，逐块产出文本增量"""
+        
+        if not self.api_key:
+            raise Exception("Deepseek API Key未配置")
+        
+        model = model or self.model
+        temperature = temperature if temperature is not None else self.temperature
+        max_tokens = max_tokens or self.max_tokens
+        
+        api_messages = self._build_api_messages(messages, system_prompt)
+        
+        try:
+            async with self._sem:
+                stream = await self.client.chat.completions.create(
+                    model=model,
+                    messages=api_messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+                
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+                    
+        except Exception as e:
+            # 与非流式接口一致，以友好提示作为回复内容
+            yield self._friendly_error_message(e)
+    
+    def _build_api_messages(
+        self,
+        messages: List[Dict[str, str]],
+        system_prompt: Optional[str]
+    ) -> List[Dict[str, str]]:
+        """构建发送给API的消息列表"""
+        # 常见情况：消息恰好只含role和content且角色合法，直接复用输入列表，不逐条复制
+        if all(msg.keys() == _MESSAGE_KEYS and msg["role"] in _ALLOWED_ROLES for msg in messages):
+            if not system_prompt:
+                return messages
+            return [{"role": "system", "content": system_prompt}, *messages]
+        
+        api_messages = []
+        
+        # 添加系统提示词
+        if system_prompt:
+            api_messages.append({
+                "role": "system",
+                "content": system_prompt
+            })
+        
+        # 添加对话历史
+        for msg in messages:
+            if msg["role"] in _ALLOWED_ROLES:
+                api_messages.append({
+                    "role": msg["role"],
+                    "content": msg["content"]
+                })
+        
+        return api_messages
+    
+    def _friendly_error_message(self, error: Exception) -> str:
+        """根据错误类型提供更友好的提示"""
+        error_message = str(error)
+        
+        if "timeout" in error_message.lower():
+            return "抱歉，AI服务响应超时，请稍后重试。"
+        elif "api_key" in error_message.lower() or "unauthorized" in error_message.lower():
+            return "抱歉，API密钥配置有误，请检查配置。"
+        elif "rate_limit" in error_message.lower():
+            return "抱歉，请求过于频繁，请稍后重试。"
+        else:
+            return f"抱歉，AI服务暂时不可用。错误信息: {error_message}"
+    
     async def _call_deepseek_api(
         self,
         messages: List[Dict[str, str]],
@@ -125,39 +236,32 @@ class DeepseekService:
         if not self.client:
             raise Exception("Deepseek客户端未初始化")
         
-        # 使用asyncio在线程池中运行同步的API调用
-        loop = asyncio.get_event_loop()
-        
-        def sync_deepseek_call():
-            # 按照Deepseek官方样例进行API调用
-            response = self.client.chat.completions.create(
+        # 按照Deepseek官方样例进行API调用，信号量限制并发请求数
+        async with self._sem:
+            response = await self.client.chat.completions.create(
                 model=model,
                 messages=messages,
                 temperature=temperature,
                 max_tokens=max_tokens,
-                stream=False,  # 明确设置为非流式，与官方样例一致
-                timeout=60
+                stream=False  # 明确设置为非流式，与官方样例一致
             )
-            
-            # 直接返回响应对象，简化转换逻辑
-            return {
-                "choices": [{
-                    "message": {
-                        "content": response.choices[0].message.content,
-                        "role": response.choices[0].message.role
-                    },
-                    "finish_reason": response.choices[0].finish_reason
-                }],
-                "usage": {
-                    "prompt_tokens": response.usage.prompt_tokens if response.usage else 0,
-                    "completion_tokens": response.usage.completion_tokens if response.usage else 0,
-                    "total_tokens": response.usage.total_tokens if response.usage else 0
-                } if response.usage else {},
-                "model": response.model if hasattr(response, 'model') else model
-            }
         
-        response = await loop.run_in_executor(None, sync_deepseek_call)
-        return response
+        # 直接返回响应对象，简化转换逻辑
+        return {
+            "choices": [{
+                "message": {
+                    "content": response.choices[0].message.content,
+                    "role": response.choices[0].message.role
+                },
+                "finish_reason": response.choices[0].finish_reason
+            }],
+            "usage": {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens,
+                "total_tokens": response.usage.total_tokens
+            } if response.usage else {},
+            "model": response.model if hasattr(response, 'model') else model
+        }
     
     async def generate_context_summary(
         self, 
@@ -179,15 +283,14 @@ class DeepseekService:
             for msg in messages[-10:]  # 只取最近10条消息
         ])
         
-        summary_prompt = f"""
-        请为以下对话生成一个简洁的摘要，突出关键讨论点和重要信息。
-        摘要长度不超过{max_length}字符。
+        cache_key = f"{max_length}:" + hashlib.blake2b(
+            conversation_text.encode(), digest_size=16
+        ).hexdigest()
+        cached = self._summary_cache.get(cache_key)
+        if cached is not None:
+            return cached
         
-        对话内容：
-        {conversation_text}
-        
-        摘要：
-        """
+        summary_prompt = _SUMMARY_TMPL.format(max_length=max_length, conversation_text=conversation_text)
         
         try:
             response = await self.generate_response(
@@ -203,6 +306,10 @@ class DeepseekService:
             if len(summary) > max_length:
                 summary = summary[:max_length-3] + "..."
             
+            # 出错时返回的是提示信息而非摘要，不写入缓存
+            if "error" not in response:
+                self._summary_cache.set(cache_key, summary)
+            
             return summary
             
         except Exception as e:
@@ -214,18 +321,25 @@ class DeepseekService:
         if not messages:
             return "无对话内容"
         
-        # 提取用户问题和助手回答
-        user_messages = [msg["content"] for msg in messages if msg["role"] == "user"]
-        assistant_messages = [msg["content"] for msg in messages if msg["role"] == "assistant"]
+        # 从末尾向前查找最新的用户问题和助手回答，两者都找到即停止
+        latest_user = latest_assistant = None
+        for msg in reversed(messages):
+            role = msg["role"]
+            if role == "user" and latest_user is None:
+                latest_user = msg["content"]
+            elif role == "assistant" and latest_assistant is None:
+                latest_assistant = msg["content"]
+            if latest_user is not None and latest_assistant is not None:
+                break
         
         summary_parts = []
         
-        if user_messages:
-            recent_question = user_messages[-1][:100] if user_messages[-1] else ""
+        if latest_user is not None:
+            recent_question = latest_user[:100] if latest_user else ""
             summary_parts.append(f"最新问题: {recent_question}")
         
-        if assistant_messages:
-            recent_answer = assistant_messages[-1][:100] if assistant_messages[-1] else ""
+        if latest_assistant is not None:
+            recent_answer = latest_assistant[:100] if latest_assistant else ""
             summary_parts.append(f"最新回答: {recent_answer}")
         
         summary_parts.append(f"对话轮次: {len(messages)}")
@@ -246,22 +360,7 @@ class DeepseekService:
     ) -> str:
         """为分支Agent生成专门的系统提示词"""
         
-        base_prompt = f"""
-        你是一个专门探讨"{branch_topic}"的学习助手。
-        
-        你的任务是：
-        1. 专注于深入探讨"{branch_topic}"这个特定话题
-        2. 提供详细、准确的解释和分析
-        3. 结合上下文信息，给出针对性的回答
-        4. 保持专业性和准确性
-        
-        上下文信息：
-        {parent_context}
-        
-        请基于以上上下文，专注于"{branch_topic}"话题进行深入讨论。
-        """
-        
-        return base_prompt.strip()
+        return _branch_prompt(branch_topic, parent_context)
     
     async def check_api_health(self) -> Dict[str, Any]:
         """检查Deepseek API健康状态"""
@@ -269,9 +368,19 @@ class DeepseekService:
             return {
                 "status": "unavailable",
                 "message": "API Key未配置",
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
         
+        if self._health_cache and time.monotonic() - self._health_cache_ts < self._health_cache_ttl:
+            return self._health_cache
+        
+        result = await self._probe_api_health()
+        self._health_cache = result
+        self._health_cache_ts = time.monotonic()
+        return result
+    
+    async def _probe_api_health(self) -> Dict[str, Any]:
+        """发送测试请求探测API状态"""
         try:
             # 发送一个简单的测试请求
             test_response = await self.generate_response(
@@ -284,7 +393,7 @@ class DeepseekService:
                 return {
                     "status": "error",
                     "message": test_response["error"],
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": now_iso()
                 }
             
             return {
@@ -292,14 +401,14 @@ class DeepseekService:
                 "message": "API连接正常",
                 "model": self.model,
                 "base_url": self.base_url,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
             
         except Exception as e:
             return {
                 "status": "error",
                 "message": f"API连接失败: {str(e)}",
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
 
 
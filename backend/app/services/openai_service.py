@@ -1,9 +1,121 @@
-import openai
 import asyncio
-from typing import List, Dict, Any, Optional
-from datetime import datetime
+import hashlib
+import json
+import random
+from openai import AsyncOpenAI
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
+from functools import lru_cache
 
 from app.core.config import settings, OPENAI_CONFIG
+from app.core.cache import ResponseCache, SemanticCache
+from app.core.clock import now_iso
+from app.core.http_client import get_http_client
+
+
+# API接受的消息角色与字段
+_VALID_ROLES = frozenset(("user", "assistant", "system"))
+_MESSAGE_KEYS = frozenset(("role", "content"))
+
+# 限流或服务端错误时重试，其余错误直接返回
+RETRYABLE_ERROR_TYPES = frozenset({"RateLimitError", "InternalServerError"})
+MAX_RETRIES = 5
+
+# 语义缓存：只缓存低温度（输出基本确定）的请求，如摘要生成
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 256  # 单次请求的输入条数（模型上限为2048）
+SEMANTIC_CACHE_MAX_TEMPERATURE = 0.3
+
+# 滚动摘要：新增内容不足该估算token数时沿用上次摘要
+ROLLING_SUMMARY_MIN_TOKENS = 1500
+# 每次交给模型摘要的最多消息条数（只取最近的消息）
+SUMMARY_MAX_MESSAGES = 10
+
+SUMMARY_SYSTEM_PROMPT = "你是一个专业的对话摘要助手，能够提取对话中的关键信息并生成简洁准确的摘要。"
+
+
+# 提示词模板：模块加载时构造一次，调用时只做format
+_SUMMARY_TMPL = """
+        请为以下对话生成一个简洁的摘要，突出关键讨论点和重要信息。
+        摘要长度不超过{max_length}字符。
+        
+        对话内容：
+        {conversation_text}
+        
+        摘要：
+        """
+
+_ROLLING_SUMMARY_TMPL = """
+        已有摘要：
+        {prior_summary}
+        
+        新增对话：
+        {new_text}
+        
+        请结合新增对话更新上述摘要，突出关键讨论点和重要信息，长度不超过{max_length}字符。
+        
+        摘要：
+        """
+
+_BRANCH_BASE_TMPL = """
+        你是一个专门探讨"{topic}"的学习助手。
+        
+        你的任务是：
+        1. 专注于深入探讨"{topic}"这个特定话题
+        2. 提供详细、准确的解释和分析
+        3. 帮助用户获得对这个话题的深入理解
+        4. 保持专业性和教育性
+        
+        请注意：
+        - 始终围绕"{topic}"展开讨论
+        - 提供具体的例子和实际应用
+        - 鼓励用户提出更深入的问题
+        - 如果用户偏离主题，温和地引导回到核心话题
+        """
+
+_BRANCH_CONTEXT_TMPL = """
+        基于之前的学习上下文：
+        {parent_context}
+        
+        请在此基础上继续深入探讨"{topic}"。
+        """
+
+
+@lru_cache(maxsize=1024)
+def _branch_prompts(branch_topic: str, parent_context: str, inheritance_mode: str) -> Tuple[str, Optional[str]]:
+    """生成分支提示词（纯函数，相同参数直接返回缓存结果）"""
+    base_prompt = _BRANCH_BASE_TMPL.format(topic=branch_topic)
+    
+    context_prompt = None
+    if parent_context and inheritance_mode != "none":
+        context_prompt = _BRANCH_CONTEXT_TMPL.format(parent_context=parent_context, topic=branch_topic)
+    
+    return base_prompt, context_prompt
+
+
+# token计数：优先使用tiktoken（可选依赖），编码器只加载一次；未安装时按字符估算
+try:
+    import tiktoken
+    
+    try:
+        _ENCODING = tiktoken.encoding_for_model(OPENAI_CONFIG["model"])
+    except KeyError:
+        _ENCODING = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _ENCODING = None
+
+
+@lru_cache(maxsize=4096)
+def _estimate_tokens(text: str) -> int:
+    """
+    计算文本的token数
+    
+    按内容缓存，对话中已计数的消息再次出现时直接命中。未安装tiktoken时粗略估算：
+    ASCII约4个字符一个token，中文等非ASCII字符约一字一个token。
+    """
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return (len(text) - non_ascii) // 4 + non_ascii
 
 
 class OpenAIService:
@@ -14,10 +126,24 @@ class OpenAIService:
         self.model = OPENAI_CONFIG["model"]
         self.max_tokens = OPENAI_CONFIG["max_tokens"]
         self.temperature = OPENAI_CONFIG["temperature"]
+        self.max_concurrency = OPENAI_CONFIG.get("max_concurrency", 8)
+        # 所有补全请求共用的并发上限，避免突发流量触发限流
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        self._semantic_cache = SemanticCache(threshold=0.95, max_entries=256)
+        # 进行中的请求：请求内容哈希 -> 调用任务
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # 滚动摘要检查点：对话ID -> (已有摘要, 已摘要的消息条数)
+        self._summary_checkpoints = ResponseCache(ttl_seconds=24 * 3600, max_entries=1024)
         
         if self.api_key:
-            openai.api_key = self.api_key
+            # 异步客户端在事件循环上直接发起请求，所有调用共享同一个连接池
+            self.client = AsyncOpenAI(
+                api_key=self.api_key,
+                timeout=30,  # 30秒超时
+                http_client=get_http_client()
+            )
         else:
+            self.client = None
             print("⚠️  警告: OpenAI API Key未配置，AI功能将不可用")
     
     async def generate_response(
@@ -27,9 +153,16 @@ class OpenAIService:
         agent_context: Dict[str, Any] = None,
         model: str = None,
         temperature: float = None,
-        max_tokens: int = None
+        max_tokens: int = None,
+        dynamic_context: Optional[str] = None
     ) -> Dict[str, Any]:
-        """生成AI回复"""
+        """
+        生成AI回复
+        
+        system_prompt应为固定的Agent设定，跨轮次逐字节保持不变，
+        API端的提示词前缀缓存才能命中；每轮变化的记忆/上下文通过dynamic_context
+        作为单独的system消息追加在其后。
+        """
         
         if not self.api_key:
             raise Exception("OpenAI API Key未配置")
@@ -40,40 +173,75 @@ class OpenAIService:
         max_tokens = max_tokens or self.max_tokens
         
         # 构建消息列表
-        api_messages = []
-        
-        # 添加系统提示词
-        if system_prompt:
-            api_messages.append({
-                "role": "system",
-                "content": system_prompt
-            })
-        
-        # 添加对话历史
-        for msg in messages:
-            if msg["role"] in ["user", "assistant", "system"]:
-                api_messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
+        api_messages = self._build_api_messages(messages, system_prompt, dynamic_context)
+        
+        # 合并完全相同的并发请求：后到的请求等待正在进行的调用，共享同一个结果
+        key = hashlib.blake2b(
+            json.dumps([api_messages, model, temperature, max_tokens], ensure_ascii=False, default=str).encode(),
+            digest_size=16
+        ).hexdigest()
+        # 调用在独立任务中进行，发起请求的调用方被取消时不影响其他等待者
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._complete(
+                api_messages, messages, system_prompt, dynamic_context, model, temperature, max_tokens
+            ))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish_inflight(key, done))
+        
+        return dict(await asyncio.shield(task))
+    
+    def _finish_inflight(self, key: str, task: asyncio.Task):
+        """调用结束后移除合并记录"""
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # 标记为已读取，等待者全部取消时不产生告警
+    
+    async def _complete(
+        self,
+        api_messages: List[Dict[str, str]],
+        messages: List[Dict[str, str]],
+        system_prompt: Optional[str],
+        dynamic_context: Optional[str],
+        model: str,
+        temperature: float,
+        max_tokens: int
+    ) -> Dict[str, Any]:
+        """调用Chat Completions API（先查语义缓存），失败时返回错误信息"""
+        # 低温度请求先查语义缓存：以系统提示词和最后一条用户消息的向量为键；
+        # 之前的对话历史按哈希放入scope精确匹配，不同对话的回答不会互相命中
+        cache_vector = None
+        if temperature <= SEMANTIC_CACHE_MAX_TEMPERATURE:
+            cache_scope = (model, max_tokens, self._history_digest(messages))
+            cache_vector = await self._embed_cache_key(system_prompt, dynamic_context, messages)
+            if cache_vector is not None:
+                cached = self._semantic_cache.get(cache_vector, cache_scope)
+                if cached is not None:
+                    return {**cached, "finish_reason": "cache_hit", "timestamp": now_iso()}
         
         try:
             # 调用OpenAI API
-            response = await self._call_openai_api(
-                messages=api_messages,
-                model=model,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
+            async with self._sem:
+                response = await self.client.chat.completions.create(
+                    model=model,
+                    messages=api_messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
             
-            return {
-                "content": response["choices"][0]["message"]["content"],
+            result = {
+                "content": response.choices[0].message.content,
                 "model": model,
-                "usage": response.get("usage", {}),
-                "finish_reason": response["choices"][0].get("finish_reason"),
-                "timestamp": datetime.now().isoformat()
+                "usage": response.usage.model_dump() if response.usage else {},
+                "finish_reason": response.choices[0].finish_reason,
+                "timestamp": now_iso()
             }
             
+            if cache_vector is not None:
+                self._semantic_cache.set(cache_vector, result, cache_scope)
+            
+            return result
+            
         except Exception as e:
             # 如果API调用失败，返回错误信息
             error_message = f"抱歉，AI服务暂时不可用。错误信息: {str(e)}"
@@ -83,40 +251,166 @@ class OpenAIService:
                 "model": model,
                 "usage": {},
                 "finish_reason": "error",
-                "timestamp": datetime.now().isoformat(),
-                "error": str(e)
+                "timestamp": now_iso(),
+                "error": str(e),
+                "error_type": type(e).__name__
             }
     
-    async def _call_openai_api(
+    async def stream_response(
+        self, 
+        messages: List[Dict[str, str]], 
+        system_prompt: str = None,
+        agent_context: Dict[str, Any] = None,
+        model: str = None,
+        temperature: float = None,
+        max_tokens: int = None,
+        dynamic_context: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """流式生成AI回复，逐块产出文本增量"""
+        
+        if not self.api_key:
+            raise Exception("OpenAI API Key未配置")
+        
+        model = model or self.model
+        temperature = temperature if temperature is not None else self.temperature
+        max_tokens = max_tokens or self.max_tokens
+        
+        api_messages = self._build_api_messages(messages, system_prompt, dynamic_context)
+        
+        try:
+            async with self._sem:
+                stream = await self.client.chat.completions.create(
+                    model=model,
+                    messages=api_messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+                
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+                    
+        except Exception as e:
+            # 与非流式接口一致，以错误提示作为回复内容
+            yield f"抱歉，AI服务暂时不可用。错误信息: {str(e)}"
+    
+    def _build_api_messages(
         self,
         messages: List[Dict[str, str]],
-        model: str,
-        temperature: float,
-        max_tokens: int
-    ) -> Dict[str, Any]:
-        """异步调用OpenAI API"""
-        
-        # 使用asyncio在线程池中运行同步的OpenAI调用
-        loop = asyncio.get_event_loop()
-        
-        def sync_openai_call():
-            return openai.ChatCompletion.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                timeout=30  # 30秒超时
+        system_prompt: Optional[str],
+        dynamic_context: Optional[str]
+    ) -> List[Dict[str, str]]:
+        """构建发送给API的消息列表"""
+        api_messages = []
+        
+        # 添加系统提示词
+        if system_prompt:
+            api_messages.append({
+                "role": "system",
+                "content": system_prompt
+            })
+        
+        # 动态上下文放在固定前缀之后，不影响前缀缓存
+        if dynamic_context:
+            api_messages.append({
+                "role": "system",
+                "content": dynamic_context
+            })
+        
+        # 添加对话历史：消息恰好只含role和content且角色合法时直接引用，否则逐条规整
+        if all(msg.keys() == _MESSAGE_KEYS and msg["role"] in _VALID_ROLES for msg in messages):
+            api_messages.extend(messages)
+        else:
+            api_messages.extend(
+                {"role": msg["role"], "content": msg["content"]}
+                for msg in messages if msg["role"] in _VALID_ROLES
             )
         
-        response = await loop.run_in_executor(None, sync_openai_call)
-        return response
+        return api_messages
+    
+    @staticmethod
+    def _history_digest(messages: List[Dict[str, str]]) -> str:
+        """除最后一条用户消息外的对话历史的哈希"""
+        last_user = next(
+            (index for index in range(len(messages) - 1, -1, -1) if messages[index]["role"] == "user"),
+            len(messages)
+        )
+        history = [[msg["role"], msg["content"]] for msg in messages[:last_user] + messages[last_user + 1:]]
+        return hashlib.blake2b(json.dumps(history, ensure_ascii=False).encode(), digest_size=16).hexdigest()
+    
+    async def _embed_cache_key(
+        self,
+        system_prompt: Optional[str],
+        dynamic_context: Optional[str],
+        messages: List[Dict[str, str]]
+    ) -> Optional[List[float]]:
+        """计算语义缓存键的向量，失败时返回None（跳过缓存）"""
+        last_user = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), "")
+        if not last_user:
+            return None
+        
+        try:
+            vectors = await self.embed_many([f"{system_prompt or ''}\n{dynamic_context or ''}\n{last_user}"])
+            return vectors[0]
+        except Exception:
+            return None
+    
+    async def embed_many(self, texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE) -> List[List[float]]:
+        """
+        批量计算文本向量
+        
+        每个请求最多携带batch_size条输入，K条文本只需约K/batch_size次往返；
+        返回的向量与texts顺序一致。
+        """
+        if not self.client:
+            raise Exception("OpenAI API Key未配置")
+        
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            response = await self.client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=texts[start:start + batch_size]
+            )
+            # 按index排序，保证与输入顺序一致
+            vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        
+        return vectors
+    
+    async def generate_many(self, jobs: List[Dict[str, Any]]) -> List[Any]:
+        """
+        并发执行多个generate_response请求
+        
+        同时在途的请求数由服务的并发上限（max_concurrency）约束，退避等待期间不占用名额；
+        遇到限流(429)或服务端错误(5xx)时按指数退避重试。
+        
+        Args:
+            jobs: generate_response的关键字参数列表
+            
+        Returns:
+            与jobs顺序一致的结果列表，单个请求抛出的异常作为结果返回
+        """
+        async def _one(job: Dict[str, Any]) -> Dict[str, Any]:
+            for attempt in range(MAX_RETRIES):
+                result = await self.generate_response(**job)
+                if result.get("error_type") not in RETRYABLE_ERROR_TYPES or attempt == MAX_RETRIES - 1:
+                    return result
+                await asyncio.sleep(2 ** attempt + random.random())
+        
+        return await asyncio.gather(*[_one(job) for job in jobs], return_exceptions=True)
     
     async def generate_context_summary(
         self, 
         messages: List[Dict[str, str]], 
-        max_length: int = 500
+        max_length: int = 500,
+        conversation_id: Optional[str] = None
     ) -> str:
-        """生成对话上下文摘要"""
+        """
+        生成对话上下文摘要
+        
+        传入conversation_id时按滚动方式摘要：只把上次摘要之后新增的消息连同已有摘要
+        交给模型更新，新增内容不足ROLLING_SUMMARY_MIN_TOKENS时直接返回已有摘要。
+        """
         
         if not messages:
             return "无对话内容"
@@ -125,26 +419,30 @@ class OpenAIService:
             # 如果没有API Key，使用简单的摘要方法
             return self._simple_summary(messages, max_length)
         
-        # 构建摘要提示词
-        conversation_text = "\n".join([
-            f"{msg['role']}: {msg['content']}"
-            for msg in messages[-10:]  # 只取最近10条消息
-        ])
-        
-        summary_prompt = f"""
-        请为以下对话生成一个简洁的摘要，突出关键讨论点和重要信息。
-        摘要长度不超过{max_length}字符。
-        
-        对话内容：
-        {conversation_text}
-        
-        摘要：
-        """
+        prior_summary, checkpoint = None, 0
+        if conversation_id:
+            prior_summary, checkpoint = self._summary_checkpoints.get(conversation_id) or (None, 0)
+            if checkpoint > len(messages):
+                # 对话被截断或替换，重新开始
+                prior_summary, checkpoint = None, 0
+        
+        if prior_summary:
+            new_messages = messages[checkpoint:]
+            # 逐条计数（结果按内容缓存），不对拼接后的整段文本重新计数
+            new_tokens = sum(_estimate_tokens(msg["content"]) for msg in new_messages)
+            if new_tokens < ROLLING_SUMMARY_MIN_TOKENS:
+                return prior_summary
+            new_text = self._format_conversation(new_messages[-SUMMARY_MAX_MESSAGES:])
+            summary_prompt = _ROLLING_SUMMARY_TMPL.format(
+                prior_summary=prior_summary, new_text=new_text, max_length=max_length
+            )
+        else:
+            summary_prompt = self._build_summary_prompt(messages, max_length)
         
         try:
             response = await self.generate_response(
                 messages=[{"role": "user", "content": summary_prompt}],
-                system_prompt="你是一个专业的对话摘要助手，能够提取对话中的关键信息并生成简洁准确的摘要。",
+                system_prompt=SUMMARY_SYSTEM_PROMPT,
                 temperature=0.3,  # 较低的温度以获得更一致的摘要
                 max_tokens=200
             )
@@ -155,29 +453,158 @@ class OpenAIService:
             if len(summary) > max_length:
                 summary = summary[:max_length-3] + "..."
             
+            if conversation_id and "error" not in response:
+                self._summary_checkpoints.set(conversation_id, (summary, len(messages)))
+            
             return summary
             
         except Exception as e:
             print(f"生成摘要失败: {e}")
             return self._simple_summary(messages, max_length)
     
+    def _format_conversation(self, messages: List[Dict[str, str]]) -> str:
+        """将消息列表格式化为摘要输入文本"""
+        return "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    
+    def _build_summary_prompt(self, messages: List[Dict[str, str]], max_length: int) -> str:
+        """构建摘要提示词"""
+        conversation_text = self._format_conversation(messages[-SUMMARY_MAX_MESSAGES:])
+        
+        return _SUMMARY_TMPL.format(max_length=max_length, conversation_text=conversation_text)
+    
+    async def submit_summary_batch(
+        self,
+        messages_per_agent: Dict[str, List[Dict[str, str]]],
+        max_length: int = 500
+    ) -> str:
+        """
+        通过Batch API批量提交摘要任务
+        
+        用于离线回填等非交互场景（费用约为在线调用的一半，24小时内完成），
+        交互请求仍使用generate_context_summary。
+        
+        Args:
+            messages_per_agent: Agent ID到其消息列表的映射
+            max_length: 摘要最大长度
+            
+        Returns:
+            批任务ID，用于poll_batch查询结果
+        """
+        if not self.client:
+            raise Exception("OpenAI API Key未配置")
+        
+        lines = []
+        for agent_id, messages in messages_per_agent.items():
+            if not messages:
+                continue
+            lines.append(json.dumps({
+                "custom_id": agent_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": [
+                        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                        {"role": "user", "content": self._build_summary_prompt(messages, max_length)}
+                    ],
+                    "temperature": 0.3,
+                    "max_tokens": 200
+                }
+            }, ensure_ascii=False))
+        
+        if not lines:
+            raise ValueError("没有需要摘要的对话")
+        
+        input_file = await self.client.files.create(
+            file=("summaries.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+    
+    async def poll_batch(self, batch_id: str) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        查询批任务结果
+        
+        Returns:
+            未完成时返回None；完成后返回custom_id（Agent ID）到结果的映射，
+            结果格式与generate_response一致
+        """
+        if not self.client:
+            raise Exception("OpenAI API Key未配置")
+        
+        batch = await self.client.batches.retrieve(batch_id)
+        if batch.status in ("failed", "expired", "cancelled"):
+            raise Exception(f"批任务{batch_id}未能完成: {batch.status}")
+        if batch.status != "completed":
+            return None
+        
+        results = {}
+        if not batch.output_file_id:
+            return results
+        
+        output = await self.client.files.content(batch.output_file_id)
+        timestamp = now_iso()
+        
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            
+            item = json.loads(line)
+            response = item.get("response") or {}
+            body = response.get("body") or {}
+            
+            if item.get("error") or response.get("status_code") != 200 or not body.get("choices"):
+                error = item.get("error") or body.get("error") or "批任务请求失败"
+                results[item["custom_id"]] = {
+                    "content": f"抱歉，AI服务暂时不可用。错误信息: {error}",
+                    "model": body.get("model", self.model),
+                    "usage": {},
+                    "finish_reason": "error",
+                    "timestamp": timestamp,
+                    "error": str(error)
+                }
+                continue
+            
+            choice = body["choices"][0]
+            results[item["custom_id"]] = {
+                "content": choice["message"]["content"],
+                "model": body.get("model", self.model),
+                "usage": body.get("usage", {}),
+                "finish_reason": choice.get("finish_reason"),
+                "timestamp": timestamp
+            }
+        
+        return results
+    
     def _simple_summary(self, messages: List[Dict[str, str]], max_length: int) -> str:
         """简单的摘要方法（不使用AI）"""
         if not messages:
             return "无对话内容"
         
-        # 提取用户问题和助手回答
-        user_messages = [msg["content"] for msg in messages if msg["role"] == "user"]
-        assistant_messages = [msg["content"] for msg in messages if msg["role"] == "assistant"]
+        # 从末尾向前查找最新的用户问题和助手回答，两者都找到即停止
+        latest_user = latest_assistant = None
+        for msg in reversed(messages):
+            role = msg["role"]
+            if role == "user" and latest_user is None:
+                latest_user = msg["content"]
+            elif role == "assistant" and latest_assistant is None:
+                latest_assistant = msg["content"]
+            if latest_user is not None and latest_assistant is not None:
+                break
         
         summary_parts = []
         
-        if user_messages:
-            recent_question = user_messages[-1][:100] if user_messages[-1] else ""
+        if latest_user is not None:
+            recent_question = latest_user[:100] if latest_user else ""
             summary_parts.append(f"最新问题: {recent_question}")
         
-        if assistant_messages:
-            recent_answer = assistant_messages[-1][:100] if assistant_messages[-1] else ""
+        if latest_assistant is not None:
+            recent_answer = latest_assistant[:100] if latest_assistant else ""
             summary_parts.append(f"最新回答: {recent_answer}")
         
         summary_parts.append(f"对话轮次: {len(messages)}")
@@ -195,45 +622,47 @@ class OpenAIService:
         branch_topic: str, 
         parent_context: str,
         inheritance_mode: str = "selective"
-    ) -> str:
-        """为分支Agent生成专门的系统提示词"""
-        
-        base_prompt = f"""
-        你是一个专门探讨"{branch_topic}"的学习助手。
-        
-        你的任务是：
-        1. 专注于深入探讨"{branch_topic}"这个特定话题
-        2. 提供详细、准确的解释和分析
-        3. 帮助用户获得对这个话题的深入理解
-        4. 保持专业性和教育性
-        
-        请注意：
-        - 始终围绕"{branch_topic}"展开讨论
-        - 提供具体的例子和实际应用
-        - 鼓励用户提出更深入的问题
-        - 如果用户偏离主题，温和地引导回到核心话题
+    ) -> Tuple[str, Optional[str]]:
         """
+        为分支Agent生成专门的系统提示词
         
-        if parent_context and inheritance_mode != "none":
-            base_prompt += f"""
-            
-        基于之前的学习上下文：
-        {parent_context}
-        
-        请在此基础上继续深入探讨"{branch_topic}"。
+        Returns:
+            (固定提示词, 父级上下文块)：前者作为generate_response的system_prompt，
+            后者作为dynamic_context，没有继承上下文时为None
         """
         
-        return base_prompt
+        return _branch_prompts(branch_topic, parent_context, inheritance_mode)
     
-    async def check_api_health(self) -> Dict[str, Any]:
-        """检查OpenAI API健康状态"""
+    async def check_api_health(self, deep: bool = False) -> Dict[str, Any]:
+        """
+        检查OpenAI API健康状态
+        
+        默认只请求模型列表（不消耗token，响应快）；deep=True时发送一次真实的补全请求，
+        用于偶尔的完整连通性验证。
+        """
         if not self.api_key:
             return {
                 "status": "unavailable",
                 "message": "API Key未配置",
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
         
+        if not deep:
+            try:
+                await self.client.models.list()
+                return {
+                    "status": "healthy",
+                    "message": "API正常工作",
+                    "model": self.model,
+                    "timestamp": now_iso()
+                }
+            except Exception as e:
+                return {
+                    "status": "error",
+                    "message": str(e),
+                    "timestamp": now_iso()
+                }
+        
         try:
             # 发送一个简单的测试请求
             test_response = await self.generate_response(
@@ -246,21 +675,21 @@ class OpenAIService:
                 return {
                     "status": "error",
                     "message": test_response["error"],
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": now_iso()
                 }
             
             return {
                 "status": "healthy",
                 "message": "API正常工作",
                 "model": self.model,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
             
         except Exception as e:
             return {
                 "status": "error",
                 "message": str(e),
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
     
     def get_model_info(self) -> Dict[str, Any]:
@@ -270,4 +699,4 @@ class OpenAIService:
             "max_tokens": self.max_tokens,
             "temperature": self.temperature,
             "api_configured": bool(self.api_key)
-        }
\ No newline at end of file
+        }
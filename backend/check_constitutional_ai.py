@@ -6,18 +6,23 @@ cursor = conn.cursor()
 
 # 查询宪法式AI agent的历史消息
 agent_id = 'e407f16b-662e-4ee1-8485-bd7e17fbcb9b'
-cursor.execute('SELECT id, agent_id, role, content, timestamp FROM messages WHERE agent_id = ?', (agent_id,))
-results = cursor.fetchall()
+# 计数和逐行读取都走(agent_id, timestamp)索引；内容只取前100个字符，不把大段内容读入Python
+total = cursor.execute('SELECT COUNT(*) FROM messages WHERE agent_id = ?', (agent_id,)).fetchone()[0]
 
 print('📨 宪法式AI agent的历史消息:')
 print(f'Agent ID: {agent_id}')
-print(f'总共找到 {len(results)} 条消息')
+print(f'总共找到 {total} 条消息')
 print('-' * 80)
 
-for i, r in enumerate(results, 1):
+cursor.execute(
+    'SELECT id, role, substr(content, 1, 100), length(content) > 100, timestamp '
+    'FROM messages WHERE agent_id = ? ORDER BY timestamp',
+    (agent_id,)
+)
+for i, r in enumerate(cursor, 1):
     print(f'{i}. ID: {r[0][:8]}...')
-    print(f'   Role: {r[2]}')
-    print(f'   Content: {r[3][:100]}...' if len(r[3]) > 100 else f'   Content: {r[3]}')
+    print(f'   Role: {r[1]}')
+    print(f'   Content: {r[2]}...' if r[3] else f'   Content: {r[2]}')
     print(f'   Time: {r[4]}')
     print()
 
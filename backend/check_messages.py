@@ -6,9 +6,8 @@ def check_messages():
     
     # 检查消息表结构
     cursor.execute("PRAGMA table_info(messages)")
-    columns = cursor.fetchall()
     print('Messages table structure:')
-    for col in columns:
+    for col in cursor:
         print(f'  {col[1]} ({col[2]})')
     
     # 检查消息总数
@@ -19,14 +18,17 @@ def check_messages():
     # 按Agent分组的消息数量
     cursor.execute('SELECT agent_id, COUNT(*) FROM messages GROUP BY agent_id')
     print('\nMessages per agent:')
-    for row in cursor.fetchall():
+    for row in cursor:
         print(f'  Agent {row[0]}: {row[1]} messages')
     
-    # 最近的消息（使用id排序）
-    cursor.execute('SELECT id, agent_id, content FROM messages ORDER BY id DESC LIMIT 10')
+    # 最近的消息（使用id排序）：只取内容前100个字符，大段内容不读入Python
+    cursor.execute(
+        'SELECT id, agent_id, substr(content, 1, 100), length(content) > 100 '
+        'FROM messages ORDER BY id DESC LIMIT 10'
+    )
     print('\nRecent messages:')
-    for row in cursor.fetchall():
-        content_preview = row[2][:100] + '...' if len(row[2]) > 100 else row[2]
+    for row in cursor:
+        content_preview = row[2] + '...' if row[3] else row[2]
         print(f'  ID: {row[0]}, Agent: {row[1]}')
         print(f'    Content: {content_preview}')
     
@@ -6,11 +6,18 @@
 
 import os
 import sys
+import shutil
 import subprocess
 import argparse
 import time
+import urllib.error
+import urllib.request
 from pathlib import Path
 
+# 后端就绪探测地址和最长等待时间（秒）
+BACKEND_READY_URL = "http://localhost:8000/ready"
+BACKEND_READY_TIMEOUT = 15
+
 def check_requirements():
     """检查系统要求"""
     print("🔍 检查系统要求...")
@@ -53,7 +60,7 @@ def setup_environment():
     if not os.path.exists(".env"):
         if os.path.exists(".env.example"):
             print("📋 复制.env.example到.env")
-            subprocess.run(["cp", ".env.example", ".env"])
+            shutil.copy(".env.example", ".env")
             print("⚠️  请编辑.env文件，添加你的OpenAI API Key")
         else:
             print("❌ 未找到.env.example文件")
@@ -65,22 +72,26 @@ def install_dependencies():
     """安装依赖"""
     print("📦 安装依赖...")
     
-    # 安装前端依赖
+    # 前端和后端依赖互不相关，同时安装
     print("📦 安装前端依赖...")
-    result = subprocess.run(["npm", "install"], cwd=".")
-    if result.returncode != 0:
-        print("❌ 前端依赖安装失败")
-        return False
+    frontend_install = subprocess.Popen(["npm", "install"], cwd=".")
     
-    # 安装后端依赖
-    print("📦 安装后端依赖...")
+    backend_install = None
     backend_path = Path("backend")
     if backend_path.exists():
-        result = subprocess.run([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"], 
-                              cwd=backend_path)
-        if result.returncode != 0:
-            print("❌ 后端依赖安装失败")
-            return False
+        print("📦 安装后端依赖...")
+        backend_install = subprocess.Popen([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"], 
+                                           cwd=backend_path)
+    
+    frontend_ok = frontend_install.wait() == 0
+    backend_ok = backend_install is None or backend_install.wait() == 0
+    
+    if not frontend_ok:
+        print("❌ 前端依赖安装失败")
+    if not backend_ok:
+        print("❌ 后端依赖安装失败")
+    if not (frontend_ok and backend_ok):
+        return False
     
     print("✅ 依赖安装完成")
     return True
@@ -108,6 +119,21 @@ def start_backend(dev_mode=True):
         print(f"❌ 后端服务启动失败: {e}")
         return None
 
+def wait_for_backend(process, timeout=BACKEND_READY_TIMEOUT):
+    """轮询后端就绪接口，返回200或超时/进程退出时结束"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with urllib.request.urlopen(BACKEND_READY_URL, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.1)
+    return False
+
 def start_frontend(dev_mode=True):
     """启动前端服务"""
     print("🚀 启动前端服务...")
@@ -161,7 +187,11 @@ def main():
             backend_process = start_backend(dev_mode)
             if backend_process:
                 processes.append(backend_process)
-                time.sleep(3)  # 等待后端启动
+                # 等待后端就绪后再启动前端
+                if wait_for_backend(backend_process):
+                    print("✅ 后端服务已就绪")
+                else:
+                    print("⚠️  后端服务未在{}秒内就绪，继续启动前端".format(BACKEND_READY_TIMEOUT))
         
         if not args.backend_only:
             frontend_process = start_frontend(dev_mode)